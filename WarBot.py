@@ -1,10 +1,14 @@
 from datetime import datetime
 import threading
 import time
+import itertools
 import shelve
 import argparse
 import os.path
 import dbm
+import json
+import secrets
+from urllib.parse import urlsplit
 
 import requests
 
@@ -12,6 +16,29 @@ from invasion import Invasion
 from alert import Alert
 from deal import Deal
 from news import News
+from feedcache import FeedCache
+from feeds import FeedSource, WorldstateSource, FeedPipeline, decode_lines
+from connection import ConnectionPool
+from dispatcher import Dispatcher
+from broadcast import Broadcaster, get_retry_after, get_send_params
+from aio import AsyncEngine
+from webhook import WebhookServer
+from scheduler import NotificationScheduler
+from outbox import Outbox, REPLIES
+from shards import ShardedSender
+from coalesce import MessageBuilder, chunk_text
+from reminders import Reminders, Reminder, parse_duration, format_duration
+from polling import LongPollController, get_offset, get_confirm_params
+from filters import ChatFilters
+from subscribers import SubscriberRegistry, ChatSettings
+from matcher import RewardMatcher, normalize
+from tracker import SeenTracker
+from statestore import StateStore
+from render import RenderCache, prerender, splice
+from metrics import (REGISTRY, Counter, Gauge, MetricsServer, UPDATES,
+                     NOTIFIER_CYCLE_SECONDS)
+from profiling import SamplingProfiler
+from tracing import TRACER, save
 
 
 class WarBot:
@@ -19,13 +46,116 @@ class WarBot:
     TOKEN = 'your token here'
     API_URL = 'https://api.telegram.org/bot' + TOKEN + '/'
 
-    INVASION_URL = 'https://deathsnacks.com/wf/data/invasion.json'
-    ALERT_URL = 'https://deathsnacks.com/wf/data/last15alerts_localized.json'
-    DEAL_URL = 'http://deathsnacks.com/wf/data/daily_deals.json'
-    NEWS_URL = 'https://deathsnacks.com/wf/data/news_raw.txt'
-
+    # Feed URLs, {base} is replaced by FEED_URL and {platform} by the
+    # path of every platform
+    FEED_URL = 'https://deathsnacks.com/wf/data/'
+    INVASION_URL = '{base}{platform}invasion.json'
+    ALERT_URL = '{base}{platform}last15alerts_localized.json'
+    DEAL_URL = '{base}{platform}daily_deals.json'
+    NEWS_URL = '{base}{platform}news_raw.txt'
+
+    # URL of a single JSON document with 'alerts', 'invasions', 'deals'
+    # and 'news' lists, replacing the four URLs above when set, {base}
+    # and {platform} are replaced as well. deathsnacks serves separate
+    # files, this is meant for a mirror
+    WORLDSTATE_URL = None
+
+    # Game platforms chats can choose with /platform, with the path of
+    # their feeds. Chats that have not chosen one are on DEFAULT_PLATFORM
+    PLATFORMS = {'pc': '', 'ps4': 'ps4/', 'xb1': 'xb1/', 'swi': 'swi/'}
+    DEFAULT_PLATFORM = 'pc'
+
+    # Seconds a fetched feed is shared before it is revalidated
+    FEED_TTL = 30
+    DEAL_TTL = 300
+    NEWS_TTL = 120
+
+    # Commands are answered from a feed up to MAX_STALE seconds past its
+    # TTL while it is revalidated in the background. A feed is not
+    # fetched for FEED_COOLDOWN seconds after FEED_FAILURES consecutive
+    # failures
+    MAX_STALE = 3600
+    FEED_FAILURES = 5
+    FEED_COOLDOWN = 30
+
+    # Seconds between checks of a notified feed. Feeds that keep changing
+    # are checked more often, down to MIN_NOTIFICATION_INTERVAL, and
+    # unchanged ones less often, up to MAX_NOTIFICATION_INTERVAL
     NOTIFICATION_INTERVAL = 60
+    MIN_NOTIFICATION_INTERVAL = 15
+    MAX_NOTIFICATION_INTERVAL = 180
+
+    # Seconds after an alert or deal expires its feed is checked again
+    # for the one replacing it
+    EXPIRY_CHECK_DELAY = 5
+
+    # Feeds with expiring items chats can be reminded of, and the
+    # resolution of reminders in seconds
+    REMINDED_FEEDS = ('alerts', 'deals')
+    REMINDER_TICK = 1.0
+
+    # Seconds the notifications and reminders of a chat are collected
+    # for, to be sent in as few messages as possible
+    COALESCE_WINDOW = 5
+
+    # Feeds checked by the notifier
+    NOTIFIED_FEEDS = ('alerts', 'invasions', 'news')
+
+    # Seconds invasions and news are remembered after leaving the feed
+    NOTIFIED_RETENTION = 3600
+
+    # Minimum number of seconds between compactions of the state file
+    COMPACT_INTERVAL = 3600
+
+    # Long poll settings, in seconds. Polls wait IDLE_TIMEOUT while the
+    # bot is idle and TIMEOUT while commands keep coming, and back off up
+    # to MAX_POLL_BACKOFF after errors
+    IDLE_TIMEOUT = 50
     TIMEOUT = 5
+    POLL_LIMIT = 100
+    POLL_BACKOFF = 1
+    MAX_POLL_BACKOFF = 60
+
+    # HTTP connection pool settings, timeouts are in seconds
+    POOL_SIZE = 10
+    CONNECT_TIMEOUT = 5
+    READ_TIMEOUT = 15
+    RETRIES = 3
+
+    # Command dispatcher settings, HANDLER_TIMEOUT is in seconds
+    WORKERS = 8
+    QUEUE_SIZE = 100
+    HANDLER_TIMEOUT = 30
+
+    # Notification broadcast settings. Telegram allows about 30 messages
+    # per second overall and one per second to the same chat
+    BROADCAST_WORKERS = 16
+    BROADCAST_RATE = 30
+    CHAT_INTERVAL = 1.0
+
+    # Default number of sender processes, 0 sends from the main process.
+    # BROADCAST_RATE is shared by all of them
+    SHARDS = 0
+
+    # Outbox settings. Failed sends are retried up to SEND_RETRIES times,
+    # SEND_BACKOFF seconds after the first failure and twice as long after
+    # every further one, up to MAX_SEND_BACKOFF. Queued messages are
+    # written to the state file every OUTBOX_FLUSH_INTERVAL seconds. On
+    # quit, due messages are sent for up to OUTBOX_DRAIN_TIMEOUT seconds.
+    # At most OUTBOX_IN_FLIGHT messages are handed to the sender at once,
+    # replies to commands skip the notifications waiting beyond that
+    SEND_RETRIES = 8
+    SEND_BACKOFF = 2
+    MAX_SEND_BACKOFF = 600
+    OUTBOX_FLUSH_INTERVAL = 1.0
+    OUTBOX_DRAIN_TIMEOUT = 5
+    OUTBOX_IN_FLIGHT = 30
+
+    # Default seconds profiles and traces started from the console are
+    # recorded for, and seconds between two samples of a profile
+    PROFILE_SECONDS = 30
+    PROFILE_INTERVAL = 0.005
+    TRACE_SECONDS = 10
 
     USAGE = (
                 'Warframe alert and invasion bot v1.0 by @nspacestd\n\n'
@@ -37,41 +167,58 @@ class WarBot:
                 '/invasions all - Show all current invasions\n'
                 '/darvo - Show current daily deals\n'
                 '/news - Show the news\n'
-                '/notify [on|off] turn notifications on/off'
+                '/notify [on|off] turn notifications on/off\n'
+                '/mute HH:MM-HH:MM - Mute notifications daily, in server '
+                'time\n'
+                '/mute off - Unmute notifications\n'
+                '/platform [pc|ps4|xb1|swi] - Show or choose the game '
+                'platform of this chat\n'
+                '/filter add <reward> - Watch a reward in this chat\n'
+                '/filter remove <reward> - Stop watching a reward\n'
+                '/filter list - Show the rewards watched in this chat\n'
+                '/remind <time> - Remind this chat of alerts and deals '
+                '<time> before they expire, e.g. /remind 10m\n'
+                '/remind off - Stop reminders\n\n'
+                'Chats watching rewards are only shown and notified '
+                'alerts and invasions with those rewards'
             )
 
-    def __init__(self, reward_path, state_path):
+    def __init__(self, reward_path, state_path, pool_size=POOL_SIZE,
+                 workers=WORKERS, legacy_state_path=None):
 
         # Path to file containing rewards to filter
         self.reward_path = reward_path
 
-        # IDs of chats with active notifications
-        self.notification_chats = []
-        
-        # IDs of notified alerts, invasions and news
-        self.notified_alerts = []
-        self.notified_invasions = []
-        self.notified_news = []
+        # Persistent program state, every change is written immediately
+        self.store = StateStore(state_path, WarBot.COMPACT_INTERVAL)
 
-        # Read saved program state
-        try:
-            with shelve.open(state_path, flag='r') as f:
-                self.notification_chats = f['chats']
-                self.notified_alerts = f['alerts']
-                self.notified_invasions = f['invasions']
-                self.notified_news = f['news']
-        except dbm.error:
-            print('State file not found, defaulting to empty')
-            self.notification_chats = []
-            self.notified_alerts = []
-            self.notified_invasions = []
-            self.notified_news = []
-        except KeyError:
-            print('Bad state file, defaulting to empty')
-            self.notification_chats = []
-            self.notified_alerts = []
-            self.notified_invasions = []
-            self.notified_news = []
+        # Import the shelve state file of older versions
+        if self.store.is_new:
+            if legacy_state_path and self.import_state(legacy_state_path):
+                print('Imported state from ' + legacy_state_path)
+            else:
+                print('State file not found, defaulting to empty')
+
+        # Chats with active notifications, and the settings of every chat
+        self.subscribers = SubscriberRegistry(
+            self.store.get_chats(),
+            {c: ChatSettings(*row)
+             for c, row in self.store.get_chat_settings().items()})
+
+        # IDs of notified alerts, invasions and news, and of deals chats
+        # with reminders have been reminded of, by platform and kind
+        self.notified = {p: {k: self.load_tracker(k, p)
+                             for k in WarBot.NOTIFIED_FEEDS + ('deals',)}
+                         for p in WarBot.PLATFORMS}
+
+        # Per chat reward watch lists
+        self.chat_filters = ChatFilters(self.store.get_filters())
+
+        # Pending expiry reminders, and how early every chat wants them
+        self.reminders = Reminders(self.store.get_reminder_leads(),
+                                   WarBot.REMINDER_TICK)
+        for row in self.store.get_reminders():
+            self.reminders.add(Reminder(*row))
 
         # Event that starts or stops notifications
         self.notifications = threading.Event()
@@ -79,18 +226,63 @@ class WarBot:
         # Notifications are inactive by default
         self.notifications.clear()
 
-        # Lock for notification_chats
-        self.notification_lock = threading.Lock()
-
-        # Lock for reward_filter
+        # Lock serializing reloads of reward_filter. Readers do not need
+        # it, reward_filter is replaced as a whole
         self.reward_lock = threading.Lock()
 
-        # Path to file for saving program state
-        self.state_path = state_path
+        # Pooled keep-alive sessions for Telegram and deathsnacks
+        self.http = ConnectionPool(pool_size, WarBot.CONNECT_TIMEOUT,
+                                   WarBot.READ_TIMEOUT, WarBot.RETRIES)
+
+        # Feed snapshots shared by command handlers and the notifier,
+        # saved to the state store
+        self.feed_cache = FeedCache(self.http, WarBot.FEED_TTL,
+                                    WarBot.MAX_STALE, WarBot.FEED_FAILURES,
+                                    WarBot.FEED_COOLDOWN, self.store)
+
+        # Fetches, decodes and parses the feeds, by name
+        self.feeds = FeedPipeline(self.feed_cache, self.get_feed_sources())
+
+        # Plans the notifier's checks of the feeds of every platform
+        self.schedule = NotificationScheduler(
+            [(p, n) for p in WarBot.PLATFORMS
+             for n in WarBot.NOTIFIED_FEEDS + ('deals',)],
+            WarBot.NOTIFICATION_INTERVAL, WarBot.MIN_NOTIFICATION_INTERVAL,
+            WarBot.MAX_NOTIFICATION_INTERVAL)
+
+        # Pre-rendered replies, by feed snapshot version
+        self.renders = RenderCache()
+
+        # AsyncEngine running the bot, None in threaded mode
+        self.async_engine = None
+
+        # Runs command handlers concurrently, in order within each chat
+        self.dispatcher = Dispatcher(self.bot, workers, WarBot.QUEUE_SIZE,
+                                     WarBot.HANDLER_TIMEOUT)
+
+        # Sends messages concurrently within Telegram's rate limits
+        self.broadcaster = Broadcaster(self.send, WarBot.BROADCAST_WORKERS,
+                                       WarBot.BROADCAST_RATE,
+                                       WarBot.CHAT_INTERVAL)
+
+        # Every reply and notification is queued here until delivered
+        self.outbox = Outbox(self.store, WarBot.SEND_RETRIES,
+                             WarBot.SEND_BACKOFF, WarBot.MAX_SEND_BACKOFF,
+                             WarBot.OUTBOX_FLUSH_INTERVAL, self.unsubscribe,
+                             WarBot.OUTBOX_IN_FLIGHT)
+
+        # Packs notifications and reminders into messages for the outbox
+        self.messages = MessageBuilder(self.outbox.put,
+                                       WarBot.COALESCE_WINDOW)
 
         # When set to True application closes
         self.close = False
 
+        # SamplingProfiler started from the console, None if not running
+        self.profiler = None
+
+        self.register_metrics()
+
         # Load reward filter from file
         self.load_rewards()
 
@@ -102,25 +294,140 @@ class WarBot:
         # Lines starting with '#' and blank lines are ignored
         with self.reward_lock:
             with open(self.reward_path) as f:
-                self.reward_filter = list(filter(
+                rewards = list(filter(
                     lambda l: l and not l.startswith('#'),
                     (line.strip() for line in f)))
 
-    def run(self):
+            # Compile before swapping, so that readers always see a
+            # complete filter
+            self.reward_filter = RewardMatcher(rewards)
+
+    def register_metrics(self):
+        """ Adds metrics of the bot's state to the metrics registry,
+        read whenever the metrics are collected
+
+        """
+        def notified():
+            return {(p, k): len(t) for p, trackers in self.notified.items()
+                    for k, t in trackers.items()}
+
+        def outbox():
+            stats = self.outbox.get_stats()
+            return {(k,): stats[k] for k in ('queued', 'sent', 'retried',
+                                              'failed', 'blocked')}
+
+        for metric in (
+                Gauge('warbot_subscribers', 'Chats with notifications',
+                      function=lambda: len(self.subscribers)),
+                Gauge('warbot_notified_ids',
+                      'Tracked IDs of notified items, by platform and kind',
+                      ('platform', 'kind'), notified),
+                Gauge('warbot_outbox_pending',
+                      'Messages waiting in the outbox or being sent',
+                      function=lambda: len(self.outbox)),
+                Counter('warbot_outbox_messages_total',
+                      'Outbox messages since the start, by outcome',
+                      ('outcome',), outbox),
+                Gauge('warbot_coalesce_pending',
+                      'Chats with notifications waiting to be packed into '
+                      'messages', function=lambda: len(self.messages)),
+                Gauge('warbot_reminders_pending', 'Scheduled reminders',
+                      function=lambda: len(self.reminders)),
+                Gauge('warbot_command_queue',
+                      'Commands waiting for a worker',
+                      function=self.dispatcher.pending)):
+            REGISTRY.register(metric)
+
+    def run(self, engine='threaded', webhook_url=None,
+            listen=('0.0.0.0', 8443), webhook_secret=None, shards=SHARDS,
+            metrics_listen=None):
         """ Run the bot and wait for user to manually stop it
         At exit save chats with active notifications
+        Throws RuntimeError if the engine is not available or the
+        webhook cannot be set
+
+        Parameters
+        ----------
+        engine : str
+            'threaded' runs polling, command handlers and the notifier in
+            threads, 'asyncio' runs them as coroutines on one event loop
+        webhook_url : str
+            Public HTTPS URL telegram sends updates to, forwarded to
+            listen. Updates are polled if None
+        listen : (str, int) tuple
+            Host and port of the webhook server
+        webhook_secret : str
+            Secret token checked on every update, random if None
+        shards : int
+            Number of processes messages are sent from, by chat ID.
+            Only supported by the threaded engine, 0 sends them from
+            this process
+        metrics_listen : (str, int) tuple
+            Host and port metrics are served on in the Prometheus text
+            format, at /metrics. Not served if None
 
         """
 
-        # Spawn new thread for main messaging loop
-        threading.Thread(target=self.loop).start()
+        if shards and engine == 'asyncio':
+            raise RuntimeError('Sharded sending requires the threaded '
+                               'engine')
+
+        # Start sender processes before any other thread
+        sender = self.broadcaster
+        if shards:
+            sender = ShardedSender(shards, WarBot.API_URL,
+                                   WarBot.BROADCAST_RATE,
+                                   WarBot.CHAT_INTERVAL,
+                                   WarBot.BROADCAST_WORKERS,
+                                   WarBot.POOL_SIZE, WarBot.CONNECT_TIMEOUT,
+                                   WarBot.READ_TIMEOUT, WarBot.RETRIES)
+
+        metrics_server = None
+        if metrics_listen:
+            try:
+                metrics_server = MetricsServer(metrics_listen)
+            except OSError as e:
+                raise RuntimeError('Cannot serve metrics on {}:{}: {}'.format(
+                    metrics_listen[0], metrics_listen[1], e))
+            metrics_server.start()
 
-        # Spawn new thread for notifier, and set it to daemon mode
-        t = threading.Thread(target=self.notifier)
-        t.daemon = True
-        t.start()
+        if engine == 'asyncio':
+            self.async_engine = AsyncEngine(self, polling=not webhook_url)
 
-        if self.notification_chats:
+        webhook_server = None
+        if webhook_url:
+            # Updates wait in the listen backlog until the server starts
+            webhook_server = self.set_webhook(webhook_url, listen,
+                                              webhook_secret)
+
+        if engine == 'asyncio':
+            # Polling, commands and notifications run on an event loop
+            self.async_engine.start()
+
+        else:
+            # Start command workers and the outbox
+            self.dispatcher.start()
+            self.outbox.start(sender)
+
+            # Spawn new thread for main messaging loop
+            if webhook_server is None:
+                loop_thread = threading.Thread(target=self.loop)
+                loop_thread.daemon = True
+                loop_thread.start()
+
+            # Spawn new thread for notifier, and set it to daemon mode
+            t = threading.Thread(target=self.notifier)
+            t.daemon = True
+            t.start()
+
+            t = threading.Thread(target=self.ticker)
+            t.daemon = True
+            t.start()
+
+        if webhook_server is not None:
+            webhook_server.start()
+
+        if self.subscribers or self.reminders.leads:
             self.notifications.set()
 
         print('WarBot is running')
@@ -129,17 +436,133 @@ class WarBot:
 
         try:
             while s.lower() != 'q':
-                print('[Q]: Quit [R]: Reload rewards file')
-                s = input()
-                if s.lower() == 'r':
+                print('[Q]: Quit [R]: Reload rewards file '
+                      '[S]: Show delivery statistics\n'
+                      '[P] [seconds] [file]: Profile all threads '
+                      '[T] [seconds] [file]: Record a trace')
+                s = input().strip()
+                command, *args = s.lower().split() or ['']
+                if command == 'r':
                     self.load_rewards()
                     print('Rewards file reloaded\n')
+                elif command == 's':
+                    print(self.get_stats_string())
+                elif command in ('p', 't'):
+                    try:
+                        self.record(command, s.split()[1:])
+                    except (ValueError, RuntimeError) as e:
+                        print('Error: ', e)
 
         except EOFError:
             print('EOF received, quitting')
 
         self.close = True
+
+        if metrics_server is not None:
+            metrics_server.stop()
+
+        if webhook_server is not None:
+            self.delete_webhook(webhook_server)
+
+        # Wait for the queued commands to finish. A long poll still
+        # waiting for updates is abandoned after TIMEOUT seconds
+        if engine == 'asyncio':
+            self.async_engine.stop()
+        else:
+            if webhook_server is None:
+                loop_thread.join(WarBot.TIMEOUT)
+            self.dispatcher.stop()
+
+        # Send what is due, keep the rest for the next start
+        self.messages.flush(force=True)
+        self.outbox.stop(WarBot.OUTBOX_DRAIN_TIMEOUT)
+
+        # Background revalidations stop saving feeds before the store
+        # is closed
+        self.feeds.close()
         self.save_state()
+        self.broadcaster.close()
+        self.http.close()
+
+    def record(self, command, args):
+        """ Starts a profile or trace from the console, see profile
+        and trace
+        Throws ValueError if the arguments are invalid
+
+        Parameters
+        ----------
+        command : str
+            'p' to profile, 't' to trace
+        args : list of str
+            Seconds to record for and file to write to, both optional
+        """
+        if command == 'p':
+            seconds, name = WarBot.PROFILE_SECONDS, 'profile-{}.pstats'
+        else:
+            seconds, name = WarBot.TRACE_SECONDS, 'trace-{}.json'
+
+        if args:
+            seconds = float(args[0])
+            if not seconds > 0:
+                raise ValueError('seconds must be positive')
+        path = args[1] if len(args) > 1 else \
+            name.format(datetime.now().strftime('%Y%m%d-%H%M%S'))
+
+        if command == 'p':
+            self.profile(seconds, path)
+        else:
+            self.trace(seconds, path)
+        print('Recording for {:g}s to {}'.format(seconds, path))
+
+    def profile(self, seconds, path):
+        """ Samples the stacks of all threads for some seconds, then
+        writes the statistics to path in the format of cProfile
+        Throws RuntimeError if a profile is already running
+
+        """
+        if self.profiler is not None:
+            raise RuntimeError('A profile is already running')
+
+        self.profiler = SamplingProfiler(WarBot.PROFILE_INTERVAL)
+        self.profiler.start()
+
+        def finish():
+            profiler, self.profiler = self.profiler, None
+            profiler.stop()
+            try:
+                profiler.save(path)
+            except OSError as e:
+                print('Error writing profile: ', e)
+                return
+            print('Profile of {} samples written to {}'.format(
+                profiler.samples, path))
+
+        t = threading.Timer(seconds, finish)
+        t.daemon = True
+        t.start()
+
+    def trace(self, seconds, path):
+        """ Records spans of command handlers, feed fetches, parsing,
+        rendering and sends for some seconds, then writes them to path
+        as a Chrome trace, see tracing.Tracer
+        Throws RuntimeError if a trace is already being recorded
+
+        """
+        TRACER.start()
+
+        def finish():
+            trace = TRACER.stop()
+            try:
+                save(trace, path)
+            except OSError as e:
+                print('Error writing trace: ', e)
+                return
+            spans = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+            print('Trace of {} spans written to {}'.format(len(spans), path))
+
+        t = threading.Timer(seconds, finish)
+        t.daemon = True
+        t.start()
 
     def loop(self):
         """ Main loop, polls telegram servers for updates
@@ -149,74 +572,239 @@ class WarBot:
         # offset should be one higher than the highest received update_id
         offset = 0
 
+        poll = self.get_poll_controller()
+
         # Main loop
         while not self.close:
-            p = {'timeout': WarBot.TIMEOUT, 'offset': offset}
-            r = None
+            p = poll.get_params(offset)
+
+            # The read timeout has to outlast the long poll
+            t = (WarBot.CONNECT_TIMEOUT,
+                 poll.get_read_timeout(WarBot.READ_TIMEOUT))
 
             try:
-                r = requests.post(WarBot.API_URL + 'getUpdates', params=p).json()
+                r = self.http.post(WarBot.API_URL + 'getUpdates', params=p,
+                                   timeout=t).json()
             except ValueError:
                 print('Invalid JSON from Telegram API')
-                time.sleep(2)
+                time.sleep(poll.failure())
                 continue
-            except requests.ConnectionError as e:
+            except requests.exceptions.RequestException as e:
                 print('Error connecting to API server: ', e)
-                time.sleep(2)
+                time.sleep(poll.failure())
+                continue
+
+            if not r.get('ok'):
+                print('Bad response from Telegram API: ', r.get('description'))
+                time.sleep(poll.failure(get_retry_after(r)
+                                        if r.get('error_code') == 429 else 0))
                 continue
 
-            if r and r['ok']:
-                for update in r['result']:
-                    if update['update_id'] >= offset:
-                        offset = update['update_id'] + 1
-                    if 'message' in update and 'text' in update['message']:
-                        try:
-                            self.bot(update['message'])
-                        except RuntimeError as e:
-                            print(e)
+            # Leave a batch received while quitting unconfirmed, telegram
+            # delivers it again on the next start
+            if self.close:
+                break
+
+            updates = r['result']
+            poll.success(len(updates))
+
+            # Blocks while a chat's worker queue is full
+            for update in updates:
+                self.receive(update)
+            offset = get_offset(updates, offset)
+
+        self.confirm_updates(offset)
+
+    def get_poll_controller(self):
+        """ Returns a LongPollController with the bot's poll settings
+
+        """
+        return LongPollController(WarBot.IDLE_TIMEOUT, WarBot.TIMEOUT,
+                                  WarBot.POLL_LIMIT, WarBot.POLL_BACKOFF,
+                                  WarBot.MAX_POLL_BACKOFF)
+
+    def confirm_updates(self, offset):
+        """ Confirms the updates below offset, so that the last handled
+        batch is not delivered again after a restart
+
+        """
+        if not offset:
+            return
+
+        try:
+            self.http.post(WarBot.API_URL + 'getUpdates',
+                           params=get_confirm_params(offset))
+        except requests.exceptions.RequestException as e:
+            print('Error confirming updates: ', e)
+
+    def receive(self, update, timeout=None):
+        """ Queues the text message of a telegram update for handling
+        Returns False if the queue stayed full for timeout seconds
+
+        Parameters
+        ----------
+        update : dict
+            Telegram update
+        timeout : float
+            Maximum number of seconds to wait, None waits forever
+        """
+        UPDATES.inc()
+
+        if 'message' not in update or 'text' not in update['message']:
+            return True
+
+        message = update['message']
+
+        if self.async_engine is not None:
+            return self.async_engine.submit_threadsafe(message, timeout)
+        return self.dispatcher.submit(message['chat']['id'], message,
+                                      timeout)
+
+    def set_webhook(self, url, listen, secret=None):
+        """ Starts listening for updates on listen and asks telegram to
+        send them to url
+        Returns the WebhookServer, which still has to be started
+        Throws RuntimeError if telegram refuses the webhook
+
+        Parameters
+        ----------
+        url : str
+            Public HTTPS URL of the webhook
+        listen : (str, int) tuple
+            Host and port to listen on
+        secret : str
+            Secret token checked on every update, random if None
+        """
+
+        secret = secret or secrets.token_urlsafe(32)
+        server = WebhookServer(listen, urlsplit(url).path, secret,
+                               self.receive)
+
+        p = {'url': url, 'secret_token': secret,
+             'allowed_updates': json.dumps(['message'])}
+
+        try:
+            r = self.http.post(WarBot.API_URL + 'setWebhook', params=p).json()
+        except (ValueError, requests.exceptions.RequestException) as e:
+            server.server_close()
+            raise RuntimeError('Error setting webhook: {}'.format(e))
+
+        if not r.get('ok'):
+            server.server_close()
+            raise RuntimeError('Webhook refused: {}'.format(
+                r.get('description')))
+
+        return server
+
+    def delete_webhook(self, server):
+        """ Stops the webhook server and removes the webhook, so that
+        the bot can be restarted in polling mode
+
+        """
+        try:
+            self.http.post(WarBot.API_URL + 'deleteWebhook')
+        except requests.exceptions.RequestException as e:
+            print('Error deleting webhook: ', e)
+
+        server.stop()
 
     def bot(self, message):
         """ Answers received messages
 
         Parameters
         ----------
-        message : str
-            Textual content of received message
+        message : dict
+            Received message, as found in a telegram update
+        """
+
+        with TRACER.span('bot', command=message['text'][:32]):
+            reply = self.respond(message)
+
+        if reply:
+            text, options = reply
+            chat_id = message['chat']['id']
+
+            # Long replies are split in parts, sent in order
+            self.outbox.put([(chat_id, chunk_text(text))],
+                            REPLIES, **options)
+
+    def respond(self, message):
+        """ Returns the answer to a received message as a tuple
+        (text, options), options being keyword arguments for send, or
+        None if there is no answer
+
+        Parameters
+        ----------
+        message : dict
+            Received message, as found in a telegram update
         """
 
         text = message['text']
         chat_id = message['chat']['id']
 
         if '/help' in text:
-            self.send(chat_id, WarBot.USAGE)
+            return WarBot.USAGE, {}
 
         elif '/alerts' in text:
-            if 'all' in text:
-                self.send(chat_id, self.get_alert_string(True))
-            else:
-                self.send(chat_id, self.get_alert_string(False))
+            return self.get_alert_string('all' in text, chat_id), {}
 
         elif '/invasions' in text:
-            if 'all' in text:
-                self.send(chat_id, self.get_invasion_string(True))
-            else:
-                self.send(chat_id, self.get_invasion_string(False))
-        
+            return self.get_invasion_string('all' in text, chat_id), {}
+
         elif '/darvo' in text:
-            self.send(chat_id, self.get_deals_string())
+            return self.get_deals_string(chat_id), {}
 
         elif '/news' in text:
-            self.send(chat_id, self.get_news_string(), markdown=True,
-                      link_preview=False)
+            return self.get_news_string(chat_id), {'markdown': True,
+                                                   'link_preview': False}
+
+        elif '/platform' in text:
+            return self.set_platform(chat_id, text), {}
+
+        elif '/filter' in text:
+            return self.edit_filter(chat_id, text), {}
+
+        elif '/remind' in text:
+            return self.set_reminders(chat_id, text), {}
 
         elif '/notify' in text:
             if 'on' in text:
-                self.set_notifications(chat_id, True)
+                # Remember the user's language for localized messages
+                language = message.get('from', {}).get('language_code')
+                if language and language != \
+                        self.subscribers.get_settings(chat_id).language:
+                    self.update_settings(chat_id, language=language)
+
+                return self.set_notifications(chat_id, True), {}
             elif 'off' in text:
-                self.set_notifications(chat_id, False)
+                return self.set_notifications(chat_id, False), {}
+
+        elif '/mute' in text:
+            return self.set_mute(chat_id, text), {}
+
+        return None
+
+    def get_stats_string(self):
+        """ Returns the delivery statistics of the outbox as a string
+
+        """
+        stats = self.outbox.get_stats()
+
+        def seconds(value):
+            return '-' if value is None else '{:.2f}s'.format(value)
+
+        return ('Queued: {queued}, sent: {sent}, retried: {retried}, '
+                'failed: {failed}, blocked: {blocked}, pending: {pending}\n'
+                'Latency: median {p50}, 95th percentile {p95}, '
+                'max {max}\n').format(p50=seconds(stats['latency_p50']),
+                                      p95=seconds(stats['latency_p95']),
+                                      max=seconds(stats['latency_max']),
+                                      **stats)
 
     def send(self, recipient, message, markdown=False, link_preview=True):
         """Send a message to a specified user or group
+        Returns the requests.Response from Telegram, or None if the
+        request failed
 
         Parameters
         ----------
@@ -231,152 +819,116 @@ class WarBot:
             Whether or not the links in the message should be previewed
 
         """
-        p = {'chat_id': recipient, 'text': message}
-
-        if markdown:
-            p['parse_mode'] = 'Markdown'
-        if not link_preview:
-            p['disable_web_page_preview'] = True
+        p = self.get_send_params(recipient, message, markdown, link_preview)
 
-        requests.post(WarBot.API_URL + 'sendMessage', params=p)
+        try:
+            with TRACER.span('send', chat=recipient):
+                return self.http.post(WarBot.API_URL + 'sendMessage',
+                                      params=p)
+        except requests.exceptions.RequestException as e:
+            print('Error sending message to {}: {}'.format(recipient, e))
+            return None
 
-    def get_alerts(self):
-        """Returns a list of Alert objects containing the last 15 alerts
-        Throws RuntimeError in case of a bad response
+    def get_send_params(self, recipient, message, markdown=False,
+                        link_preview=True):
+        """ Returns the parameters of a sendMessage request, see send
 
         """
-        
-        alert_data = None
-        r = None
+        return get_send_params(recipient, message, markdown, link_preview)
 
-        try:
-            r = requests.get(WarBot.ALERT_URL)
-        except requests.exceptions.RequestException:
-            raise RuntimeError('Error while connecting to ' + WarBot.ALERT_URL)
+    def get_feed_sources(self):
+        """ Returns the list of sources providing the 'alerts',
+        'invasions', 'deals' and 'news' feeds of every platform
 
-        # Raise an exception in case of a bad response
-        if not r.status_code == requests.codes.ok:
-            raise RuntimeError('Bad response from ' + WarBot.ALERT_URL)
+        """
+        sources = []
 
-        # Response.json() might raise ValueError
-        try:
-            alert_data = r.json()
-        except ValueError as e:
-            raise RuntimeError('Bad JSON from ' + WarBot.ALERT_URL) from e
+        for platform, path in WarBot.PLATFORMS.items():
+            def url(template):
+                return template.format(base=WarBot.FEED_URL, platform=path)
 
-        # Raise an exception in case of an empty response
-        if not alert_data:
-            raise RuntimeError('Empty response from ' + WarBot.ALERT_URL)
+            if WarBot.WORLDSTATE_URL:
+                sources.append(WorldstateSource(
+                    url(WarBot.WORLDSTATE_URL),
+                    {'alerts': Alert, 'invasions': Invasion, 'deals': Deal,
+                     'news': News}, platform=platform))
+                continue
 
-        return [Alert(d) for d in alert_data]
+            sources += [
+                FeedSource('alerts', url(WarBot.ALERT_URL), Alert,
+                           platform=platform),
+                FeedSource('invasions', url(WarBot.INVASION_URL), Invasion,
+                           platform=platform),
+                FeedSource('deals', url(WarBot.DEAL_URL), Deal,
+                           ttl=WarBot.DEAL_TTL, platform=platform),
+                FeedSource('news', url(WarBot.NEWS_URL), News, decode_lines,
+                           ttl=WarBot.NEWS_TTL, platform=platform)]
 
-    def get_invasions(self):
-        """ Returns a list of Invasion objects containing all active
-        invasions
-        Throws RuntimeError in case of a bad response
+        return sources
 
-        """
-        invasion_data = None
-        r = None
+    def get_platform(self, chat_id):
+        """ Returns the game platform of a chat, DEFAULT_PLATFORM if
+        chat_id is None or the chat has not chosen one
 
-        try:
-            r = requests.get(WarBot.INVASION_URL)
-        except requests.exceptions.RequestException:
-            raise RuntimeError('Error while connecting to ' + WarBot.INVASION_URL)
+        """
+        if chat_id is None:
+            return WarBot.DEFAULT_PLATFORM
+        return self.subscribers.get_platform(chat_id,
+                                             WarBot.DEFAULT_PLATFORM)
 
-        # Raise an exception in case of a bad response
-        if not r.status_code == requests.codes.ok:
-            raise RuntimeError('Bad response from ' + WarBot.INVASION_URL)
+    def get_alerts(self, platform=DEFAULT_PLATFORM):
+        """Returns a list of Alert objects containing the last 15 alerts
+        of a platform
+        Throws RuntimeError in case of a bad response
 
-        # Response.json() might raise ValueError
-        try:
-            invasion_data = r.json()
-        except ValueError as e:
-            raise RuntimeError('Bad JSON from ' + WarBot.INVASION_URL) from e
+        """
+        return self.feeds.get((platform, 'alerts')).data
 
-        # Raise an exception in case of an empty response
-        if not invasion_data:
-            raise RuntimeError('Empty response from ' + WarBot.INVASION_URL)
+    def get_invasions(self, platform=DEFAULT_PLATFORM):
+        """ Returns a list of Invasion objects containing all active
+        invasions of a platform
+        Throws RuntimeError in case of a bad response
 
-        return [Invasion(d) for d in invasion_data]
+        """
+        return self.feeds.get((platform, 'invasions')).data
 
-    def get_deals(self):
+    def get_deals(self, platform=DEFAULT_PLATFORM):
         """ Returns a list of Deal objects containing all active
-        daily deals
+        daily deals of a platform
         Throws RuntimeError in case of a bad response
 
         """
+        return self.feeds.get((platform, 'deals')).data
 
-        deal_data = None
-        r = None
-        try:
-            r = requests.get(WarBot.DEAL_URL)
-        except requests.exceptions.RequestException:
-            raise RuntimeError('Error while connecting to ' + WarBot.DEAL_URL)
-
-        # Raise an exception in case of a bad response
-        if not r.status_code == requests.codes.ok:
-            raise RuntimeError('Bad response from ' + WarBot.DEAL_URL)
-
-        # Response.json() might raise ValueError
-        try:
-            deal_data = r.json()
-        except ValueError as e:
-            raise RuntimeError('Bad JSON from ' + WarBot.DEAL_URL) from e
-
-        # Raise an exception in case of an empty response
-        if not deal_data:
-            raise RuntimeError('Empty response from ' + WarBot.DEAL_URL)
-
-        return [Deal(d) for d in deal_data]
-
-    def get_news(self):
-        """Returns a list of News objects containing all the news
+    def get_news(self, platform=DEFAULT_PLATFORM):
+        """Returns a list of News objects containing all the news of a
+        platform
         Throws RuntimeError in case of a bad response
 
         """
+        return self.feeds.get((platform, 'news')).data
 
-        news_data = None
-        r = None
-        try:
-            r = requests.get(WarBot.NEWS_URL)
-        except requests.exceptions.RequestException:
-            raise RuntimeError('Error while connecting to ' + WarBot.NEWS_URL)
-
-        # Raise an exception in case of a bad response
-        if not r.status_code == requests.codes.ok:
-            raise RuntimeError('Bad response from ' + WarBot.NEWS_URL)
-
-        news_data = r.text.split('\n')
-        news_data.pop()
-
-        # Raise an exception in case of an empty response
-        if not news_data:
-            raise RuntimeError('Empty response from ' + WarBot.NEWS_URL)
-
-        return [News(n) for n in news_data]
-
-    def get_alert_string(self, show_all):
-        """ Returns a string with all current alerts
+    def get_alert_string(self, show_all, chat_id=None):
+        """ Returns a string with all current alerts of the chat's
+        platform
 
         Parameters
         ----------
         show_all : bool
             Whether or not to show all alerts or only filtered ones
+        chat_id : int
+            ID of the chat whose platform is shown, and whose watch list
+            is used for filtering, if any
 
         """
 
-        alert_string = ''
-        alerts = self.get_alerts()
-
-        for a in alerts:
+        key = (self.get_platform(chat_id), 'alerts')
+        snapshot = self.feeds.get(key)
+        rendered = self.get_rendered(key, snapshot, show_all, chat_id,
+                                     expires=True)
 
-            # We only need current alerts
-            if a.expiry < datetime.now():
-                break
-
-            if show_all or self.filter_rewards(a.get_rewards()):
-                alert_string += str(a) + '\n\n'
+        # Expired alerts are left out when splicing
+        alert_string = splice(rendered)
 
         if not alert_string:
             if not show_all:
@@ -386,21 +938,24 @@ class WarBot:
 
         return alert_string
 
-    def get_invasion_string(self, show_all):
-        """ Returns a string with all current invasions
+    def get_invasion_string(self, show_all, chat_id=None):
+        """ Returns a string with all current invasions of the chat's
+        platform
 
         Parameters
         ----------
         show_all : bool
             Whether or not to show all invasions or only filtered ones
+        chat_id : int
+            ID of the chat whose platform is shown, and whose watch list
+            is used for filtering, if any
         """
 
-        invasion_string = ''
-        invasions = self.get_invasions()
+        key = (self.get_platform(chat_id), 'invasions')
+        snapshot = self.feeds.get(key)
+        rendered = self.get_rendered(key, snapshot, show_all, chat_id)
 
-        for i in invasions:
-            if show_all or self.filter_rewards(i.get_rewards()):
-                invasion_string += str(i) + '\n\n'
+        invasion_string = splice(rendered)
 
         if not invasion_string:
             if not show_all:
@@ -410,35 +965,68 @@ class WarBot:
 
         return invasion_string
 
-    def get_deals_string(self):
-        """ Returns a string with all current daily deals
+    def get_deals_string(self, chat_id=None):
+        """ Returns a string with all current daily deals of the chat's
+        platform
 
         """
 
-        deal_string = ""
-        deals = self.get_deals()
-
-        for d in deals:
-            deal_string += str(d) + '\n\n'
+        key = (self.get_platform(chat_id), 'deals')
+        deal_string = splice(self.get_rendered(key, self.feeds.get(key)))
 
         if not deal_string:
             deal_string = 'No deals'
 
         return deal_string
 
-    def get_news_string(self):
-        """Returns a string with the news
+    def get_news_string(self, chat_id=None):
+        """Returns a string with the news of the chat's platform
 
         """
 
-        news_string = ""
+        key = (self.get_platform(chat_id), 'news')
+
+        return splice(self.get_rendered(key, self.feeds.get(key)))
+
+    def get_rendered(self, key, snapshot, show_all=True, chat_id=None,
+                     expires=False):
+        """ Returns the list of RenderedItem objects for the items of a
+        feed snapshot that should be shown, rendering them only once per
+        snapshot version
 
-        news = self.get_news()
+        Parameters
+        ----------
+        key : (str, str) tuple
+            Platform and name of the feed
+        snapshot : Snapshot
+            Current snapshot of the feed
+        show_all : bool
+            Whether or not to show all items or only filtered ones
+        chat_id : int
+            ID of the chat whose watch list is used for filtering, if any
+        expires : bool
+            Whether items past their expiry are left out when splicing
 
-        for n in news:
-            news_string += str(n) + '\n\n'
+        """
 
-        return news_string
+        # Chats with a watch list filter all items of the feed, which
+        # is cheap compared to rendering
+        if not show_all and chat_id is not None and \
+                self.chat_filters.has_filter(chat_id):
+            rendered = self.get_rendered(key, snapshot, expires=expires)
+            return [r for r in rendered
+                    if self.chat_filters.matches(chat_id, r.rewards)]
+
+        # The global reward filter is replaced on reload, so it is part
+        # of the key of filtered renders
+        reward_filter = None if show_all else self.reward_filter
+        render_key = (key, snapshot.version, reward_filter)
+
+        with TRACER.span('render', feed='/'.join(key), all=show_all):
+            return self.renders.get(render_key, lambda: prerender(
+                (i for i in snapshot.data
+                 if show_all or self.filter_rewards(i.get_rewards())),
+                expires))
 
     def filter_rewards(self, rewards):
         """ Returns True if no rewards are contained in the
@@ -452,12 +1040,72 @@ class WarBot:
         """
         if not rewards:
             return False
-        with self.reward_lock:
-            return any(i not in self.reward_filter for i in rewards)
+        reward_filter = self.reward_filter
+        return any(i not in reward_filter for i in rewards)
+
+    def chat_wants(self, chat_id, rewards):
+        """ Returns True if a mission with the specified rewards should
+        be shown to a chat. Chats with a watch list only want missions
+        with a watched reward, other chats use the global reward filter
+
+        Parameters
+        ----------
+        chat_id : int
+            ID of the chat, None for the global reward filter
+        rewards : List of str objects
+            List of rewards for an alert or invasion
+
+        """
+        if chat_id is not None and self.chat_filters.has_filter(chat_id):
+            return self.chat_filters.matches(chat_id, rewards)
+        return self.filter_rewards(rewards)
+
+    def edit_filter(self, chat_id, text):
+        """ Handles the /filter command, which adds, removes or lists
+        the rewards watched by a chat
+        Returns the answer to the command
+
+        Parameters
+        ----------
+        chat_id : int
+            ID of specified chat
+        text : str
+            Text of the received command
+
+        """
+        args = text.split(None, 2)[1:]
+        action = args[0].lower() if args else 'list'
+        reward = args[1].strip() if len(args) > 1 else ''
+
+        if action == 'add' and reward:
+            if self.chat_filters.add(chat_id, reward):
+                self.store.add_filter(chat_id, normalize(reward),
+                                      ' '.join(reward.split()))
+                return 'Now watching ' + reward
+            else:
+                return reward + ' is already watched'
+
+        elif action == 'remove' and reward:
+            if self.chat_filters.remove(chat_id, reward):
+                self.store.remove_filter(chat_id, normalize(reward))
+                return 'No longer watching ' + reward
+            else:
+                return reward + ' is not watched'
+
+        elif action == 'list':
+            rewards = self.chat_filters.get(chat_id)
+            if rewards:
+                return 'Watched rewards:\n' + '\n'.join(rewards)
+            else:
+                return 'No watched rewards, using the global reward filter'
+
+        else:
+            return 'Usage: /filter add|remove <reward> or /filter list'
 
     def set_notifications(self, chat_id, enable):
         """ Enables or disables reward notifications for a specified
         chat
+        Returns the confirmation for the user
 
         Parameters
         ----------
@@ -470,41 +1118,292 @@ class WarBot:
         """
 
         if enable:
-            if chat_id not in self.notification_chats:
-                # Acquire lock on notification_chats and add new chat to it
-                with self.notification_lock:
-                    self.notification_chats.append(chat_id)
+            if self.subscribers.add(chat_id):
+                self.store.add_chat(chat_id)
 
                 # Start notifier if needed
                 if not self.notifications.is_set():
                     self.notifications.set()
 
                 # Send confirmation to user
-                self.send(chat_id, 'Notifications enabled')
+                return 'Notifications enabled'
             else:
-                self.send(chat_id, 'Notifications are already enabled')
+                return 'Notifications are already enabled'
         else:
-            if chat_id in self.notification_chats:
-                # Remove chat_id from notification_chats
-                with self.notification_lock:
-                    self.notification_chats.remove(chat_id)
+            if self.subscribers.remove(chat_id):
+                self.store.remove_chat(chat_id)
 
                 # Stop notifier if there are no chats with
-                # active notifications
-                if not self.notification_chats:
+                # active notifications or reminders
+                if not self.subscribers and not self.reminders.leads:
                     self.notifications.clear()
 
                 # Send confirmation to user
-                self.send(chat_id, 'Notifications disabled')
+                return 'Notifications disabled'
             else:
-                self.send(chat_id, 'Notifications are already disabled')
+                return 'Notifications are already disabled'
+
+    def update_settings(self, chat_id, **fields):
+        """ Changes and saves some settings of a chat, see
+        SubscriberRegistry.update_settings
+        Returns the new ChatSettings
+
+        """
+        settings = self.subscribers.update_settings(chat_id, **fields)
+
+        if settings.is_default():
+            self.store.remove_chat_settings(chat_id)
+        else:
+            self.store.set_chat_settings(settings.to_row(chat_id))
+
+        return settings
+
+    def set_mute(self, chat_id, text):
+        """ Handles the /mute command, which sets the daily window in
+        which a chat gets no notifications, or removes it
+        Returns the answer to the command
+
+        Parameters
+        ----------
+        chat_id : int
+            ID of specified chat
+        text : str
+            Text of the received command
+
+        """
+        usage = 'Usage: /mute HH:MM-HH:MM, e.g. /mute 23:00-07:00, ' \
+                'or /mute off'
+        args = ''.join(text.split()[1:])
+
+        def minutes_to_string(m):
+            return '{:02d}:{:02d}'.format(m // 60, m % 60)
+
+        if not args:
+            settings = self.subscribers.get_settings(chat_id)
+            if settings.mute_start is None:
+                return 'Notifications are not muted\n' + usage
+            return 'Notifications are muted from {} to {} (server ' \
+                   'time)'.format(minutes_to_string(settings.mute_start),
+                                  minutes_to_string(settings.mute_end))
+
+        if args.lower() == 'off':
+            self.update_settings(chat_id, mute_start=None, mute_end=None)
+            return 'Notifications unmuted'
+
+        window = []
+        for t in args.split('-'):
+            try:
+                hours, minutes = (int(x) for x in t.split(':'))
+            except ValueError:
+                return usage
+            if not (0 <= hours < 24 and 0 <= minutes < 60):
+                return usage
+            window.append(hours * 60 + minutes)
+
+        if len(window) != 2 or window[0] == window[1]:
+            return usage
+
+        self.update_settings(chat_id, mute_start=window[0],
+                             mute_end=window[1])
+        return 'Notifications are muted from {} to {} (server ' \
+               'time)'.format(minutes_to_string(window[0]),
+                              minutes_to_string(window[1]))
+
+    def set_platform(self, chat_id, text):
+        """ Handles the /platform command, which shows or changes the
+        game platform whose alerts, invasions, deals and news a chat gets
+        Returns the answer to the command
+
+        Parameters
+        ----------
+        chat_id : int
+            ID of specified chat
+        text : str
+            Text of the received command
+
+        """
+        usage = 'Usage: /platform ' + '|'.join(WarBot.PLATFORMS)
+        args = text.split()[1:]
+
+        if not args:
+            return 'This chat is on {}\n{}'.format(
+                self.get_platform(chat_id), usage)
+
+        platform = args[0].lower()
+        if platform not in WarBot.PLATFORMS:
+            return usage
+
+        if platform == self.get_platform(chat_id):
+            return 'This chat is already on ' + platform
+
+        self.update_settings(chat_id, platform=None if platform ==
+                             WarBot.DEFAULT_PLATFORM else platform)
+
+        # Pending reminders are about the items of the old platform
+        lead = self.reminders.get_lead(chat_id)
+        if lead is not None:
+            self.reminders.remove_chat(chat_id)
+            self.store.remove_reminder_chat(chat_id)
+            self.enable_reminders(chat_id, lead)
+
+        return 'This chat is now on ' + platform
+
+    def unsubscribe(self, chat_id):
+        """ Disables notifications and reminders of a chat that blocked
+        the bot or removed it from a group
+
+        Parameters
+        ----------
+        chat_id : int
+            ID of specified chat
+
+        """
+        print('Chat {} blocked the bot, unsubscribing'.format(chat_id))
+
+        if chat_id in self.subscribers:
+            self.set_notifications(chat_id, False)
+
+        if self.reminders.remove_chat(chat_id):
+            self.store.remove_reminder_chat(chat_id)
+
+            if not self.subscribers and not self.reminders.leads:
+                self.notifications.clear()
+
+    def set_reminders(self, chat_id, text):
+        """ Handles the /remind command, which sets how long before
+        expiry a chat is reminded of alerts and deals, or turns the
+        reminders off
+        Returns the answer to the command
+
+        Parameters
+        ----------
+        chat_id : int
+            ID of specified chat
+        text : str
+            Text of the received command
+
+        """
+        usage = 'Usage: /remind <time>, e.g. /remind 10m, or /remind off'
+        args = ' '.join(text.split()[1:])
+
+        if not args:
+            lead = self.reminders.get_lead(chat_id)
+            if lead is None:
+                return 'Reminders are off\n' + usage
+            return 'Reminding this chat {} before alerts and deals ' \
+                   'expire'.format(format_duration(lead))
+
+        if args.lower() == 'off':
+            if not self.reminders.remove_chat(chat_id):
+                return 'Reminders are already off'
+            self.store.remove_reminder_chat(chat_id)
+
+            if not self.subscribers and not self.reminders.leads:
+                self.notifications.clear()
+            return 'Reminders disabled'
+
+        lead = parse_duration(args)
+        if not lead:
+            return usage
+
+        self.enable_reminders(chat_id, lead)
+
+        return 'Reminding this chat {} before alerts and deals ' \
+               'expire'.format(format_duration(lead))
+
+    def enable_reminders(self, chat_id, lead):
+        """ Reminds a chat of alerts and deals lead seconds before they
+        expire, starting with the current ones
+
+        """
+        self.reminders.set_lead(chat_id, lead)
+        self.store.set_reminder_lead(chat_id, lead)
+
+        # Start notifier if needed, it finds the alerts and deals
+        if not self.notifications.is_set():
+            self.notifications.set()
+
+        # Alerts and deals already known are not new to the notifier
+        platform = self.get_platform(chat_id)
+        try:
+            items = self.get_alerts(platform) + self.get_deals(platform)
+        except RuntimeError:
+            items = []
+        self.schedule_reminders(items, platform, [chat_id])
+
+    def schedule_reminders(self, items, platform, chats=None):
+        """ Schedules reminders about expiring items for the chats with
+        reminders that are interested in them
+
+        Parameters
+        ----------
+        items : List of Alert and Deal objects
+            Items to be reminded of
+        platform : str
+            Platform of the items, only its chats are reminded
+        chats : List of int
+            IDs of the chats to schedule reminders for, defaults to all
+            chats with reminders
+        """
+        added = []
+
+        leads = [(c, lead) for c, lead in self.reminders.get_leads(chats)
+                 if self.get_platform(c) == platform]
+
+        for item in items:
+            rewards = item.get_rewards() if \
+                hasattr(item, 'get_rewards') else None
+
+            for c, lead in leads:
+                if rewards is not None and not self.chat_wants(c, rewards):
+                    continue
+
+                r = Reminder.for_item(c, item)
+                if self.reminders.add(r):
+                    added.append(r)
+
+        if added:
+            self.store.add_reminders(added)
+
+    def ticker(self):
+        """ Runs in a separate thread and every REMINDER_TICK seconds
+        collects the reminders that are due and sends the notifications
+        collected for COALESCE_WINDOW seconds
+
+        """
+        while not self.close:
+            time.sleep(WarBot.REMINDER_TICK)
+            self.tick()
+
+    def tick(self):
+        """ Collects the reminders that are due and sends the collected
+        notifications and reminders whose window has passed
+
+        """
+        deliveries = self.get_due_reminders()
+        if deliveries:
+            self.messages.add(deliveries)
+
+        self.messages.flush()
+
+    def get_due_reminders(self):
+        """ Returns a list of (chat ID, list of texts) pairs of the
+        reminders that are due, which are forgotten
+
+        """
+        now = time.time()
+
+        due = self.reminders.get_due(now)
+        if due:
+            self.store.remove_reminders(due)
+
+        return [(r.chat_id, [r.get_text(now)]) for r in due]
 
 
     def notifier(self):
         """ Runs in a separate thread and checks alerts, invasions and news
-        every NOTIFICATION_INTERVAL seconds. Missions with rewards that
-        match the filter and all news are notified to all chats in
-        notification_chats
+        whenever the schedule says so. Missions with rewards that match
+        the filter and all news are notified to all subscribed chats
 
         """
 
@@ -513,81 +1412,291 @@ class WarBot:
             # i.e. notifications are active
             self.notifications.wait()
 
-            try:
-                alerts = self.get_alerts()
-                invasions = self.get_invasions()
-                news = self.get_news()
-
-                notification_text = ''
-                news_text = ''
-
-                for a in alerts:
-                    # Remove any expired alerts from list of
-                    # notified alerts
-                    if a.expiry < datetime.now():
-                        if a.id in self.notified_alerts:
-                            self.notified_alerts.remove(a.id)
-
-                    # If alert has not been notified, send a message
-                    elif a.id not in self.notified_alerts and \
-                            self.filter_rewards(a.get_rewards()):
-                                notification_text += str(a) + '\n\n'
-                                # Add to list of notified alerts
-                                self.notified_alerts.append(a.id)
-
-                # Remove any expired invasions
-                for n in self.notified_invasions:
-                    if not any(n == i.id for i in invasions):
-                        self.notified_invasions.remove(n)
-
-                for i in invasions:
-                    # If invasion has not been notified, send a message
-                    if i.id not in self.notified_invasions and \
-                            self.filter_rewards(i.get_rewards()):
-                                notification_text += str(i) + '\n\n'
-                                # Add to list of notified invasions
-                                self.notified_invasions.append(i.id)
-
-                # Remove any old news
-                for n in self.notified_news:
-                    if not any(n == i.id for i in news):
-                        self.notified_news.remove(n)
-
-                for n in news:
-                    # If news not notified, send a message
-                    if n.id not in self.notified_news:
-                        news_text += str(n) + '\n\n'
-                        # Add to list of notified news
-                        self.notified_news.append(n.id)
-
-                if notification_text:
-                    # Send message to all chats
-                    with self.notification_lock:
-                        for c in self.notification_chats:
-                            self.send(c, notification_text)
-
-                if news_text:
-                    # Send message to all chats, with markdown enabled
-                    with self.notification_lock:
-                        for c in self.notification_chats:
-                            self.send(c, news_text, markdown=True,
-                                      link_preview=False)           
-
-            # If we get a bad response, just wait and try again
-            except RuntimeError:
-                pass
-            time.sleep(WarBot.NOTIFICATION_INTERVAL)
+            time.sleep(self.schedule.get_wait())
+
+            with NOTIFIER_CYCLE_SECONDS.time(), TRACER.span('notify'):
+                try:
+                    self.check_due_feeds()
+                except Exception as e:
+                    self.check_failed(e)
+
+    def check_failed(self, e):
+        """ Reports an unexpected error of a notifier check, and retries
+        the feeds still due later, so that a bug in one check does not
+        stop notifications for good
+
+        """
+        print('Unhandled error checking feeds: {!r}'.format(e))
+        for key in self.schedule.get_due():
+            self.schedule.fail(key)
+
+    def check_due_feeds(self):
+        """ Revalidates the feeds whose check is due, whatever their TTL,
+        and queues notifications of their new items. Feeds with a bad
+        response are tried again later
+
+        """
+        due = self.get_due_feeds()
+
+        snapshots, errors = self.feeds.try_all(due, max_age=0)
+        for key, e in errors.items():
+            print('Error checking {}/{}: {}'.format(key[0], key[1], e))
+            self.schedule.fail(key)
+
+        if not snapshots:
+            return
+
+        self.plan_checks(snapshots)
+
+        for deliveries, options in self.check_notifications(snapshots):
+            self.messages.add(deliveries, **options)
+
+    def get_due_feeds(self):
+        """ Returns the keys of the feeds whose check is due, leaving
+        out and postponing those of platforms without any chat with
+        notifications or reminders
+
+        """
+        due = self.schedule.get_due()
+
+        chats = itertools.chain(self.subscribers.snapshot(),
+                                (c for c, lead in self.reminders.get_leads()))
+        platforms = set(self.subscribers.group_by_platform(
+            chats, WarBot.DEFAULT_PLATFORM))
+
+        for key in due:
+            if key[0] not in platforms:
+                self.schedule.postpone(key)
+
+        return [k for k in due if k[0] in platforms]
+
+    def plan_checks(self, snapshots):
+        """ Schedules the next checks of the feeds in snapshots, and a
+        check of the alerts and deals feeds right after their next item
+        expires
+
+        Parameters
+        ----------
+        snapshots : dict
+            Just checked Snapshot of some scheduled feeds, by key
+        """
+        now = datetime.now()
+
+        for key, snapshot in snapshots.items():
+            self.schedule.update(key, snapshot.version)
+
+            if key[1] in WarBot.REMINDED_FEEDS:
+                expiries = [i.expiry for i in snapshot.data if i.expiry > now]
+                if expiries:
+                    self.schedule.plan(key, min(expiries).timestamp() +
+                                       WarBot.EXPIRY_CHECK_DELAY)
+
+    def check_notifications(self, snapshots):
+        """ Finds alerts, invasions and news that have not been notified
+        yet and marks them as notified
+        Returns a list of (deliveries, options) tuples, deliveries being
+        a list of (chat ID, list of item texts) pairs sent with options as
+        keyword arguments for send
+
+        Reminders of new alerts and deals are scheduled as well
+
+        Parameters
+        ----------
+        snapshots : dict
+            Current Snapshot of some scheduled feeds, by key. Only these
+            feeds are checked, and the items of every platform are only
+            sent to the chats on that platform
+
+        """
+        now = datetime.now()
+
+        # The snapshot is not affected by /notify, chats with muted
+        # notifications are left out
+        chats = self.subscribers.snapshot()
+        muted = self.subscribers.get_muted(now.hour * 60 + now.minute)
+        if muted:
+            chats = [c for c in chats if c not in muted]
+
+        platform_chats = self.subscribers.group_by_platform(
+            chats, WarBot.DEFAULT_PLATFORM)
+
+        # Checked feeds of every platform, by name
+        platform_snapshots = {}
+        for (platform, name), snapshot in snapshots.items():
+            platform_snapshots.setdefault(platform, {})[name] = snapshot
+
+        notifications = []
+        for platform, feeds in platform_snapshots.items():
+            notifications += self.check_platform(
+                platform, feeds, platform_chats.get(platform, []), now)
+
+        # Purge expired IDs from the state file once in a while
+        self.store.compact()
+
+        return notifications
+
+    def check_platform(self, platform, snapshots, chats, now):
+        """ Finds the new items of the checked feeds of a platform, see
+        check_notifications
+
+        Parameters
+        ----------
+        platform : str
+            Platform of the feeds
+        snapshots : dict
+            Current Snapshot of some feeds of the platform, by name
+        chats : List of int
+            IDs of the chats on the platform to be notified
+        now : datetime
+            Current time
+        """
+        notified = self.notified[platform]
+
+        news = []
+        new_missions = []
+
+        if 'alerts' in snapshots:
+            # Expired alerts are not notified, current ones are
+            # remembered until they expire
+            alerts = [a for a in snapshots['alerts'].data if a.expiry >= now]
+
+            new_alerts = notified['alerts'].diff(
+                alerts, lambda a: a.expiry.timestamp())
+            new_missions += new_alerts
+            self.schedule_reminders(new_alerts, platform)
+
+        if 'deals' in snapshots:
+            deals = [d for d in snapshots['deals'].data if d.expiry >= now]
+            self.schedule_reminders(notified['deals'].diff(
+                deals, lambda d: d.expiry.timestamp()), platform)
+
+        if 'invasions' in snapshots:
+            new_missions += notified['invasions'].diff(
+                snapshots['invasions'].data)
+
+        if 'news' in snapshots:
+            news = [str(n) for n in
+                    notified['news'].diff(snapshots['news'].data)]
+
+        notifications = []
+
+        # Send every chat the missions it is interested in
+        deliveries = self.get_mission_deliveries(new_missions, chats)
+        if deliveries:
+            notifications.append((deliveries, {}))
+
+        if news and chats:
+            # Send news to all chats, with markdown enabled
+            notifications.append(([(c, news) for c in chats],
+                                  {'markdown': True, 'link_preview': False}))
+
+        return notifications
+
+    def get_mission_deliveries(self, missions, chats):
+        """ Returns a list of (chat ID, list of texts) pairs notifying
+        every chat of the missions it is interested in. Chats with a watch
+        list are found through the reward index, all other chats share the
+        missions that pass the global reward filter
+
+        Parameters
+        ----------
+        missions : List of Alert and Invasion objects
+            New missions to be notified
+        chats : List of int
+            IDs of chats with active notifications
+
+        """
+
+        # Missions for chats using the global reward filter
+        notification_items = []
+
+        # Missions for chats with a watch list, by chat ID
+        chat_items = {}
+
+        for m in missions:
+            rewards = m.get_rewards()
+            mission_text = str(m)
+
+            if self.filter_rewards(rewards):
+                notification_items.append(mission_text)
+
+            for c in self.chat_filters.match(rewards):
+                chat_items.setdefault(c, []).append(mission_text)
+
+        deliveries = []
+        for c in chats:
+            if self.chat_filters.has_filter(c):
+                items = chat_items.get(c)
+            else:
+                items = notification_items
+            if items:
+                deliveries.append((c, items))
+
+        return deliveries
+
+    def load_tracker(self, kind, platform=DEFAULT_PLATFORM):
+        """ Returns a SeenTracker with the saved IDs of one kind and
+        platform, which writes every change to the state store
+
+        Parameters
+        ----------
+        kind : str
+            Kind of notified items, e.g. 'alerts'
+        platform : str
+            Platform of the items. IDs of the default platform are
+            stored under the bare kind, as by older versions
+
+        """
+        if platform != WarBot.DEFAULT_PLATFORM:
+            kind = platform + '/' + kind
+
+        tracker = SeenTracker(WarBot.NOTIFIED_RETENTION,
+                              self.store.get_seen(kind))
+        tracker.listener = lambda changed, evicted: \
+            self.store.update_seen(kind, changed, evicted)
+        return tracker
+
+    def import_state(self, path):
+        """ Copies the state saved by older versions in a shelve file to
+        the state store
+        Returns False if the file is missing or invalid
+
+        Parameters
+        ----------
+        path : str
+            Path of the shelve file
+
+        """
+        try:
+            with shelve.open(path, flag='r') as f:
+                chats = f['chats']
+                seen = {k: SeenTracker.load(f[k], WarBot.NOTIFIED_RETENTION)
+                        for k in ('alerts', 'invasions', 'news')}
+
+                # Older state files have no watch lists
+                filters = ChatFilters(f.get('filters'))
+        except dbm.error:
+            return False
+        except KeyError:
+            print('Bad legacy state file, ignoring it')
+            return False
+
+        for c in chats:
+            self.store.add_chat(c)
+        for kind, tracker in seen.items():
+            self.store.update_seen(kind, tracker.to_dict())
+        for c, rewards in filters.to_dict().items():
+            for r in rewards:
+                self.store.add_filter(c, normalize(r), r)
+
+        return True
 
     def save_state(self):
-        """ Saves the state of the notifier thread at the path specified
-        in statefile
+        """ Compacts and closes the state store. All changes have
+        already been written when they happened
 
         """
-        with shelve.open(self.state_path, flag='n') as f:
-            f['chats'] = self.notification_chats
-            f['alerts'] = self.notified_alerts
-            f['invasions'] = self.notified_invasions
-            f['news'] = self.notified_news
+        self.store.close()
 
 
 if __name__ == '__main__':
@@ -596,13 +1705,67 @@ if __name__ == '__main__':
 
     parser.add_argument('--rewards', '-r', default='rewards',
                         dest='rewards_file')
-    parser.add_argument('--statefile', '-s', default='state', dest='state_file')
+    parser.add_argument('--statefile', '-s', default='state.sqlite',
+                        dest='state_file')
+    parser.add_argument('--legacy-statefile', default='state',
+                        dest='legacy_state_file',
+                        help='shelve state file of older versions, imported '
+                             'when the state file does not exist yet')
+    parser.add_argument('--pool-size', type=int, default=WarBot.POOL_SIZE,
+                        dest='pool_size',
+                        help='maximum number of connections kept per host')
+    parser.add_argument('--workers', type=int, default=WarBot.WORKERS,
+                        dest='workers',
+                        help='number of concurrent command workers')
+    parser.add_argument('--engine', choices=('threaded', 'asyncio'),
+                        default='threaded', dest='engine',
+                        help='run with threads or on an asyncio event loop, '
+                             'which requires aiohttp')
+    parser.add_argument('--webhook', dest='webhook_url',
+                        help='receive updates on this public HTTPS URL '
+                             'instead of polling, TLS has to be terminated '
+                             'by a reverse proxy forwarding to --listen')
+    parser.add_argument('--listen', default='0.0.0.0:8443', dest='listen',
+                        help='host:port of the webhook server')
+    parser.add_argument('--webhook-secret', dest='webhook_secret',
+                        help='secret token telegram sends with every '
+                             'update, random by default')
+    parser.add_argument('--api-url', default=WarBot.API_URL, dest='api_url',
+                        help='base URL of the Telegram Bot API, with the '
+                             'token, e.g. to use a local test server')
+    parser.add_argument('--feed-url', default=WarBot.FEED_URL,
+                        dest='feed_url',
+                        help='base URL of the deathsnacks feeds, e.g. to '
+                             'use a mirror or a local test server')
+    parser.add_argument('--shards', type=int, default=WarBot.SHARDS,
+                        dest='shards',
+                        help='send messages from this many processes, '
+                             'each owning a share of the chats')
+    parser.add_argument('--metrics', dest='metrics_listen',
+                        help='host:port to serve Prometheus metrics on, at '
+                             '/metrics, e.g. 127.0.0.1:9100')
 
     args = parser.parse_args()
 
+    WarBot.API_URL = args.api_url
+    WarBot.FEED_URL = args.feed_url
+
     if os.path.isfile(args.rewards_file):
-        w = WarBot(args.rewards_file, args.state_file)
-        w.run()
+        w = WarBot(args.rewards_file, args.state_file,
+                   pool_size=args.pool_size, workers=args.workers,
+                   legacy_state_path=args.legacy_state_file)
+        host, _, port = args.listen.rpartition(':')
+
+        metrics_listen = None
+        if args.metrics_listen:
+            m_host, _, m_port = args.metrics_listen.rpartition(':')
+            metrics_listen = (m_host, int(m_port))
+
+        try:
+            w.run(args.engine, args.webhook_url, (host, int(port)),
+                  args.webhook_secret, args.shards, metrics_listen)
+        except RuntimeError as e:
+            print('Error: ', e)
 
     else:
         print('Error: reward file not found')
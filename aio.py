@@ -0,0 +1,566 @@
+import asyncio
+import concurrent.futures
+import json
+import threading
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from broadcast import get_retry_after
+from polling import get_offset, get_confirm_params
+from coalesce import chunk_text
+from outbox import REPLIES
+from metrics import (FEED_FETCH_SECONDS, UPDATES, NOTIFIER_CYCLE_SECONDS,
+                     record_send)
+from tracing import TRACER
+
+
+class AsyncResponse:
+    """The parts of a requests.Response used by the feed parsers, for
+    responses received with aiohttp
+
+    """
+
+    def __init__(self, status_code, headers, content, encoding='utf-8'):
+        self.status_code    = status_code
+        self.headers        = headers
+        self.content        = content
+        self.text           = content.decode(encoding, errors='replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncEngine:
+    """Runs polling, command handling, feed fetching and notification
+    broadcasts of a WarBot as coroutines on a single asyncio event loop,
+    using aiohttp for all requests
+
+    Commands and notifications use the same WarBot methods as the
+    threaded mode. Feeds are fetched asynchronously into the shared feed
+    cache first, so those methods never block on the network
+
+    """
+
+    # Feeds of the chat's platform needed to answer each command
+    COMMAND_FEEDS = (('/alerts', 'alerts'), ('/invasions', 'invasions'),
+                     ('/darvo', 'deals'), ('/news', 'news'),
+                     ('/remind', 'alerts'), ('/remind', 'deals'),
+                     ('/platform', 'alerts'), ('/platform', 'deals'))
+
+    def __init__(self, bot, max_pending=1000, polling=True):
+        if aiohttp is None:
+            raise RuntimeError('The asyncio engine requires aiohttp')
+
+        self.bot = bot
+
+        # Stale feeds are revalidated by refresh, on the event loop
+        bot.feed_cache.revalidate_stale = False
+
+        # Whether updates are polled, or received through submit_threadsafe
+        self.polling = polling
+
+        # Maximum number of commands being handled at the same time,
+        # polling waits when it is reached
+        self.max_pending = max_pending
+
+        # Per chat locks keeping commands in order, with the number of
+        # commands holding or waiting for each of them
+        self.chat_locks = {}
+        self.chat_pending = {}
+
+        # Per URL locks, so that each feed is fetched once at a time
+        self.fetch_locks = {}
+
+        # Tasks revalidating stale feeds in the background, by URL
+        self.revalidations = {}
+
+        # Running command handlers, and tasks sending outbox messages
+        self.handlers = set()
+        self.senders = set()
+
+        # offset should be one higher than the highest received update_id
+        self.offset = 0
+
+        self.loop = None
+        self.thread = None
+        self.started = threading.Event()
+
+    def start(self):
+        """ Starts the event loop in a new thread, which sends the
+        messages of the bot's outbox
+
+        """
+        self.thread = threading.Thread(target=asyncio.run,
+                                       args=(self.main(),))
+        self.thread.start()
+        self.started.wait()
+
+    def stop(self):
+        """ Stops polling and notifications, waits for running commands
+        and stops the event loop
+
+        """
+        self.loop.call_soon_threadsafe(self.stopped.set)
+        self.thread.join()
+
+    async def main(self):
+        """ Runs the poller and the notifier until stop is called
+
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.pending = asyncio.Semaphore(self.max_pending)
+
+        # Set when messages are queued in the outbox
+        self.outbox_ready = asyncio.Event()
+        self.bot.outbox.wakeup = lambda: self.loop.call_soon_threadsafe(
+            self.outbox_ready.set)
+
+        self.started.set()
+
+        timeout = aiohttp.ClientTimeout(sock_connect=self.bot.CONNECT_TIMEOUT,
+                                        sock_read=self.bot.READ_TIMEOUT)
+        connector = aiohttp.TCPConnector(limit=self.max_pending)
+
+        async with aiohttp.ClientSession(timeout=timeout,
+                                         connector=connector) as session:
+            self.session = session
+
+            tasks = [asyncio.create_task(self.notify()),
+                     asyncio.create_task(self.tick())]
+            drain = asyncio.create_task(self.drain())
+            if self.polling:
+                tasks.append(asyncio.create_task(self.poll()))
+
+            await self.stopped.wait()
+
+            # Cancelling the poller abandons its long poll, the updates
+            # it would have returned are delivered again on the next start
+            tasks += self.revalidations.values()
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            if self.polling:
+                await self.confirm()
+
+            # Let queued commands finish
+            if self.handlers:
+                await asyncio.wait(self.handlers)
+
+            # Send what is due, the outbox keeps the rest for the next
+            # start
+            self.bot.messages.flush(force=True)
+            await self.finish_outbox(self.bot.OUTBOX_DRAIN_TIMEOUT)
+            drain.cancel()
+            await asyncio.gather(drain, return_exceptions=True)
+
+            # Messages still being sent stay in the outbox
+            senders = list(self.senders)
+            for t in senders:
+                t.cancel()
+            await asyncio.gather(*senders, return_exceptions=True)
+            self.bot.outbox.wakeup = None
+
+    async def poll(self):
+        """ Polls telegram servers for updates and starts a handler for
+        every received command, see WarBot.loop
+
+        """
+        poll = self.bot.get_poll_controller()
+
+        while True:
+            p = poll.get_params(self.offset)
+
+            # The read timeout has to outlast the long poll
+            timeout = aiohttp.ClientTimeout(
+                sock_connect=self.bot.CONNECT_TIMEOUT,
+                sock_read=poll.get_read_timeout(self.bot.READ_TIMEOUT))
+
+            try:
+                async with self.session.post(self.bot.API_URL + 'getUpdates',
+                                             params=p,
+                                             timeout=timeout) as resp:
+                    r = await resp.json(content_type=None)
+            except ValueError:
+                print('Invalid JSON from Telegram API')
+                await asyncio.sleep(poll.failure())
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print('Error connecting to API server: ', e)
+                await asyncio.sleep(poll.failure())
+                continue
+
+            if not r.get('ok'):
+                print('Bad response from Telegram API: ', r.get('description'))
+                await asyncio.sleep(poll.failure(
+                    get_retry_after(r) if r.get('error_code') == 429 else 0))
+                continue
+
+            updates = r['result']
+            poll.success(len(updates))
+            UPDATES.inc(len(updates))
+
+            for update in updates:
+                if 'message' in update and 'text' in update['message']:
+                    # Waits while too many commands are running
+                    await self.pending.acquire()
+                    self.submit(update['message'])
+            self.offset = get_offset(updates, self.offset)
+
+    async def confirm(self):
+        """ Confirms the handled updates, see WarBot.confirm_updates
+
+        """
+        if not self.offset:
+            return
+
+        try:
+            async with self.session.post(
+                    self.bot.API_URL + 'getUpdates',
+                    params=get_confirm_params(self.offset)) as resp:
+                await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print('Error confirming updates: ', e)
+
+    def submit_threadsafe(self, message, timeout=None):
+        """ Queues a message for handling from another thread, e.g. the
+        webhook server
+        Returns False if it could not be queued within timeout seconds
+
+        """
+        future = asyncio.run_coroutine_threadsafe(self.enqueue(message),
+                                                  self.loop)
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            return False
+        return True
+
+    async def enqueue(self, message):
+        """ Starts a task handling message, waiting while too many
+        commands are running
+
+        """
+        await self.pending.acquire()
+        self.submit(message)
+
+    def submit(self, message):
+        """ Starts a task handling message, must be called with
+        pending acquired
+
+        """
+        chat_id = message['chat']['id']
+
+        if chat_id not in self.chat_locks:
+            self.chat_locks[chat_id] = asyncio.Lock()
+            self.chat_pending[chat_id] = 0
+        self.chat_pending[chat_id] += 1
+
+        task = asyncio.create_task(self.handle(chat_id, message))
+        self.handlers.add(task)
+        task.add_done_callback(self.handlers.discard)
+
+    async def handle(self, chat_id, message):
+        """ Answers a message, after any earlier message of the same chat
+
+        """
+        try:
+            async with self.chat_locks[chat_id]:
+                await asyncio.wait_for(self.answer(chat_id, message),
+                                       self.bot.HANDLER_TIMEOUT)
+        except asyncio.TimeoutError:
+            print('Handler for {} timed out after {}s'.format(
+                chat_id, self.bot.HANDLER_TIMEOUT))
+        except RuntimeError as e:
+            print(e)
+        except Exception as e:
+            print('Unhandled error in handler for {}: {!r}'.format(chat_id, e))
+        finally:
+            self.pending.release()
+            self.chat_pending[chat_id] -= 1
+            if not self.chat_pending[chat_id]:
+                del self.chat_pending[chat_id]
+                del self.chat_locks[chat_id]
+
+    async def answer(self, chat_id, message):
+        """ Fetches the feed needed by a command and sends the answer
+
+        """
+        text = message['text']
+
+        # A chat changing its platform needs the feeds of the new one
+        platforms = {self.bot.get_platform(chat_id)}
+        if '/platform' in text:
+            platforms.update(p for p in text.lower().split()[1:2]
+                             if p in self.bot.PLATFORMS)
+
+        feeds = [(p, f) for c, f in AsyncEngine.COMMAND_FEEDS if c in text
+                 for p in platforms]
+        with TRACER.span('bot', command=text[:32]):
+            await asyncio.gather(*(self.refresh(f) for f in feeds))
+            reply = self.bot.respond(message)
+
+        if reply:
+            text, options = reply
+
+            # Long replies are split in parts, sent in order
+            self.bot.outbox.put([(chat_id, chunk_text(text))],
+                                REPLIES, **options)
+
+    async def refresh(self, key, max_age=None):
+        """ Makes sure the feed cache holds a fresh snapshot of a feed
+        Throws RuntimeError in case of a bad response
+
+        Parameters
+        ----------
+        key : (str, str) tuple
+            Platform and name of the feed, e.g. ('pc', 'alerts')
+        max_age : float
+            Overrides the feed's TTL, 0 always revalidates
+        """
+        source = self.bot.feeds.sources[key]
+        cache = self.bot.feed_cache
+        url = source.url
+
+        snapshot = cache.snapshots.get(url)
+        if cache.is_fresh(url, snapshot, max_age):
+            return
+
+        if max_age is None and cache.is_servable(url, snapshot):
+            self.revalidate_later(key)
+            return
+
+        cache.check_circuit(url)
+
+        if url not in self.fetch_locks:
+            self.fetch_locks[url] = asyncio.Lock()
+
+        requested = time.monotonic()
+
+        async with self.fetch_locks[url]:
+            # Another task might have fetched the feed while we were
+            # waiting for the lock
+            previous = cache.snapshots.get(url)
+            if cache.is_fresh(url, previous, max_age) or \
+                    cache.is_newer(previous, requested):
+                return
+
+            # The fetch we waited for might have failed as well
+            cache.check_circuit(url)
+
+            start = time.monotonic()
+
+            try:
+                with TRACER.span('fetch', url=url):
+                    async with self.session.get(
+                            url,
+                            headers=cache.get_validators(previous)) as resp:
+                        r = AsyncResponse(resp.status, resp.headers,
+                                          await resp.read(),
+                                          resp.get_encoding())
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                cache.record_failure(url)
+                raise RuntimeError('Error while connecting to ' + url)
+            finally:
+                FEED_FETCH_SECONDS.observe(time.monotonic() - start, url=url)
+
+            try:
+                snapshot = cache.make_snapshot(url, source.parse, previous, r)
+            except RuntimeError:
+                cache.record_failure(url)
+                raise
+
+            cache.record_success(url)
+            cache.store(url, snapshot)
+
+    def revalidate_later(self, key):
+        """ Revalidates a feed in a background task, unless it is
+        already being revalidated or its circuit is open, see
+        FeedCache.revalidate_later
+
+        """
+        url = self.bot.feeds.sources[key].url
+        if url in self.revalidations or \
+                not self.bot.feed_cache.breaker.allow(url):
+            return
+
+        task = asyncio.create_task(self.revalidate(key))
+        self.revalidations[url] = task
+        task.add_done_callback(lambda t: self.revalidations.pop(url, None))
+
+    async def revalidate(self, key):
+        try:
+            await self.refresh(key, max_age=0)
+        except RuntimeError as e:
+            print('Error revalidating feed: ', e)
+
+    async def send(self, recipient, message, **options):
+        """ Sends a message, see WarBot.send
+        Returns a tuple (status code, decoded body), or None if the
+        request failed
+
+        """
+        p = self.bot.get_send_params(recipient, message, **options)
+
+        # aiohttp only accepts strings and numbers as parameters
+        p = {k: str(v).lower() if isinstance(v, bool) else v
+             for k, v in p.items()}
+
+        start = time.monotonic()
+        result = None
+
+        try:
+            with TRACER.span('send', chat=recipient):
+                async with self.session.post(
+                        self.bot.API_URL + 'sendMessage', params=p) as resp:
+                    result = resp.status, await resp.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print('Error sending message to {}: {}'.format(recipient, e))
+
+        record_send(time.monotonic() - start, result)
+        return result
+
+    async def attempt(self, chat_id, text, options):
+        """ Sends a single message once, within the rate limits of the
+        bot's broadcaster, see Broadcaster.attempt
+
+        """
+        broadcaster = self.bot.broadcaster
+
+        await asyncio.sleep(broadcaster.chats.reserve(chat_id))
+        await asyncio.sleep(broadcaster.bucket.reserve())
+
+        r = await self.send(chat_id, text, **options)
+
+        if r is not None and r[0] == 429:
+            # Telegram tells us how long to back off for
+            retry_after = get_retry_after(r[1])
+            broadcaster.bucket.pause(retry_after)
+            broadcaster.chats.delay(chat_id, retry_after)
+
+        return r
+
+    async def drain(self):
+        """ Sends the messages of the bot's outbox as they become due,
+        and flushes it regularly, see Outbox.run
+
+        """
+        outbox = self.bot.outbox
+
+        while True:
+            self.outbox_ready.clear()
+
+            wait = outbox.get_wait()
+            if wait is None or wait > outbox.flush_interval:
+                wait = outbox.flush_interval
+
+            try:
+                await asyncio.wait_for(self.outbox_ready.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+            for msg in outbox.get_due():
+                task = asyncio.create_task(self.send_queued(msg))
+                self.senders.add(task)
+                task.add_done_callback(self.senders.discard)
+
+            outbox.flush_if_due()
+
+    async def send_queued(self, msg):
+        """ Makes a single attempt to send an outbox message and records
+        the outcome
+
+        """
+        try:
+            result = await self.attempt(msg.chat_id, msg.text, msg.options)
+        except Exception as e:
+            print('Unhandled error sending to {}: {!r}'.format(msg.chat_id,
+                                                               e))
+            result = None
+        self.bot.outbox.complete(msg, result)
+
+        # A message can be in flight in its place
+        self.outbox_ready.set()
+
+    async def finish_outbox(self, timeout):
+        """ Waits up to timeout seconds for the due messages of the
+        outbox to be sent
+
+        """
+        outbox = self.bot.outbox
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            wait = outbox.get_wait()
+            if not self.senders and (wait is None or wait > 0):
+                break
+            await asyncio.sleep(0.05)
+
+    async def notify(self):
+        """ Checks the notified feeds whenever the bot's schedule says so
+        and broadcasts new alerts, invasions and news, see
+        WarBot.notifier
+
+        """
+        schedule = self.bot.schedule
+
+        while True:
+            await asyncio.sleep(schedule.get_wait())
+
+            # Only run if notifications are active
+            if not self.bot.notifications.is_set():
+                await asyncio.sleep(1)
+                continue
+
+            with NOTIFIER_CYCLE_SECONDS.time(), TRACER.span('notify'):
+                try:
+                    await self.check_due_feeds()
+                except Exception as e:
+                    self.bot.check_failed(e)
+
+    async def check_due_feeds(self):
+        """ Revalidates the feeds whose check is due and queues
+        notifications of their new items, see WarBot.check_due_feeds
+
+        """
+        due = self.bot.get_due_feeds()
+
+        # Revalidate the due feeds concurrently, whatever their TTL.
+        # Feeds with a bad response are tried again later
+        results = await asyncio.gather(
+            *(self.refresh(k, max_age=0) for k in due),
+            return_exceptions=True)
+
+        snapshots = {}
+        for key, result in zip(due, results):
+            if isinstance(result, RuntimeError):
+                print('Error checking {}/{}: {}'.format(key[0], key[1],
+                                                        result))
+                self.bot.schedule.fail(key)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                snapshots[key] = self.bot.feeds.get(key)
+
+        if not snapshots:
+            return
+
+        self.bot.plan_checks(snapshots)
+
+        for deliveries, options in self.bot.check_notifications(snapshots):
+            self.bot.messages.add(deliveries, **options)
+
+    async def tick(self):
+        """ Collects due reminders and sends collected notifications
+        every REMINDER_TICK seconds, see WarBot.ticker
+
+        """
+        while True:
+            await asyncio.sleep(self.bot.REMINDER_TICK)
+            self.bot.tick()
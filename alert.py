@@ -23,6 +23,15 @@ class Alert:
     def __str__(self):
         """Returns a string with all the information about this alert
 
+        """
+        head, eta, tail = self.get_parts()
+        return head + eta() + tail
+
+    def get_parts(self):
+        """Returns the string representation of this alert split in a
+        tuple (head, eta, tail). eta is a function returning the current
+        ETA string, which goes between head and tail
+
         """
         rewardString = ''
 
@@ -39,12 +48,13 @@ class Alert:
                        '{1} ({2})\n'
                        '{3}\n'
                        'level {4} - {5}\n'
-                       'Expires in {6}')
+                       'Expires in ')
 
-        return alertString.format(self.location, self.missionType,
+        head = alertString.format(self.location, self.missionType,
                                   self.faction, rewardString,
-                                  self.minLevel, self.maxLevel,
-                                  self.get_eta_string())
+                                  self.minLevel, self.maxLevel)
+
+        return head, self.get_eta_string, ''
 
     def get_eta_string(self):
         """Returns a string containing the alert's ETA
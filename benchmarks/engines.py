@@ -0,0 +1,189 @@
+""" Compares how fast the threaded and the asyncio engine drain the
+outbox, the path every message takes, against a local stand-in for the
+Telegram Bot API, which answers every sendMessage after a fixed delay
+
+Usage: python3 benchmarks/engines.py [--chats N] [--latency SECONDS]
+                                     [--in-flight N]
+
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+
+from WarBot import WarBot
+from aio import AsyncEngine
+
+
+class TelegramStub(BaseHTTPRequestHandler):
+    """Answers every request with a successful empty result after
+    server.latency seconds
+
+    """
+
+    # Keep connections alive, like the real API
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        body = json.dumps({'ok': True, 'result': {}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    # Listen backlog, the engines open many connections at once
+    request_queue_size = 1024
+
+
+def serve_stub(latency, port):
+    """Runs the stub server, sending its port through port
+
+    """
+    server = StubServer(('127.0.0.1', 0), TelegramStub)
+    server.latency = latency
+
+    port.put(server.server_port)
+    server.serve_forever()
+
+
+def start_stub(latency):
+    """Starts the stub server in its own process, so that it does not
+    compete with the benchmarked engine for the GIL
+    Returns its base URL
+
+    """
+    port = multiprocessing.Queue()
+    p = multiprocessing.Process(target=serve_stub, args=(latency, port))
+    p.daemon = True
+    p.start()
+    return 'http://127.0.0.1:{}/bot/'.format(port.get())
+
+
+def wait_sent(outbox, before):
+    """Returns the messages sent and failed since the outbox statistics
+    before, once the outbox is empty
+
+    """
+    while len(outbox):
+        time.sleep(0.01)
+
+    stats = outbox.get_stats()
+    return (stats['sent'] - before['sent'],
+            stats['failed'] + stats['blocked'] - before['failed'] -
+            before['blocked'])
+
+
+def run_threaded(bot, deliveries):
+    """Drains the outbox through the Broadcaster, like the threaded engine
+    Returns a tuple (sent, failed, seconds)
+
+    """
+    before = bot.outbox.get_stats()
+    bot.outbox.start(bot.broadcaster)
+
+    start = time.monotonic()
+    bot.outbox.put(deliveries)
+    sent, failed = wait_sent(bot.outbox, before)
+    duration = time.monotonic() - start
+
+    bot.outbox.stop()
+    return sent, failed, duration
+
+
+def run_asyncio(bot, deliveries):
+    """Drains the outbox on an event loop, like the asyncio engine
+    Returns a tuple (sent, failed, seconds)
+
+    """
+    async def main():
+        engine = AsyncEngine(bot)
+        engine.loop = asyncio.get_running_loop()
+        engine.outbox_ready = asyncio.Event()
+        bot.outbox.wakeup = lambda: engine.loop.call_soon_threadsafe(
+            engine.outbox_ready.set)
+
+        connector = aiohttp.TCPConnector(limit=engine.max_pending)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            engine.session = session
+            drain = asyncio.create_task(engine.drain())
+
+            before = bot.outbox.get_stats()
+            start = time.monotonic()
+            bot.outbox.put(deliveries)
+            while len(bot.outbox):
+                await asyncio.sleep(0.01)
+            duration = time.monotonic() - start
+
+            drain.cancel()
+            await asyncio.gather(drain, return_exceptions=True)
+
+        bot.outbox.wakeup = None
+        stats = bot.outbox.get_stats()
+        return (stats['sent'] - before['sent'],
+                stats['failed'] + stats['blocked'] - before['failed'] -
+                before['blocked'], duration)
+
+    return asyncio.run(main())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark how fast both WarBot engines drain the '
+                    'outbox')
+
+    parser.add_argument('--chats', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds the stub waits before answering')
+    parser.add_argument('--in-flight', type=int,
+                        default=WarBot.OUTBOX_IN_FLIGHT, dest='in_flight',
+                        help='messages handed to the sender at once')
+
+    args = parser.parse_args()
+
+    WarBot.API_URL = start_stub(args.latency)
+    WarBot.OUTBOX_IN_FLIGHT = args.in_flight
+
+    # Benchmark the engines, not Telegram's rate limits
+    WarBot.BROADCAST_RATE = 1e9
+    WarBot.CHAT_INTERVAL = 0
+
+    rewards = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'rewards')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bot = WarBot(rewards, os.path.join(tmp, 'state.sqlite'))
+        deliveries = [(c, 'benchmark') for c in range(args.chats)]
+
+        results = {}
+        for name, run in (('threaded', run_threaded),
+                          ('asyncio', run_asyncio)):
+            sent, failed, duration = run(bot, deliveries)
+            results[name] = {'sent': sent, 'failed': failed,
+                             'seconds': round(duration, 3),
+                             'messages_per_second':
+                                 round(sent / duration, 1)}
+
+        bot.feeds.close()
+        bot.broadcaster.close()
+        bot.store.close()
+
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,495 @@
+""" End-to-end load test of a WarBot process against local stand-ins for
+the Telegram Bot API and deathsnacks
+
+The bot is started as a separate process with --api-url and --feed-url
+pointing at a local server, which serves the fixtures in
+benchmarks/fixtures, answers getUpdates with the commands of thousands
+of synthetic chats and rate limits part of the sendMessage requests.
+The test runs in three phases:
+
+1. Warm-up: a single chat turns notifications on, so that the bot
+   fetches the feeds and notifies their current items
+2. Commands: random chats send /alerts, /invasions, /darvo, /news, /help
+   and /notify toggles at --rate commands per second for --duration
+   seconds, the latency of every answer is recorded
+3. Broadcast: new alerts are published, and the time until every chat
+   with notifications on has been notified is recorded. Notifications
+   are collected for the bot's COALESCE_WINDOW before they are sent
+
+The alerts feed holds reward-less alerts expiring every --check-period
+seconds, so that the bot, which checks the feed right after an alert
+expires, notices the new alerts within that period
+
+Usage: python3 benchmarks/loadtest.py [--chats N] [--rate N]
+                                      [--duration SECONDS] [--engine E]
+
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from micro import FIXTURES, FIXTURE_TIME, shift_times
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds the bot gets to notify the current items after the warm-up
+# chat turned notifications on, longer than the coalescing window
+WARMUP = 10
+
+# Commands of the synthetic chats, with their relative frequency
+COMMANDS = (('/alerts', 30), ('/invasions', 20), ('/darvo', 10),
+            ('/news', 10), ('/help', 5), ('/notify on', 15),
+            ('/notify off', 10))
+
+
+def get_percentile(values, p):
+    """Returns the p-th percentile of a sorted list, None if it is empty
+
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Feeds:
+    """The deathsnacks feeds served by the stub, built from the fixtures.
+    The alerts can be replaced by copies with new IDs, which the bot
+    notifies
+
+    """
+
+    def __init__(self, start, check_period, lifetime):
+        offset = int(time.time()) - FIXTURE_TIME
+
+        def load_json(name):
+            with open(os.path.join(FIXTURES, name)) as f:
+                return shift_times(json.load(f), offset)
+
+        self.alerts = load_json('alerts.json')
+
+        # Alerts without rewards, which are never shown nor notified,
+        # expiring every check_period seconds
+        template = self.alerts[0]
+        self.clock = []
+        for n in range(int(lifetime // check_period) + 1):
+            a = json.loads(json.dumps(template))
+            a['id'] = 'clock-{}'.format(n)
+            a['Expiry']['sec'] = int(start + check_period * (n + 1))
+            a['MissionInfo']['missionReward'] = {'credits': 100,
+                                                 'items': [],
+                                                 'countedItems': []}
+            self.clock.append(a)
+
+        with open(os.path.join(FIXTURES, 'news_raw.txt')) as f:
+            news = []
+            for line in f.read().split('\n')[:-1]:
+                id, link, published, text = line.split('|', 3)
+                news.append('|'.join((id, link, str(int(published) + offset),
+                                      text)))
+
+        self.bodies = {
+            'invasion.json': json.dumps(load_json('invasions.json')).encode(),
+            'daily_deals.json': json.dumps(load_json('deals.json')).encode(),
+            'news_raw.txt': ('\n'.join(news) + '\n').encode()}
+        self.set_alerts(self.alerts)
+
+        # Time the new alerts were published and first served
+        self.published = None
+        self.served = None
+
+    def set_alerts(self, alerts):
+        self.bodies['last15alerts_localized.json'] = json.dumps(
+            self.clock + alerts).encode()
+
+    def publish(self):
+        """ Replaces the alerts by copies with new IDs
+
+        """
+        alerts = json.loads(json.dumps(self.alerts))
+        for a in alerts:
+            a['id'] = 'new-' + a['id']
+
+        self.set_alerts(alerts)
+        self.published = time.monotonic()
+
+    def get(self, name):
+        """ Returns the body of a feed, None if there is no such feed
+
+        """
+        body = self.bodies.get(name)
+        if name.startswith('last15alerts') and self.published and \
+                self.served is None:
+            self.served = time.monotonic()
+        return body
+
+
+class Telegram:
+    """The state of the Bot API stand-in: updates waiting to be polled,
+    and every message sent by the bot
+
+    """
+
+    def __init__(self, rate_limit_ratio):
+
+        # Fraction of sendMessage requests answered with a 429
+        self.rate_limit_ratio = rate_limit_ratio
+
+        # Updates not confirmed yet, and the last update ID
+        self.updates = deque()
+        self.last_id = 0
+
+        # Send times of the commands without an answer, by chat ID
+        self.waiting = {}
+
+        # Latencies of the answered commands, in seconds
+        self.latencies = []
+
+        # Time of the first message of every chat since track was called
+        self.tracked = {}
+        self.tracking = False
+
+        self.stats = dict.fromkeys(('get_updates', 'send_message',
+                                    'rate_limited', 'messages'), 0)
+
+        self.cond = threading.Condition()
+
+    def command(self, chat_id, text):
+        """ Queues an update with a command from a chat
+
+        """
+        with self.cond:
+            self.last_id += 1
+            self.updates.append({
+                'update_id': self.last_id,
+                'message': {'message_id': self.last_id,
+                            'date': int(time.time()),
+                            'chat': {'id': chat_id, 'type': 'private'},
+                            'from': {'id': chat_id, 'is_bot': False,
+                                     'first_name': 'Load',
+                                     'language_code': 'en'},
+                            'text': text}})
+            self.waiting.setdefault(chat_id, deque()).append(
+                time.monotonic())
+            self.cond.notify_all()
+
+    def get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 100))
+        deadline = time.monotonic() + float(params.get('timeout', 0))
+
+        with self.cond:
+            self.stats['get_updates'] += 1
+
+            while self.updates and self.updates[0]['update_id'] < offset:
+                self.updates.popleft()
+
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            return [u for _, u in zip(range(limit), self.updates)]
+
+    def send_message(self, params):
+        """ Returns the status code and body of the answer to a
+        sendMessage request
+
+        """
+        now = time.monotonic()
+        chat_id = int(params['chat_id'])
+
+        with self.cond:
+            self.stats['send_message'] += 1
+
+            if random.random() < self.rate_limit_ratio:
+                self.stats['rate_limited'] += 1
+                return 429, {'ok': False, 'error_code': 429,
+                             'description': 'Too Many Requests',
+                             'parameters': {'retry_after': 1}}
+
+            self.stats['messages'] += 1
+
+            # Replies are matched with the oldest unanswered command of
+            # the chat, further parts of long replies with none
+            waiting = self.waiting.get(chat_id)
+            if waiting:
+                self.latencies.append(now - waiting.popleft())
+                if not waiting:
+                    del self.waiting[chat_id]
+
+            if self.tracking and chat_id not in self.tracked:
+                self.tracked[chat_id] = now
+
+        return 200, {'ok': True, 'result': {'message_id': 1}}
+
+    def track(self):
+        """ Starts recording the time of the first message every chat
+        gets from now on
+
+        """
+        with self.cond:
+            self.tracked = {}
+            self.tracking = True
+
+    def get_tracked(self):
+        """ Returns a dict of chat ID -> time of the first message of
+        every chat since track was called
+
+        """
+        with self.cond:
+            return dict(self.tracked)
+
+    def get_waiting(self):
+        """ Returns the number of unanswered commands
+
+        """
+        with self.cond:
+            return sum(len(w) for w in self.waiting.values())
+
+    def reset_latencies(self):
+        with self.cond:
+            self.latencies = []
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serves the Bot API under /bot/ and the feeds under /wf/data/
+
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        name = path.rpartition('/')[2]
+        body = self.server.feeds.get(name) if \
+            path.startswith('/wf/data/') else None
+
+        if body is None:
+            self.respond(404, b'Not found')
+        else:
+            self.respond(200, body)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode()
+            params.update({k: v[0] for k, v in parse_qs(body).items()})
+
+        method = url.path.rpartition('/')[2]
+        telegram = self.server.telegram
+
+        if method == 'getUpdates':
+            status, data = 200, {'ok': True,
+                                 'result': telegram.get_updates(params)}
+        elif method == 'sendMessage':
+            status, data = telegram.send_message(params)
+        else:
+            status, data = 200, {'ok': True, 'result': True}
+
+        self.respond(status, json.dumps(data).encode())
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    # Listen backlog, the bot opens many connections at once
+    request_queue_size = 1024
+
+
+def wait_for(condition, timeout, interval=0.1):
+    """Waits up to timeout seconds for condition to return True
+    Returns False if it did not
+
+    """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def start_bot(args, tmp, port):
+    """Starts WarBot in a separate process, using the stub server
+
+    """
+    command = [sys.executable, os.path.join(ROOT, 'WarBot.py'),
+               '--rewards', os.path.join(ROOT, 'rewards'),
+               '--statefile', os.path.join(tmp, 'state.sqlite'),
+               '--legacy-statefile', os.path.join(tmp, 'state'),
+               '--engine', args.engine, '--shards', str(args.shards),
+               '--api-url', 'http://127.0.0.1:{}/bot/'.format(port),
+               '--feed-url', 'http://127.0.0.1:{}/wf/data/'.format(port)]
+
+    output = None if args.verbose else subprocess.DEVNULL
+    return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output,
+                            stderr=output, cwd=tmp, text=True)
+
+
+def run_commands(telegram, args, subscribed):
+    """Sends commands from random chats at args.rate per second for
+    args.duration seconds, recording which chats turned notifications
+    on or off last
+
+    """
+    commands = [c for c, _ in COMMANDS]
+    weights = [w for _, w in COMMANDS]
+
+    interval = 1 / args.rate
+    start = time.monotonic()
+    sent = 0
+
+    while time.monotonic() - start < args.duration:
+        chat_id = random.randint(1, args.chats)
+        text = random.choices(commands, weights)[0]
+        telegram.command(chat_id, text)
+        sent += 1
+
+        if text == '/notify on':
+            subscribed.add(chat_id)
+        elif text == '/notify off':
+            subscribed.discard(chat_id)
+
+        # Keep the rate, whatever time sending took
+        delay = start + sent * interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    return sent
+
+
+def seconds(value):
+    return round(value, 3) if value is not None else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load test WarBot against local Telegram and '
+                    'deathsnacks stand-ins')
+
+    parser.add_argument('--chats', type=int, default=2000,
+                        help='number of synthetic chats')
+    parser.add_argument('--rate', type=float, default=20,
+                        help='commands per second')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds commands are sent for')
+    parser.add_argument('--engine', choices=('threaded', 'asyncio'),
+                        default='threaded')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='sender processes of the threaded engine')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.01,
+                        dest='rate_limit_ratio',
+                        help='fraction of sendMessage requests answered '
+                             'with 429 Too Many Requests')
+    parser.add_argument('--check-period', type=float, default=10,
+                        dest='check_period',
+                        help='seconds between expiring alerts, bounds the '
+                             'time the bot takes to notice new alerts')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds to wait for answers and for the '
+                             'broadcast to finish')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the output of the bot')
+
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    lifetime = 60 + args.duration + 3 * args.timeout
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    server.telegram = Telegram(args.rate_limit_ratio)
+    server.feeds = Feeds(time.time(), args.check_period, lifetime)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    telegram = server.telegram
+    feeds = server.feeds
+    report = {'engine': args.engine, 'shards': args.shards,
+              'chats': args.chats}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bot = start_bot(args, tmp, server.server_port)
+
+        try:
+            # Warm-up, chat 0 gets the current items of every feed
+            telegram.track()
+            telegram.command(0, '/notify on')
+            if not wait_for(lambda: 0 in telegram.get_tracked(), 60):
+                raise RuntimeError('The bot did not answer')
+            time.sleep(WARMUP)
+            telegram.reset_latencies()
+
+            # Commands
+            subscribed = {0}
+            sent = run_commands(telegram, args, subscribed)
+            wait_for(lambda: not telegram.get_waiting(), args.timeout)
+
+            latencies = sorted(telegram.latencies)
+            report['commands'] = {
+                'sent': sent,
+                'answered': len(latencies),
+                'latency_p50': seconds(get_percentile(latencies, 50)),
+                'latency_p95': seconds(get_percentile(latencies, 95)),
+                'latency_p99': seconds(get_percentile(latencies, 99)),
+                'latency_max': seconds(latencies[-1] if latencies
+                                       else None)}
+
+            # Broadcast of the new alerts to every subscribed chat
+            time.sleep(1)
+            telegram.track()
+            feeds.publish()
+
+            wait_for(lambda: subscribed <= telegram.get_tracked().keys(),
+                     args.timeout)
+
+            notified = [t for c, t in telegram.get_tracked().items()
+                        if c in subscribed]
+            first = min(notified) if notified else None
+            last = max(notified) if notified else None
+            served = feeds.served
+
+            report['broadcast'] = {
+                'subscribers': len(subscribed),
+                'notified': len(notified),
+                # Until the bot fetched the new alerts
+                'detection_seconds': seconds(
+                    served - feeds.published if served else None),
+                # From the fetch to the first notification
+                'notifier_cycle_seconds': seconds(
+                    first - served if served and first else None),
+                # From the fetch to the last notification
+                'completion_seconds': seconds(
+                    last - served if served and last else None)}
+
+        finally:
+            try:
+                bot.communicate('q\n', timeout=args.timeout)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+
+    report['telegram'] = dict(telegram.stats)
+    print(json.dumps(report, indent=2))
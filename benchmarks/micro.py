@@ -0,0 +1,347 @@
+""" Micro-benchmarks of the parsing, filtering and rendering hot paths,
+run offline against the deathsnacks fixtures in benchmarks/fixtures at
+their realistic size and scaled up 100 times
+
+Results are printed as JSON and can be saved with --output. Passing a
+saved file as --baseline compares every benchmark with it, and the exit
+status is 1 if any of them got slower than --threshold
+
+Usage: python3 benchmarks/micro.py [--scale N ...] [--output FILE]
+                                   [--baseline FILE] [--filter TEXT]
+
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+from WarBot import WarBot
+from alert import Alert
+from deal import Deal
+from feedcache import Snapshot
+from feeds import FeedSource, decode_lines
+from invasion import Invasion
+from news import News
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+
+# Unix timestamp the fixtures were taken at. Their times are moved by
+# the age of the fixtures, so that alerts and deals have not expired
+FIXTURE_TIME = 1455000000
+
+
+class FixtureResponse:
+    """The parts of a requests.Response used by the feed parsers
+
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.text = content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def shift_times(data, offset):
+    """Moves every 'sec' timestamp in decoded JSON data by offset seconds
+
+    """
+    if isinstance(data, list):
+        return [shift_times(d, offset) for d in data]
+    if isinstance(data, dict):
+        return {k: v + offset if k == 'sec' else shift_times(v, offset)
+                for k, v in data.items()}
+    return data
+
+
+def scale_items(items, scale, set_id):
+    """Returns items repeated scale times. set_id is called with every
+    copy but the first and its number, to give it its own ID
+
+    """
+    scaled = list(items)
+    for n in range(1, scale):
+        for i in items:
+            copy = json.loads(json.dumps(i))
+            set_id(copy, n)
+            scaled.append(copy)
+    return scaled
+
+
+def load_fixtures(scale=1):
+    """Returns a dict of feed name -> response body, with scale times the
+    items of the fixtures
+
+    """
+    offset = int(time.time()) - FIXTURE_TIME
+
+    def load_json(name):
+        with open(os.path.join(FIXTURES, name)) as f:
+            return shift_times(json.load(f), offset)
+
+    def set_id(key):
+        def set_id(data, n):
+            data[key] = '{}-{}'.format(data[key], n)
+        return set_id
+
+    alerts = scale_items(load_json('alerts.json'), scale, set_id('id'))
+    invasions = scale_items(load_json('invasions.json'), scale,
+                            set_id('Id'))
+    def set_deal_id(data, n):
+        data['_id']['$id'] = '{}-{}'.format(data['_id']['$id'], n)
+
+    deals = scale_items(load_json('deals.json'), scale, set_deal_id)
+
+    with open(os.path.join(FIXTURES, 'news_raw.txt')) as f:
+        lines = f.read().split('\n')[:-1]
+
+    news = []
+    for n in range(scale):
+        for line in lines:
+            id, link, published, text = line.split('|', 3)
+            news.append('|'.join((id if not n else '{}-{}'.format(id, n),
+                                  link, str(int(published) + offset), text)))
+
+    return {'alerts': json.dumps(alerts).encode(),
+            'invasions': json.dumps(invasions).encode(),
+            'deals': json.dumps(deals).encode(),
+            'news': ('\n'.join(news) + '\n').encode()}
+
+
+def get_rewards_lines(scale=1):
+    """Returns the lines of the rewards file, with synthetic rewards and
+    wildcard patterns added for every scale above 1
+
+    """
+    with open(os.path.join(ROOT, 'rewards')) as f:
+        lines = [l.strip() for l in f]
+    rewards = [l for l in lines if l and not l.startswith('#')]
+
+    extra = []
+    for n in range(1, scale):
+        extra += ['{} {}'.format(r, n) for r in rewards]
+        extra.append('Prime Part {} *'.format(n))
+        extra.append('* Blueprint {}'.format(n))
+    return rewards + extra
+
+
+def make_bot(tmp, scale):
+    """Returns a WarBot with a rewards file of the specified scale, and
+    the fixtures of that scale in its feed cache, which never expire
+
+    """
+    rewards = os.path.join(tmp, 'rewards-{}'.format(scale))
+    with open(rewards, 'w') as f:
+        f.write('\n'.join(get_rewards_lines(scale)) + '\n')
+
+    WarBot.FEED_TTL = WarBot.DEAL_TTL = WarBot.NEWS_TTL = float('inf')
+    bot = WarBot(rewards, os.path.join(tmp, 'state-{}.sqlite'.format(scale)))
+
+    bodies = load_fixtures(scale)
+    for key, source in bot.feeds.sources.items():
+        if key[0] == WarBot.DEFAULT_PLATFORM:
+            data = source.parse(FixtureResponse(bodies[key[1]]))
+            bot.feed_cache.store(source.url, Snapshot(data, 1))
+
+    return bot
+
+
+def get_benchmarks(bot, scale):
+    """Returns a list of (name, function, number of items) tuples of the
+    benchmarks of one scale
+
+    """
+    bodies = load_fixtures(scale)
+    responses = {n: FixtureResponse(b) for n, b in bodies.items()}
+
+    sources = {'alerts': FeedSource('alerts', 'alerts', Alert),
+               'invasions': FeedSource('invasions', 'invasions', Invasion),
+               'deals': FeedSource('deals', 'deals', Deal),
+               'news': FeedSource('news', 'news', News, decode_lines)}
+
+    decoded = {'alerts': json.loads(bodies['alerts']),
+               'invasions': json.loads(bodies['invasions']),
+               'deals': json.loads(bodies['deals']),
+               'news': responses['news'].text.split('\n')[:-1]}
+    models = {'alerts': Alert, 'invasions': Invasion, 'deals': Deal,
+              'news': News}
+
+    alerts = bot.get_alerts()
+    invasions = bot.get_invasions()
+    rewards = [a.get_rewards() for a in alerts] + \
+        [i.get_rewards() for i in invasions]
+
+    reward_lines = get_rewards_lines(scale)
+    # Minutes, hours and days
+    deltas = [timedelta(seconds=s * 37) for s in range(1000 * scale)]
+
+    benchmarks = []
+
+    for name, model in models.items():
+        items = decoded[name]
+        benchmarks.append(('construct.' + name,
+                           lambda m=model, d=items: [m(i) for i in d],
+                           len(items)))
+        benchmarks.append(('parse.' + name,
+                           lambda s=sources[name], r=responses[name]:
+                           s.parse(r), len(items)))
+
+    benchmarks += [
+        ('filter_rewards', lambda: [bot.filter_rewards(r) for r in rewards],
+         len(rewards)),
+        ('chat_wants', lambda: [bot.chat_wants(None, r) for r in rewards],
+         len(rewards)),
+        ('load_rewards', bot.load_rewards, len(reward_lines)),
+        ('timedelta_to_string',
+         lambda: [utils.timedelta_to_string(d) for d in deltas],
+         len(deltas)),
+    ]
+
+    # Cold renders start from an empty render cache, warm ones only
+    # splice the current ETAs into cached renders
+    renderers = (('alerts', lambda: bot.get_alert_string(True), alerts),
+                 ('alerts.filtered', lambda: bot.get_alert_string(False),
+                  alerts),
+                 ('invasions', lambda: bot.get_invasion_string(True),
+                  invasions),
+                 ('invasions.filtered',
+                  lambda: bot.get_invasion_string(False), invasions),
+                 ('deals', bot.get_deals_string, bot.get_deals()),
+                 ('news', bot.get_news_string, bot.get_news()))
+
+    for name, render, items in renderers:
+        def cold(render=render):
+            bot.renders.entries.clear()
+            return render()
+
+        benchmarks.append(('render.cold.' + name, cold, len(items)))
+        benchmarks.append(('render.warm.' + name, render, len(items)))
+
+    return benchmarks
+
+
+def measure(function, repeat, min_time):
+    """Returns the best and median seconds per call of function, timed
+    repeat times over loops that take at least min_time seconds
+
+    """
+    timer = timeit.Timer(function)
+
+    # Pick the number of calls per loop like timeit's command line
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time:
+            break
+        number *= 2
+
+    times = [t / number for t in timer.repeat(repeat, number)]
+    return min(times), statistics.median(times)
+
+
+def compare(results, baseline, threshold):
+    """Prints how every benchmark changed since the baseline
+    Returns the names of the benchmarks that got slower than threshold
+
+    """
+    slower = []
+
+    print('{:<40} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline',
+                                               'current', 'change'),
+          file=sys.stderr)
+
+    for name, r in sorted(results.items()):
+        b = baseline.get(name)
+        if b is None:
+            print('{:<40} {:>12} {:>12.3f} {:>8}'.format(
+                name, '-', r['best_us'], 'new'), file=sys.stderr)
+            continue
+
+        change = r['best_us'] / b['best_us'] - 1
+        if change > threshold:
+            slower.append(name)
+
+        print('{:<40} {:>12.3f} {:>12.3f} {:>+7.1%}{}'.format(
+            name, b['best_us'], r['best_us'], change,
+            ' !' if change > threshold else ''), file=sys.stderr)
+
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the parsing, filtering and rendering of '
+                    'WarBot offline')
+
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 100],
+                        help='fixture sizes to run, as multiples of the '
+                             'realistic size')
+    parser.add_argument('--filter', default='',
+                        help='only run benchmarks whose name contains '
+                             'this text')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        dest='min_time',
+                        help='minimum seconds of every timed loop')
+    parser.add_argument('--output', help='save the results to this file')
+    parser.add_argument('--baseline',
+                        help='compare with results saved by --output')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown against the baseline that fails, '
+                             '0.1 is 10%%')
+
+    args = parser.parse_args()
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in args.scale:
+            bot = make_bot(tmp, scale)
+
+            for name, function, items in get_benchmarks(bot, scale):
+                name = '{}[{}x]'.format(name, scale)
+                if args.filter not in name:
+                    continue
+
+                best, median = measure(function, args.repeat, args.min_time)
+                results[name] = {'items': items,
+                                 'best_us': round(best * 1e6, 3),
+                                 'median_us': round(median * 1e6, 3),
+                                 'per_item_us': round(best * 1e6 /
+                                                      max(items, 1), 4)}
+
+            bot.feeds.close()
+            bot.broadcaster.close()
+            bot.http.close()
+            bot.store.close()
+
+    report = {'python': platform.python_version(),
+              'machine': platform.machine(),
+              'results': results}
+
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        slower = compare(results, baseline, args.threshold)
+        if slower:
+            print('Slower than the baseline: ' + ', '.join(slower),
+                  file=sys.stderr)
+            sys.exit(1)
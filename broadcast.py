@@ -0,0 +1,233 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from metrics import record_send
+
+
+def get_retry_after(data):
+    """Returns the number of seconds to back off for, from the decoded
+    body of a 429 response from Telegram
+
+    """
+    try:
+        return data['parameters']['retry_after']
+    except (KeyError, TypeError):
+        return 1
+
+
+def get_send_params(recipient, message, markdown=False, link_preview=True):
+    """Returns the parameters of a sendMessage request
+
+    Parameters
+    ----------
+    recipient : int
+        Id of recipient
+    message : str
+        Message to be sent
+    markdown : boolean
+        Whether the message should be parsed as markdown or not
+    link_preview : boolean
+        Whether or not the links in the message should be previewed
+    """
+    p = {'chat_id': recipient, 'text': message}
+
+    if markdown:
+        p['parse_mode'] = 'Markdown'
+    if not link_preview:
+        p['disable_web_page_preview'] = True
+
+    return p
+
+
+class TokenBucket:
+    """A thread safe token bucket. Tokens are added at a constant rate
+    up to capacity. Tokens are reserved in advance: the bucket may go
+    into debt, and each caller waits until its own token has been added
+
+    """
+
+    def __init__(self, rate, capacity=None):
+        # Tokens added per second
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """ Adds the tokens accrued since the last update, the caller
+        holds the lock
+
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """ Takes a token from the bucket
+        Returns the number of seconds to wait before using it
+
+        """
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+
+            return max(0, -self.tokens / self.rate)
+
+    def acquire(self):
+        """ Takes a token from the bucket, waiting for it if needed
+
+        """
+        time.sleep(self.reserve())
+
+    def pause(self, seconds):
+        """ Stops handing out tokens for at least the specified number
+        of seconds
+
+        """
+        with self.lock:
+            # Idle time before the pause must not pay off its debt
+            self.refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class ChatLimiter:
+    """Spaces consecutive messages to the same chat by at least
+    interval seconds
+
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+
+        # Earliest time of the next message, by chat ID
+        self.next_slot = {}
+
+        self.lock = threading.Lock()
+
+    def wait(self, chat_id):
+        """ Reserves the next free slot for chat_id and sleeps until it
+
+        """
+        time.sleep(self.reserve(chat_id))
+
+    def reserve(self, chat_id):
+        """ Reserves the next free slot for chat_id
+        Returns the number of seconds until the slot
+
+        """
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(chat_id, now))
+            self.next_slot[chat_id] = slot + self.interval
+
+            # Forget chats whose slots are in the past
+            if len(self.next_slot) > 10000:
+                self.next_slot = {c: t for c, t in self.next_slot.items()
+                                  if t > now}
+
+        return slot - now
+
+    def delay(self, chat_id, seconds):
+        """ Pushes the next slot of chat_id at least seconds in the future
+
+        """
+        with self.lock:
+            slot = time.monotonic() + seconds
+            self.next_slot[chat_id] = max(slot, self.next_slot.get(chat_id, 0))
+
+
+class Broadcaster:
+    """Sends messages to many chats concurrently, within Telegram's
+    global and per chat rate limits
+
+    """
+
+    def __init__(self, send, workers=16, rate=30, chat_interval=1.0):
+
+        # Function sending a single message, must return a
+        # requests.Response or None if the request failed
+        self.send = send
+
+        # Global limit, in messages per second
+        self.bucket = TokenBucket(rate)
+
+        # Per chat limit
+        self.chats = ChatLimiter(chat_interval)
+
+        # Called with the duration and result of every request, see
+        # metrics.record_send
+        self.on_sent = record_send
+
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='broadcast')
+
+    def attempt(self, chat_id, text, options):
+        """ Sends a single message once, within the rate limits. After a
+        429 response the limits are paused as long as Telegram asks
+        Returns a tuple (status code, decoded body), or None if the
+        request failed
+
+        """
+        self.chats.wait(chat_id)
+        self.bucket.acquire()
+
+        start = time.monotonic()
+        r = self.send(chat_id, text, **options)
+        seconds = time.monotonic() - start
+
+        if r is None:
+            self.on_sent(seconds, None)
+            return None
+
+        try:
+            data = r.json()
+        except ValueError:
+            data = None
+
+        if r.status_code == requests.codes.too_many_requests:
+            # Telegram tells us how long to back off for
+            retry_after = get_retry_after(data)
+            self.bucket.pause(retry_after)
+            self.chats.delay(chat_id, retry_after)
+
+        self.on_sent(seconds, (r.status_code, data))
+        return r.status_code, data
+
+    def dispatch(self, messages, complete):
+        """ Makes a single attempt to send every message on the sender
+        pool, without waiting
+
+        Parameters
+        ----------
+        messages : iterable of OutboxMessage objects
+            Messages to be sent
+        complete : function
+            Called with every message and the result of its attempt,
+            see attempt
+        """
+        for msg in messages:
+            self.executor.submit(self.attempt_message, msg, complete)
+
+    def attempt_message(self, msg, complete):
+        try:
+            result = self.attempt(msg.chat_id, msg.text, msg.options)
+        except Exception as e:
+            print('Unhandled error sending to {}: {!r}'.format(msg.chat_id,
+                                                               e))
+            result = None
+        complete(msg, result)
+
+    def close(self):
+        """ Stops the sender pool, cancelling the messages it has not
+        started sending, and waits for the ones being sent. Cancelled
+        messages are never reported to complete
+
+        """
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,175 @@
+import threading
+import time
+
+
+# Maximum length of a Telegram message
+MESSAGE_LIMIT = 4096
+
+# Separator between items in a message
+SEPARATOR = '\n\n'
+
+
+def get_length(text):
+    """Returns the length of text as counted by Telegram, in UTF-16 code
+    units
+
+    """
+    return len(text.encode('utf-16-le')) // 2
+
+
+def split_item(item, limit=MESSAGE_LIMIT):
+    """Returns a list of pieces of an item too long for a single message,
+    split at line breaks where possible
+
+    """
+    pieces = []
+    piece = ''
+
+    for line in item.split('\n'):
+        # Lines too long on their own are cut anywhere
+        while get_length(line) > limit:
+            cut = limit
+            while get_length(line[:cut]) > limit:
+                cut -= 1
+            if piece:
+                pieces.append(piece)
+                piece = ''
+            pieces.append(line[:cut])
+            line = line[cut:]
+
+        if piece and get_length(piece) + 1 + get_length(line) > limit:
+            pieces.append(piece)
+            piece = line
+        else:
+            piece = piece + '\n' + line if piece else line
+
+    if piece:
+        pieces.append(piece)
+    return pieces
+
+
+def pack(items, limit=MESSAGE_LIMIT):
+    """Returns the texts of as few messages as possible holding items,
+    separated by blank lines. Messages are only split between items,
+    unless a single item is longer than limit
+
+    Parameters
+    ----------
+    items : iterable of str
+        Texts of the items, without separators
+    limit : int
+        Maximum message length
+    """
+    messages = []
+    parts = []
+    length = 0
+
+    for item in items:
+        pieces = split_item(item, limit) if get_length(item) > limit \
+            else [item]
+
+        for p in pieces:
+            size = get_length(p)
+            if parts and length + len(SEPARATOR) + size > limit:
+                messages.append(SEPARATOR.join(parts))
+                parts = []
+                length = 0
+
+            length += size + (len(SEPARATOR) if parts else 0)
+            parts.append(p)
+
+    if parts:
+        messages.append(SEPARATOR.join(parts))
+    return messages
+
+
+def chunk_text(text, limit=MESSAGE_LIMIT):
+    """Returns text split in messages no longer than limit, at blank
+    lines where possible
+
+    """
+    items = [i for i in text.split(SEPARATOR) if i.strip()]
+    return pack(items, limit) if items else [text]
+
+
+class MessageBuilder:
+    """Collects the items notified to every chat over a short window and
+    packs them in as few messages as possible. Items with different send
+    options, e.g. markdown news and plain alerts, go in separate messages
+
+    """
+
+    def __init__(self, put, window=5, limit=MESSAGE_LIMIT):
+        """
+        Parameters
+        ----------
+        put : function
+            Called with a list of (chat ID, text) pairs and the send
+            options as keyword arguments, e.g. Outbox.put
+        window : float
+            Seconds items are collected for, from the first item of a
+            chat on
+        limit : int
+            Maximum message length
+        """
+        self.put = put
+        self.window = window
+        self.limit = limit
+
+        # Collected items and time of the first one, by (chat ID, options)
+        self.pending = {}
+
+        # Lock for pending
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, deliveries, **options):
+        """ Collects items for chats
+
+        Parameters
+        ----------
+        deliveries : iterable of (int, list) tuples
+            Pairs of recipient chat ID and list of item texts
+        options : dict
+            Keyword arguments passed to send with the items
+        """
+        now = time.monotonic()
+        frozen = tuple(sorted(options.items()))
+
+        with self.lock:
+            for chat_id, items in deliveries:
+                key = (chat_id, frozen)
+                if key not in self.pending:
+                    self.pending[key] = (now, [])
+                self.pending[key][1].extend(items)
+
+    def flush(self, force=False):
+        """ Packs and sends the items collected for window seconds, or
+        all of them if force is True
+
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            ready = [k for k, (first, items) in self.pending.items()
+                     if force or now - first >= self.window]
+            batches = [(k, self.pending.pop(k)[1]) for k in ready]
+
+        # Deliveries of every set of options
+        by_options = {}
+
+        # Chats sharing the same items share their messages
+        packed = {}
+
+        for (chat_id, frozen), items in batches:
+            key = tuple(items)
+            if key not in packed:
+                packed[key] = pack(items, self.limit)
+
+            by_options.setdefault(frozen, []).extend(
+                (chat_id, text) for text in packed[key])
+
+        for frozen, deliveries in by_options.items():
+            self.put(deliveries, **dict(frozen))
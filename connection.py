@@ -0,0 +1,102 @@
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class ConnectionPool:
+    """Keeps one pooled, keep-alive requests.Session per host, so that
+    consecutive requests to the Telegram API or to deathsnacks reuse
+    their TCP and TLS connections
+
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=5, read_timeout=15,
+                 retries=3, backoff=0.5):
+
+        # Maximum number of connections kept open to a single host
+        self.pool_size = pool_size
+
+        # Default timeouts in seconds
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        # Retry policy shared by all sessions. Connection errors are
+        # retried for every method, since the request never reached the
+        # server, bad statuses only for idempotent ones
+        self.retry = Retry(total=retries, connect=retries, read=0,
+                           status=retries, backoff_factor=backoff,
+                           status_forcelist=(500, 502, 503, 504),
+                           allowed_methods=frozenset(('GET', 'HEAD')),
+                           raise_on_status=False)
+
+        # Sessions by host
+        self.sessions = {}
+
+        # Lock for sessions
+        self.lock = threading.Lock()
+
+    def get_session(self, url):
+        """ Returns the session for the host of url, creating it if needed
+
+        Parameters
+        ----------
+        url : str
+            URL of the request
+        """
+        parts = urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size,
+                                      max_retries=self.retry)
+                session = requests.Session()
+                session.mount(parts.scheme + '://', adapter)
+                self.sessions[host] = session
+            return session
+
+    def request(self, method, url, timeout=None, **kwargs):
+        """ Sends a request through the pooled session of its host
+        Returns a requests.Response, throws
+        requests.exceptions.RequestException on failure
+
+        Parameters
+        ----------
+        method : str
+            HTTP method
+        url : str
+            URL of the request
+        timeout : float or tuple
+            Overrides the default (connect, read) timeouts
+        """
+        if timeout is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+
+        return self.get_session(url).request(method, url, timeout=timeout,
+                                             **kwargs)
+
+    def get(self, url, **kwargs):
+        """ Sends a GET request, see request
+
+        """
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """ Sends a POST request, see request
+
+        """
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        """ Closes all sessions and their connections
+
+        """
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
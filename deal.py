@@ -9,7 +9,10 @@ class Deal:
     """
 
     def __init__(self, data):
-        self.id              = data['_id']
+        # deathsnacks sends the ID as a MongoDB object, {"$id": "..."}
+        id = data['_id']
+        self.id              = str(id['$id'] if isinstance(id, dict)
+                                   else id)
         self.item            = data['StoreItem']
         self.expiry          = datetime.fromtimestamp(data['Expiry']['sec'])
         self.original_price  = data['OriginalPrice']
@@ -20,16 +23,27 @@ class Deal:
     def __str__(self):
         """Returns a string with all the information about this alert
 
+        """
+        head, eta, tail = self.get_parts()
+        return head + eta() + tail
+
+    def get_parts(self):
+        """Returns the string representation of this deal split in a
+        tuple (head, eta, tail). eta is a function returning the current
+        ETA string, which goes between head and tail
+
         """
 
         deal_string = ('Daily Deal: {0}\n'
                        '{1}p (original {2}p)\n'
                        '{3} / {4} sold\n'
-                       'Expires in {5}')
+                       'Expires in ')
 
-        return deal_string.format(self.item, self.sale_price,
+        head = deal_string.format(self.item, self.sale_price,
                                   self.original_price, self.sold,
-                                  self.total, self.get_eta_string())
+                                  self.total)
+
+        return head, self.get_eta_string, ''
 
     def get_eta_string(self):
         """Returns a string containing the deal's ETA
@@ -0,0 +1,183 @@
+import threading
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
+
+
+# Queued by a timed out handler when it finishes, to wake up its worker
+WAKE = object()
+
+
+class Dispatcher:
+    """Runs a handler on incoming items using a pool of workers
+
+    Items are partitioned by key (the chat ID for telegram messages), so
+    items with the same key are always handled in order by the same
+    worker, while items with different keys run concurrently. Each worker
+    has a bounded queue, submit blocks when it is full
+
+    A handler that times out no longer holds up the other keys of its
+    worker, but the next items of its own key wait until it finishes
+
+    """
+
+    def __init__(self, handler, workers=8, queue_size=100, timeout=30):
+
+        # Function called with every submitted item
+        self.handler = handler
+
+        # Seconds a worker waits for a handler before moving on to the
+        # items of other keys
+        self.timeout = timeout
+
+        # One bounded queue per worker
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+
+        # Handlers run here, so that a worker can give up on one that
+        # takes too long
+        self.executor = ThreadPoolExecutor(max_workers=workers * 2,
+                                           thread_name_prefix='handler')
+
+        self.threads = []
+
+    def start(self):
+        """ Starts all workers
+
+        """
+        for q in self.queues:
+            t = threading.Thread(target=self.work, args=(q,))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        """ Waits for all queued items to be handled and stops workers.
+        Items held back by a handler that is still running timeout
+        seconds after the worker's last item are dropped
+
+        """
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        self.executor.shutdown(wait=False)
+
+    def submit(self, key, item, timeout=None):
+        """ Queues an item for handling. Blocks while the queue of the
+        item's worker is full
+        Returns False if the item could not be queued within timeout
+
+        Parameters
+        ----------
+        key : hashable
+            Items with the same key are handled in order
+        item : object
+            Item passed to the handler
+        timeout : float
+            Maximum number of seconds to wait, None waits forever
+        """
+        q = self.queues[hash(key) % len(self.queues)]
+
+        try:
+            q.put((key, item), timeout=timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def pending(self):
+        """ Returns the number of queued items
+
+        """
+        return sum(q.qsize() for q in self.queues)
+
+    def work(self, q):
+        """ Worker loop, handles items from q until a None is received
+
+        """
+        # Keys whose last handler timed out, with that handler's future
+        # and the items of the key held back until it finishes
+        waiting = {}
+
+        while True:
+            entry = q.get()
+            if entry is None:
+                self.finish(waiting)
+                break
+
+            if entry is not WAKE:
+                key, item = entry
+                if key in waiting:
+                    waiting[key][1].append(item)
+                else:
+                    self.run(q, waiting, key, deque([item]))
+
+            # Resume the keys whose timed out handler has finished since
+            for key, (future, items) in list(waiting.items()):
+                if future.done():
+                    del waiting[key]
+                    self.run(q, waiting, key, items)
+
+    def run(self, q, waiting, key, items):
+        """ Handles items of key in order. If a handler times out, the
+        rest of the items are held back in waiting until it finishes,
+        so that a later item never overtakes it
+
+        """
+        while items:
+            future = self.handle(key, items.popleft())
+            if future is not None:
+                waiting[key] = (future, items)
+                future.add_done_callback(lambda f: self.wake(q))
+                return
+
+    def finish(self, waiting):
+        """ Handles the items held back when the worker stops, dropping
+        those of handlers still running after timeout seconds
+
+        """
+        while waiting:
+            key, (future, items) = waiting.popitem()
+            wait([future], self.timeout)
+            if future.done():
+                self.run(None, waiting, key, items)
+            else:
+                print('Dropping {} items for {}, its handler is still '
+                      'running'.format(len(items), key))
+
+    def wake(self, q):
+        """ Makes the worker of q look at its waiting keys again. A full
+        queue needs no wake up, the worker is busy with it anyway
+
+        """
+        if q is not None:
+            try:
+                q.put_nowait(WAKE)
+            except queue.Full:
+                pass
+
+    def handle(self, key, item):
+        """ Runs the handler on item
+        Returns its future if it timed out, None once it has finished
+
+        """
+        # The timeout starts when the handler does, not while it waits
+        # for a thread behind handlers that timed out
+        started = threading.Event()
+        future = self.executor.submit(self.call, started, item)
+        started.wait()
+
+        try:
+            future.result(self.timeout)
+        except TimeoutError:
+            print('Handler for {} timed out after {}s'.format(
+                key, self.timeout))
+            return future
+        except RuntimeError as e:
+            print(e)
+        except Exception as e:
+            print('Unhandled error in handler for {}: {!r}'.format(key, e))
+
+    def call(self, started, item):
+        started.set()
+        return self.handler(item)
@@ -0,0 +1,448 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from metrics import FEED_FETCH_SECONDS, FEED_FETCH_ERRORS
+from tracing import TRACER
+
+
+class Snapshot:
+    """This class represents the last successfully fetched state of a
+    feed, together with the validators needed to revalidate it
+
+    """
+
+    def __init__(self, data, version, etag=None, last_modified=None,
+                 digest=None, fetched=None):
+        self.data           = data
+        self.version        = version
+        self.etag           = etag
+        self.last_modified  = last_modified
+        self.digest         = digest
+        self.fetched        = fetched if fetched is not None \
+            else time.monotonic()
+
+    def age(self):
+        """Returns the number of seconds since this snapshot was fetched
+        or last revalidated
+
+        """
+        return time.monotonic() - self.fetched
+
+
+class StoredResponse:
+    """The parts of a requests.Response used by the feed parsers, for
+    feed content read back from the state store
+
+    """
+
+    def __init__(self, content):
+        self.status_code    = requests.codes.ok
+        self.headers        = {}
+        self.content        = content
+        self.text           = content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class CircuitBreaker:
+    """Stops fetching a feed after a number of consecutive failures, so
+    that callers fail fast instead of piling up on a slow or unreachable
+    server. After cooldown seconds a single fetch is let through again,
+    which closes the circuit if it succeeds
+
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+
+        # Consecutive failures opening the circuit of a feed
+        self.threshold = threshold
+
+        # Seconds an open circuit stays open
+        self.cooldown = cooldown
+
+        # Consecutive failures, and the monotonic time until which the
+        # circuit is open, by URL
+        self.failures = {}
+        self.opened = {}
+
+        self.lock = threading.Lock()
+
+    def allow(self, url):
+        """ Returns True if the feed at url may be fetched
+
+        """
+        with self.lock:
+            until = self.opened.get(url)
+            return until is None or time.monotonic() >= until
+
+    def success(self, url):
+        with self.lock:
+            self.failures.pop(url, None)
+            if self.opened.pop(url, None) is not None:
+                print('Fetching {} again'.format(url))
+
+    def failure(self, url):
+        with self.lock:
+            failures = self.failures.get(url, 0) + 1
+            self.failures[url] = failures
+
+            # A failed trial after the cooldown opens it again
+            if failures >= self.threshold:
+                if url not in self.opened:
+                    print('Not fetching {} for {}s after {} failures'.format(
+                        url, self.cooldown, failures))
+                self.opened[url] = time.monotonic() + self.cooldown
+
+
+class FeedCache:
+    """A cache of feed snapshots shared by command handlers and the
+    notifier. Every entry has its own TTL, stale entries are revalidated
+    with a conditional GET and concurrent misses on the same feed result
+    in a single upstream request
+
+    Callers that accept any age get a stale snapshot right away while it
+    is revalidated in the background, up to max_stale seconds after it
+    expired. Feeds that keep failing are not fetched for a while, see
+    CircuitBreaker. With a state store, the content of every new version
+    and the time it was last revalidated are saved, so that a restarted
+    bot answers from it until the first fetch
+
+    """
+
+    def __init__(self, http, ttl=30, max_stale=3600, failure_threshold=5,
+                 cooldown=30, state_store=None):
+
+        # ConnectionPool used for fetching
+        self.http = http
+
+        # Default TTL in seconds, used for feeds without a specific one
+        self.ttl = ttl
+
+        # Seconds past its TTL a snapshot is still served without waiting
+        # for its revalidation
+        self.max_stale = max_stale
+
+        # Trips for feeds that keep failing
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+
+        # StateStore the last content of every feed is saved to, if any
+        self.state_store = state_store
+
+        # Feed specific TTLs, by URL
+        self.ttls = {}
+
+        # Last snapshot of every feed, by URL
+        self.snapshots = {}
+
+        # One lock per feed, held while a fetch is in flight
+        self.fetch_locks = {}
+
+        # URLs being revalidated in the background
+        self.revalidating = set()
+
+        # Whether get revalidates the stale snapshots it returns on the
+        # cache's own threads. The asyncio engine revalidates them itself
+        self.revalidate_stale = True
+
+        # Lock for fetch_locks and revalidating
+        self.lock = threading.Lock()
+
+        self.executor = ThreadPoolExecutor(max_workers=4,
+                                           thread_name_prefix='revalidate')
+
+    def set_ttl(self, url, ttl):
+        """ Sets the TTL of a single feed
+
+        Parameters
+        ----------
+        url : str
+            URL of the feed
+        ttl : float
+            Number of seconds a snapshot of the feed is considered fresh
+        """
+        self.ttls[url] = ttl
+
+    def get(self, url, parse, max_age=None):
+        """ Returns a fresh Snapshot of the feed at url, fetching it only
+        if the cached one is missing or expired. Without max_age, a stale
+        one is returned right away and revalidated in the background
+        Throws RuntimeError in case of a bad response, or if the feed is
+        not fetched after repeated failures
+
+        Parameters
+        ----------
+        url : str
+            URL of the feed
+        parse : function
+            Called with the requests.Response of a successful fetch,
+            returns the data to be stored in the snapshot
+        max_age : float
+            Overrides the feed's TTL, 0 always revalidates and waits
+        """
+
+        snapshot = self.snapshots.get(url)
+        if self.is_fresh(url, snapshot, max_age):
+            return snapshot
+
+        if max_age is None and self.is_servable(url, snapshot):
+            if self.revalidate_stale:
+                self.revalidate_later(url, parse)
+            return snapshot
+
+        self.check_circuit(url)
+
+        requested = time.monotonic()
+
+        with self.get_fetch_lock(url):
+            # Another thread might have fetched the feed while we were
+            # waiting for the lock
+            snapshot = self.snapshots.get(url)
+            if self.is_fresh(url, snapshot, max_age) or \
+                    self.is_newer(snapshot, requested):
+                return snapshot
+
+            # The fetch we waited for might have failed as well
+            self.check_circuit(url)
+
+            snapshot = self.fetch(url, parse, snapshot)
+            self.snapshots[url] = snapshot
+
+        return snapshot
+
+    def revalidate_later(self, url, parse):
+        """ Revalidates the snapshot of a feed in the background, unless
+        it is already being revalidated or its circuit is open
+
+        """
+        if not self.breaker.allow(url):
+            return
+
+        with self.lock:
+            if url in self.revalidating:
+                return
+            self.revalidating.add(url)
+
+        self.executor.submit(self.revalidate, url, parse)
+
+    def revalidate(self, url, parse):
+        try:
+            self.get(url, parse, max_age=0)
+        except RuntimeError as e:
+            print('Error revalidating feed: ', e)
+        finally:
+            with self.lock:
+                self.revalidating.discard(url)
+
+    def store(self, url, snapshot):
+        """ Replaces the cached snapshot of a feed, for snapshots fetched
+        outside of the cache
+
+        """
+        self.snapshots[url] = snapshot
+
+    def is_fresh(self, url, snapshot, max_age=None):
+        """ Returns True if snapshot is not older than max_age seconds,
+        or the feed's TTL if max_age is None
+
+        """
+        if max_age is None:
+            max_age = self.ttls.get(url, self.ttl)
+        return snapshot is not None and snapshot.age() < max_age
+
+    def is_servable(self, url, snapshot):
+        """ Returns True if snapshot expired less than max_stale seconds
+        ago, and can be served while it is revalidated
+
+        """
+        return snapshot is not None and snapshot.age() < \
+            self.ttls.get(url, self.ttl) + self.max_stale
+
+    def check_circuit(self, url):
+        """ Throws RuntimeError if the feed at url is not fetched after
+        repeated failures
+
+        """
+        if not self.breaker.allow(url):
+            raise RuntimeError('Not fetching {} after repeated '
+                               'failures'.format(url))
+
+    def record_success(self, url):
+        """ Records a successful fetch of a feed
+
+        """
+        self.breaker.success(url)
+
+    def record_failure(self, url):
+        """ Records a failed fetch of a feed
+
+        """
+        FEED_FETCH_ERRORS.inc(url=url)
+        self.breaker.failure(url)
+
+    def is_newer(self, snapshot, requested):
+        """ Returns True if snapshot was fetched after the monotonic time
+        requested, i.e. while the caller was waiting for the fetch lock
+
+        """
+        return snapshot is not None and snapshot.fetched >= requested
+
+    def get_fetch_lock(self, url):
+        """ Returns the lock used to serialize fetches of a feed
+
+        """
+        with self.lock:
+            if url not in self.fetch_locks:
+                self.fetch_locks[url] = threading.Lock()
+            return self.fetch_locks[url]
+
+    def fetch(self, url, parse, previous):
+        """ Fetches a feed, revalidating previous if it is not None
+        Returns the new Snapshot, or previous with its age reset if the
+        feed has not been modified
+        Throws RuntimeError in case of a bad response
+
+        """
+
+        start = time.monotonic()
+
+        try:
+            with TRACER.span('fetch', url=url):
+                r = self.http.get(url, headers=self.get_validators(previous))
+        except requests.exceptions.RequestException:
+            self.record_failure(url)
+            raise RuntimeError('Error while connecting to ' + url)
+        finally:
+            FEED_FETCH_SECONDS.observe(time.monotonic() - start, url=url)
+
+        try:
+            snapshot = self.make_snapshot(url, parse, previous, r)
+        except RuntimeError:
+            self.record_failure(url)
+            raise
+
+        self.record_success(url)
+        return snapshot
+
+    def get_validators(self, previous):
+        """ Returns the headers of a conditional GET revalidating the
+        snapshot previous, which may be None
+
+        """
+        headers = {}
+        if previous is not None:
+            if previous.etag:
+                headers['If-None-Match'] = previous.etag
+            if previous.last_modified:
+                headers['If-Modified-Since'] = previous.last_modified
+        return headers
+
+    def make_snapshot(self, url, parse, previous, r):
+        """ Returns the Snapshot for the response r to a fetch of url,
+        or previous with its age reset if the feed has not been modified.
+        The snapshot is saved to the state store
+        Throws RuntimeError in case of a bad response
+
+        Parameters
+        ----------
+        r : requests.Response
+            Or any object with status_code and headers attributes that
+            parse accepts
+        """
+
+        # Feed unchanged, keep data and version of the cached snapshot
+        if r.status_code == requests.codes.not_modified and previous:
+            snapshot = Snapshot(previous.data, previous.version,
+                                r.headers.get('ETag', previous.etag),
+                                r.headers.get('Last-Modified',
+                                              previous.last_modified),
+                                previous.digest)
+            self.save(url, snapshot)
+            return snapshot
+
+        # Raise an exception in case of a bad response
+        if not r.status_code == requests.codes.ok:
+            raise RuntimeError('Bad response from ' + url)
+
+        # Servers without validators send the whole feed every time,
+        # skip parsing it again if the content has not changed
+        digest = hashlib.sha1(r.content).digest()
+        if previous and previous.digest == digest:
+            snapshot = Snapshot(previous.data, previous.version,
+                                r.headers.get('ETag'),
+                                r.headers.get('Last-Modified'), digest)
+            self.save(url, snapshot)
+            return snapshot
+
+        version = previous.version + 1 if previous else 1
+
+        with TRACER.span('parse', url=url):
+            data = parse(r)
+
+        snapshot = Snapshot(data, version, r.headers.get('ETag'),
+                            r.headers.get('Last-Modified'), digest)
+
+        self.save(url, snapshot, r.content)
+        return snapshot
+
+    def save(self, url, snapshot, content=None):
+        """ Saves a snapshot to the state store, if there is one. Without
+        content only its validators and fetch time are updated, so that a
+        feed that has not changed for long is still restored
+
+        """
+        store = self.state_store
+        if store is None:
+            return
+
+        if content is None:
+            store.touch_feed(url, snapshot.etag, snapshot.last_modified,
+                             time.time())
+        else:
+            store.set_feed((url, content, snapshot.etag,
+                            snapshot.last_modified, time.time()))
+
+    def restore(self, url, parse):
+        """ Loads the snapshot of a feed saved by a previous run, if
+        there is one and nothing newer is cached. Its age is the time
+        since it was saved, so it is revalidated on first use
+
+        Parameters
+        ----------
+        url : str
+            URL of the feed
+        parse : function
+            Parses the saved content, see get
+        """
+        if self.state_store is None or url in self.snapshots:
+            return
+
+        row = self.state_store.get_feed(url)
+        if row is None:
+            return
+
+        content, etag, last_modified, saved = row
+
+        try:
+            data = parse(StoredResponse(content))
+        except (RuntimeError, ValueError) as e:
+            print('Not restoring {}: {}'.format(url, e))
+            return
+
+        age = max(0, time.time() - saved)
+        self.snapshots[url] = Snapshot(data, 1, etag, last_modified,
+                                       hashlib.sha1(content).digest(),
+                                       time.monotonic() - age)
+
+    def close(self):
+        """ Stops the background revalidations, feeds fetched from now
+        on are no longer saved
+
+        """
+        self.state_store = None
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,201 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from feedcache import Snapshot
+from tracing import TRACER
+
+
+def decode_json(r, url):
+    """Returns the decoded JSON body of the response r
+    Throws RuntimeError in case of bad JSON
+
+    """
+    # Response.json() might raise ValueError
+    try:
+        return r.json()
+    except ValueError as e:
+        raise RuntimeError('Bad JSON from ' + url) from e
+
+
+def decode_lines(r, url):
+    """Returns the lines of the text body of the response r, the text
+    ends with a newline so the last, empty line is dropped
+
+    """
+    lines = r.text.split('\n')
+    lines.pop()
+    return lines
+
+
+class FeedSource:
+    """A feed of one game platform served at its own URL. Fetches go
+    through the shared feed cache, responses are then decoded, validated
+    and parsed into a list of model objects
+
+    """
+
+    def __init__(self, name, url, model, decode=decode_json, ttl=None,
+                 platform=None):
+        self.name       = name
+        self.url        = url
+        self.model      = model
+        self.decode     = decode
+
+        # Seconds a snapshot is fresh, None for the cache default
+        self.ttl        = ttl
+
+        # Game platform the feed is about, e.g. 'pc'
+        self.platform   = platform
+
+    def names(self):
+        """Returns the names of the feeds provided by this source
+
+        """
+        return [self.name]
+
+    def parse(self, r):
+        """ Returns the list of model objects in the response r
+        Throws RuntimeError in case of a bad response
+
+        """
+        data = self.decode(r, self.url)
+        self.validate(data)
+        return [self.model(d) for d in data]
+
+    def validate(self, data):
+        """ Throws RuntimeError in case of an empty response
+
+        """
+        if not data:
+            raise RuntimeError('Empty response from ' + self.url)
+
+    def snapshot(self, cache, name, max_age=None):
+        """ Returns the current Snapshot of the feed, see FeedCache.get
+        Throws RuntimeError in case of a bad response
+
+        """
+        return cache.get(self.url, self.parse, max_age)
+
+
+class WorldstateSource(FeedSource):
+    """A single document providing several feeds at once, a JSON object
+    with a list of items for every feed, e.g.
+    {"alerts": [...], "invasions": [...], "deals": [...], "news": [...]}
+
+    """
+
+    def __init__(self, url, models, ttl=None, platform=None):
+        super().__init__('worldstate', url, None, decode_json, ttl,
+                         platform)
+
+        # Model class of every feed, by name
+        self.models = models
+
+    def names(self):
+        return list(self.models)
+
+    def parse(self, r):
+        """ Returns a dict of feed name -> list of model objects
+        Throws RuntimeError in case of a bad response
+
+        """
+        data = self.decode(r, self.url)
+        if not isinstance(data, dict):
+            raise RuntimeError('Bad worldstate from ' + self.url)
+
+        # Unlike single feeds, a section may be empty, e.g. when there
+        # are no invasions, but it has to be there
+        feeds = {}
+        for name, model in self.models.items():
+            items = data.get(name)
+            if not isinstance(items, list):
+                raise RuntimeError('Missing {} in worldstate from {}'.format(
+                    name, self.url))
+            feeds[name] = [model(d) for d in items]
+        return feeds
+
+    def snapshot(self, cache, name, max_age=None):
+        """ Returns a Snapshot of a single feed of the document, sharing
+        the version of the whole document
+        Throws RuntimeError in case of a bad response
+
+        """
+        s = cache.get(self.url, self.parse, max_age)
+        return Snapshot(s.data[name], s.version, s.etag, s.last_modified,
+                        s.digest)
+
+
+class FeedPipeline:
+    """Gives access to the snapshots of feeds by key, a (platform, name)
+    tuple, whatever source provides them, and fetches several sources
+    concurrently
+
+    """
+
+    def __init__(self, cache, sources, workers=4):
+
+        # Shared FeedCache
+        self.cache = cache
+
+        # Source of every feed, by (platform, name)
+        self.sources = {}
+
+        for s in sources:
+            if s.ttl is not None:
+                cache.set_ttl(s.url, s.ttl)
+
+            # Answer from the content saved by the last run until the
+            # first fetch
+            cache.restore(s.url, s.parse)
+            for name in s.names():
+                self.sources[(s.platform, name)] = s
+
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='feed')
+
+    def get(self, key, max_age=None):
+        """ Returns the current Snapshot of a feed
+        Throws RuntimeError in case of a bad response
+
+        Parameters
+        ----------
+        key : (str, str) tuple
+            Platform and name of the feed, e.g. ('pc', 'alerts')
+        max_age : float
+            Overrides the TTL of the feed's source, see FeedCache.get
+        """
+        with TRACER.span('get', feed='/'.join(key)):
+            return self.sources[key].snapshot(self.cache, key[1], max_age)
+
+    def try_all(self, keys, max_age=None):
+        """ Fetches every distinct source of some feeds concurrently. A
+        bad response of one feed does not affect the others
+        Returns a dict of feed key -> current Snapshot of the feeds that
+        were fetched, and a dict of feed key -> RuntimeError of the others
+
+        Parameters
+        ----------
+        keys : iterable of (str, str) tuples
+            Platforms and names of the feeds
+        max_age : float
+            Overrides the TTLs of the sources, see FeedCache.get
+        """
+        futures = {k: self.executor.submit(self.get, k, max_age)
+                   for k in keys}
+
+        snapshots = {}
+        errors = {}
+        for key, f in futures.items():
+            try:
+                snapshots[key] = f.result()
+            except RuntimeError as e:
+                errors[key] = e
+
+        return snapshots, errors
+
+    def close(self):
+        """ Stops the fetch pool and the background revalidations of
+        the cache
+
+        """
+        self.executor.shutdown(wait=False)
+        self.cache.close()
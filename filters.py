@@ -0,0 +1,119 @@
+import threading
+
+from matcher import normalize
+
+
+class ChatFilters:
+    """Per chat reward watch lists. Besides the rewards of every chat,
+    an inverted index from reward to chats is kept, so that the chats
+    interested in an alert or invasion are found with one lookup per
+    reward
+
+    """
+
+    def __init__(self, filters=None):
+
+        # Watched rewards of every chat, normalized name -> name
+        self.by_chat = {}
+
+        # Chats watching every reward, by normalized name
+        self.by_reward = {}
+
+        # Lock for by_chat and by_reward
+        self.lock = threading.Lock()
+
+        if filters:
+            for chat_id, rewards in filters.items():
+                for r in rewards:
+                    self.add(chat_id, r)
+
+    def add(self, chat_id, reward):
+        """ Adds a reward to the watch list of a chat
+        Returns False if it was already there
+
+        Parameters
+        ----------
+        chat_id : int
+            ID of the chat
+        reward : str
+            Reward name
+        """
+        key = normalize(reward)
+
+        with self.lock:
+            rewards = self.by_chat.setdefault(chat_id, {})
+            if key in rewards:
+                return False
+            rewards[key] = ' '.join(reward.split())
+            self.by_reward.setdefault(key, set()).add(chat_id)
+        return True
+
+    def remove(self, chat_id, reward):
+        """ Removes a reward from the watch list of a chat
+        Returns False if it was not there
+
+        Parameters
+        ----------
+        chat_id : int
+            ID of the chat
+        reward : str
+            Reward name
+        """
+        key = normalize(reward)
+
+        with self.lock:
+            rewards = self.by_chat.get(chat_id)
+            if not rewards or key not in rewards:
+                return False
+
+            del rewards[key]
+            if not rewards:
+                del self.by_chat[chat_id]
+
+            chats = self.by_reward[key]
+            chats.discard(chat_id)
+            if not chats:
+                del self.by_reward[key]
+        return True
+
+    def get(self, chat_id):
+        """ Returns a sorted list of the rewards watched by a chat
+
+        """
+        with self.lock:
+            return sorted(self.by_chat.get(chat_id, {}).values())
+
+    def has_filter(self, chat_id):
+        """ Returns True if the chat has its own watch list
+
+        """
+        return chat_id in self.by_chat
+
+    def matches(self, chat_id, rewards):
+        """ Returns True if the chat watches any of rewards
+
+        """
+        watched = self.by_chat.get(chat_id, {})
+        return any(normalize(r) in watched for r in rewards)
+
+    def match(self, rewards):
+        """ Returns the set of chats watching any of rewards
+
+        Parameters
+        ----------
+        rewards : List of str objects
+            List of rewards for an alert or invasion
+        """
+        chats = set()
+        with self.lock:
+            for r in rewards:
+                chats.update(self.by_reward.get(normalize(r), ()))
+        return chats
+
+    def to_dict(self):
+        """ Returns the watch lists as a dict of chat ID -> list of
+        rewards, suitable for saving
+
+        """
+        with self.lock:
+            return {c: list(r.values()) for c, r in self.by_chat.items()}
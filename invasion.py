@@ -46,6 +46,14 @@ class Invasion:
                                      self.type2, self.reward2,
                                      self.completion, self.ETA)
 
+    def get_parts(self):
+        """Returns the string representation of this invasion as a tuple
+        (head, eta, tail). Invasions have no time dependent text, so eta
+        is None and tail is empty
+
+        """
+        return str(self), None, ''
+
     def get_rewards(self):
         """Returns a list containing the invasion's rewards excluding credits
 
@@ -0,0 +1,173 @@
+import re
+from collections import deque
+
+
+# Item counts as found in reward strings, e.g. '3 x Fieldron' or
+# 'Nitain Extract x2'
+COUNT_PREFIX = re.compile(r'^\d+\s*x\s+')
+COUNT_SUFFIX = re.compile(r'\s+x\s*\d+$')
+
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize(reward):
+    """Returns the form of a reward name used for comparisons: lower
+    case, single spaced and without item counts
+
+    Parameters
+    ----------
+    reward : str
+        Reward name
+    """
+    reward = ' '.join(reward.lower().split())
+    return COUNT_SUFFIX.sub('', COUNT_PREFIX.sub('', reward))
+
+
+class Automaton:
+    """An Aho-Corasick automaton, finds every occurrence of a set of
+    fragments in a string in a single pass
+
+    """
+
+    def __init__(self, fragments):
+
+        # Transitions, outputs and failure links of every state,
+        # state 0 is the root
+        self.goto = [{}]
+        self.output = [[]]
+        self.fail = [0]
+
+        for i, f in enumerate(fragments):
+            state = 0
+            for ch in f:
+                if ch not in self.goto[state]:
+                    self.goto.append({})
+                    self.output.append([])
+                    self.fail.append(0)
+                    self.goto[state][ch] = len(self.goto) - 1
+                state = self.goto[state][ch]
+            self.output[state].append(i)
+
+        # Breadth first construction of failure links
+        todo = deque(self.goto[0].values())
+        while todo:
+            state = todo.popleft()
+            for ch, child in self.goto[state].items():
+                todo.append(child)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                self.output[child] = self.output[child] + \
+                    self.output[self.fail[child]]
+
+    def search(self, text):
+        """ Returns a list of (end, fragment) pairs for every occurrence of
+        a fragment in text, end being the index after its last character
+
+        """
+        found = []
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            for f in self.output[state]:
+                found.append((i + 1, f))
+        return found
+
+
+class RewardMatcher:
+    """A compiled reward filter. Plain names are kept in a hash set of
+    normalized names, patterns containing '*' wildcards are compiled into
+    a single automaton. Instances are never modified, so they can be
+    shared between threads and replaced as a whole on reload
+
+    """
+
+    def __init__(self, patterns):
+
+        # Normalized exact names
+        self.names = set()
+
+        # Wildcard patterns, as (fragments, anchored start, anchored end)
+        self.patterns = []
+
+        fragments = []
+        fragment_ids = {}
+
+        for p in patterns:
+            if '*' not in p:
+                self.names.add(normalize(p))
+                continue
+
+            # Spaces next to a wildcard are kept, 'Vandal *' must not
+            # match 'Vandalism'
+            parts = [WHITESPACE.sub(' ', f)
+                     for f in p.strip().lower().split('*')]
+            ids = []
+            for f in parts:
+                if f and f not in fragment_ids:
+                    fragment_ids[f] = len(fragments)
+                    fragments.append(f)
+                if f:
+                    ids.append(fragment_ids[f])
+
+            self.patterns.append((ids, bool(parts[0]), bool(parts[-1])))
+
+        self.lengths = [len(f) for f in fragments]
+        self.automaton = Automaton(fragments) if fragments else None
+
+    def __len__(self):
+        return len(self.names) + len(self.patterns)
+
+    def __contains__(self, reward):
+        """ Returns True if reward matches a name or a pattern
+
+        """
+        reward = normalize(reward)
+
+        if reward in self.names:
+            return True
+        if not self.patterns:
+            return False
+
+        # Positions of every fragment occurrence, by fragment. Patterns
+        # of wildcards only have none
+        found = {}
+        if self.automaton is not None:
+            for end, f in self.automaton.search(reward):
+                found.setdefault(f, []).append(end)
+
+        return any(self.match_pattern(p, found, len(reward))
+                   for p in self.patterns)
+
+    def match_pattern(self, pattern, found, length):
+        """ Returns True if the fragments of pattern occur in order,
+        without overlapping and respecting its anchors
+
+        """
+        ids, anchored_start, anchored_end = pattern
+        if not ids:
+            # Pattern consisting of wildcards only
+            return True
+
+        pos = 0
+        for n, f in enumerate(ids):
+            start = None
+            for end in found.get(f, ()):
+                begin = end - self.lengths[f]
+                if begin < pos:
+                    continue
+                if n == 0 and anchored_start and begin != 0:
+                    continue
+                if n == len(ids) - 1 and anchored_end and end != length:
+                    continue
+                start = end
+                break
+            if start is None:
+                return False
+            pos = start
+        return True
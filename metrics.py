@@ -0,0 +1,307 @@
+import bisect
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')) for k, v in labels) + '}'
+
+
+class Metric:
+    """A metric with a value for every combination of label values.
+    Values are either recorded as they change, or read from function
+    when the metrics are collected
+
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=(), function=None):
+        """
+        Parameters
+        ----------
+        name : str
+            Metric name, e.g. 'warbot_updates_total'
+        help : str
+            Description of the metric
+        labels : tuple of str
+            Label names
+        function : function
+            Returns the current value, or if the metric has labels a dict
+            of label values tuple -> value
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+
+        # Value of every combination of label values
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, labels):
+        return tuple(str(labels[l]) for l in self.labels)
+
+    def samples(self):
+        """ Returns a list of (name suffix, labels, value) tuples, labels
+        being a tuple of (name, value) pairs
+
+        """
+        if self.function is not None:
+            values = self.function()
+            if not self.labels:
+                values = {(): values}
+        else:
+            with self.lock:
+                values = dict(self.values)
+
+        return [('', tuple(zip(self.labels, k)), v)
+                for k, v in sorted(values.items())]
+
+    def render(self):
+        """ Returns the metric in the Prometheus text format
+
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix,
+                                            format_labels(labels),
+                                            format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. a number of requests
+
+    """
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. a queue length
+
+    """
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """Counts observed values, e.g. latencies, in buckets
+
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = ([0] * len(self.buckets), [0.0])
+            counts, total = self.values[key]
+            counts[i] += 1
+            total[0] += value
+
+    def time(self, **labels):
+        """ Returns a context manager observing the seconds its block
+        takes
+
+        """
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            values = {k: (list(c), t[0]) for k, (c, t) in
+                      self.values.items()}
+
+        samples = []
+        for key, (counts, total) in sorted(values.items()):
+            labels = tuple(zip(self.labels, key))
+
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(('_bucket', labels + (('le', format_value(
+                    float(bound))),), cumulative))
+
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+class Timer:
+    """Observes the duration of a with block in a histogram
+
+    """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+
+class Registry:
+    """The metrics exposed by the bot, by name
+
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """ Adds a metric, replacing any metric with the same name
+        Returns the metric
+
+        """
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """ Returns all metrics in the Prometheus text format
+
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return ''.join(m.render() + '\n' for m in metrics)
+
+
+# Metrics of the bot, recorded by the modules doing the work
+REGISTRY = Registry()
+
+FEED_FETCH_SECONDS = REGISTRY.register(Histogram(
+    'warbot_feed_fetch_seconds', 'Duration of feed fetches', ('url',)))
+FEED_FETCH_ERRORS = REGISTRY.register(Counter(
+    'warbot_feed_fetch_errors_total', 'Failed feed fetches', ('url',)))
+
+SEND_SECONDS = REGISTRY.register(Histogram(
+    'warbot_send_seconds', 'Duration of sendMessage requests'))
+SEND_RESPONSES = REGISTRY.register(Counter(
+    'warbot_send_responses_total',
+    'sendMessage responses by status code, "error" if the request failed',
+    ('status',)))
+
+UPDATES = REGISTRY.register(Counter(
+    'warbot_updates_total', 'Telegram updates received'))
+
+NOTIFIER_CYCLE_SECONDS = REGISTRY.register(Histogram(
+    'warbot_notifier_cycle_seconds',
+    'Duration of notifier checks, from fetching the due feeds to queueing '
+    'the notifications'))
+
+
+def record_send(seconds, result):
+    """Records the duration and outcome of a sendMessage request
+
+    Parameters
+    ----------
+    seconds : float
+        Duration of the request
+    result : (int, dict) tuple
+        Status code and decoded body, None if the request failed
+    """
+    SEND_SECONDS.observe(seconds)
+    SEND_RESPONSES.inc(status=result[0] if result is not None else 'error')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the metrics of the registry at /metrics
+
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = self.server.registry.render().encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """An HTTP server exposing the metrics in the Prometheus text format,
+    meant to listen on a local or internal address
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, registry=REGISTRY):
+        """
+        Parameters
+        ----------
+        address : (str, int) tuple
+            Host and port to listen on
+        registry : Registry
+            Metrics to serve
+        """
+        super().__init__(address, MetricsHandler)
+
+        self.registry = registry
+        self.thread = None
+
+    def start(self):
+        """ Starts serving in a new thread
+
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stops serving and closes the socket
+
+        """
+        self.shutdown()
+        self.server_close()
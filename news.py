@@ -22,8 +22,18 @@ class News:
 
         """
 
-        return '\[{} ago]: [{}]({})'.format(self.get_elapsed_time(),
-                                              self.text, self.link)
+        head, eta, tail = self.get_parts()
+        return head + eta() + tail
+
+    def get_parts(self):
+        """Returns the string representation of this news item split in
+        a tuple (head, eta, tail). eta is a function returning the current
+        elapsed time string, which goes between head and tail
+
+        """
+
+        return '\\[', self.get_elapsed_time, \
+            ' ago]: [{}]({})'.format(self.text, self.link)
 
     def get_elapsed_time(self):
         """Returns a string containing the time that has passed since
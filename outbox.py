@@ -0,0 +1,438 @@
+import heapq
+import itertools
+import json
+import threading
+import time
+from collections import deque
+
+from broadcast import get_retry_after
+
+
+# Lanes of the outbox, due replies are sent before due notifications
+REPLIES = 0
+NOTIFICATIONS = 1
+
+
+class OutboxMessage:
+    """This class represents a message waiting in the outbox. Messages
+    too long for a single telegram message are sent as several parts, in
+    order: text is the part to be sent next, rest the parts after it
+
+    """
+
+    __slots__ = ('id', 'chat_id', 'text', 'options', 'created', 'attempts',
+                 'next_attempt', 'stored', 'lane', 'rest')
+
+    def __init__(self, id, chat_id, text, options, created, attempts=0,
+                 next_attempt=None, stored=False, lane=NOTIFICATIONS,
+                 rest=()):
+        self.id             = id
+        self.chat_id        = chat_id
+        self.text           = text
+        self.rest           = list(rest)
+        self.options        = options
+        self.created        = created
+        self.attempts       = attempts
+        self.next_attempt   = next_attempt if next_attempt else created
+
+        # Whether the message has been written to the state store
+        self.stored         = stored
+
+        # REPLIES or NOTIFICATIONS, messages left over from the last run
+        # are all notifications
+        self.lane           = lane
+
+    @classmethod
+    def from_row(cls, row):
+        (id, chat_id, text, options, created, attempts, next_attempt,
+         rest) = row
+        return cls(id, chat_id, text, json.loads(options), created,
+                   attempts, next_attempt, True, rest=json.loads(rest))
+
+    def to_row(self):
+        return (self.id, self.chat_id, self.text, json.dumps(self.options),
+                self.created, self.attempts, self.next_attempt,
+                json.dumps(self.rest))
+
+
+def get_percentile(values, p):
+    """Returns the p-th percentile of a sorted list, None if it is empty
+
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Outbox:
+    """A durable queue every outgoing message goes through
+
+    Queued messages are kept in memory and written to the state store in
+    batches, every flush_interval seconds, so that messages still waiting
+    survive a restart. Failed sends are retried with exponential backoff,
+    rate limited ones after the retry_after Telegram asks for. Chats that
+    blocked the bot (403) are reported to on_blocked
+
+    Messages are sent by start, through a Broadcaster or ShardedSender,
+    or by the asyncio engine, which takes due messages with get_due and
+    reports the outcome to complete
+
+    At most max_in_flight messages are being sent at a time. Replies to
+    commands go through their own lane, and are taken before any due
+    notification, so they never wait behind a whole broadcast
+
+    A message of several parts is a single entry, which sends its next
+    part only once the previous one has been sent
+
+    """
+
+    def __init__(self, store, retries=8, backoff=2, max_backoff=600,
+                 flush_interval=1.0, on_blocked=None, max_in_flight=30):
+
+        self.store = store
+
+        # Retry policy, backoff times are in seconds
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # Seconds between two writes to the store
+        self.flush_interval = flush_interval
+        self.flushed = time.monotonic()
+
+        # Called with the ID of every chat that blocked the bot
+        self.on_blocked = on_blocked
+
+        # Called after messages are queued, e.g. to wake up an event loop
+        self.wakeup = None
+
+        # Waiting messages of every lane, as heaps of (next attempt, ID,
+        # message)
+        self.queues = ([], [])
+
+        # Number of messages being sent, and how many can be at a time
+        self.in_flight = 0
+        self.max_in_flight = max_in_flight
+
+        # Messages to write and IDs to delete with the next flush
+        self.dirty = {}
+        self.deleted = set()
+
+        # Delivery statistics, and the latencies of the last deliveries
+        self.stats = dict.fromkeys(('queued', 'sent', 'retried', 'failed',
+                                    'blocked'), 0)
+        self.latencies = deque(maxlen=1000)
+
+        # Notifications queued since the notification lane was last
+        # empty: [monotonic start, messages, finished, failed], None
+        # while there are none
+        self.broadcast = None
+
+        # Condition for all of the above, notified when messages are
+        # queued or sent
+        self.cond = threading.Condition()
+
+        # Serializes flushes, so that writes reach the store in order
+        self.flush_lock = threading.Lock()
+
+        self.running = False
+        self.thread = None
+        self.sender = None
+
+        # Messages left over from the last run
+        last_id = 0
+        for row in store.get_outbox():
+            msg = OutboxMessage.from_row(row)
+            self.push(msg)
+            last_id = max(last_id, msg.id)
+
+        if self.queues[NOTIFICATIONS]:
+            print('{} messages left in the outbox'.format(
+                len(self.queues[NOTIFICATIONS])))
+            self.broadcast = [time.monotonic(),
+                              len(self.queues[NOTIFICATIONS]), 0, 0]
+
+        self.ids = itertools.count(last_id + 1)
+
+    def __len__(self):
+        """ Returns the number of messages waiting or being sent
+
+        """
+        with self.cond:
+            return sum(map(len, self.queues)) + self.in_flight
+
+    def push(self, msg):
+        # Must be called with cond held
+        heapq.heappush(self.queues[msg.lane], (msg.next_attempt, msg.id, msg))
+
+    def put(self, deliveries, lane=NOTIFICATIONS, **options):
+        """ Queues messages for sending
+
+        Parameters
+        ----------
+        deliveries : iterable of (int, str) tuples
+            Pairs of recipient chat ID and message text. The text may be
+            a list of parts, sent one after the other, each only once
+            the previous one has been sent
+        lane : int
+            REPLIES for answers to commands, NOTIFICATIONS otherwise
+        options : dict
+            Keyword arguments passed to send for every message
+        """
+        now = time.time()
+
+        with self.cond:
+            queued = self.stats['queued']
+
+            for chat_id, text in deliveries:
+                parts = [text] if isinstance(text, str) else text
+                msg = OutboxMessage(next(self.ids), chat_id, parts[0],
+                                    options, now, lane=lane, rest=parts[1:])
+                self.dirty[msg.id] = msg
+                self.push(msg)
+                self.stats['queued'] += len(parts)
+
+            if lane == NOTIFICATIONS and self.stats['queued'] > queued:
+                if self.broadcast is None:
+                    self.broadcast = [time.monotonic(), 0, 0, 0]
+                self.broadcast[1] += self.stats['queued'] - queued
+
+            self.cond.notify_all()
+
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def get_due(self, now=None):
+        """ Takes the messages due for an attempt out of the queue, as
+        many as can be in flight, replies first
+        Returns a list of OutboxMessage objects, the outcome of every
+        attempt has to be reported to complete
+
+        """
+        if now is None:
+            now = time.time()
+
+        due = []
+        with self.cond:
+            free = self.max_in_flight - self.in_flight
+            for queue in self.queues:
+                while len(due) < free and queue and queue[0][0] <= now:
+                    due.append(heapq.heappop(queue)[2])
+            self.in_flight += len(due)
+        return due
+
+    def get_wait(self, now=None):
+        """ Returns the number of seconds until the next message is due,
+        None if the queue is empty or no more messages can be in flight
+
+        """
+        if now is None:
+            now = time.time()
+
+        with self.cond:
+            if self.in_flight >= self.max_in_flight:
+                return None
+
+            heads = [q[0][0] for q in self.queues if q]
+            if not heads:
+                return None
+            return max(0, min(heads) - now)
+
+    def complete(self, msg, result):
+        """ Records the outcome of an attempt to send msg, and queues it
+        again if it should be retried
+
+        Parameters
+        ----------
+        msg : OutboxMessage
+            Message returned by get_due
+        result : (int, dict) tuple
+            Status code and decoded body of Telegram's response, None if
+            the request failed
+        """
+        now = time.time()
+        status, data = result if result is not None else (None, None)
+
+        # Network errors, rate limits and server errors are temporary
+        temporary = status is None or status == 429 or status >= 500
+
+        with self.cond:
+            self.in_flight -= 1
+            retried = False
+
+            if status == 200 and msg.rest:
+                # The next part goes out only now, so that it cannot
+                # overtake this one
+                self.stats['sent'] += 1
+                msg.text = msg.rest.pop(0)
+                msg.attempts = 0
+                msg.next_attempt = now
+                self.dirty[msg.id] = msg
+                self.push(msg)
+                retried = True
+
+            elif status == 200:
+                self.stats['sent'] += 1
+                self.latencies.append(now - msg.created)
+                self.forget(msg)
+
+            elif status == 403:
+                self.stats['blocked'] += 1
+                self.forget(msg)
+
+            elif temporary and msg.attempts < self.retries:
+                msg.attempts += 1
+
+                if status == 429:
+                    delay = get_retry_after(data)
+                else:
+                    delay = min(self.max_backoff,
+                                self.backoff * 2 ** (msg.attempts - 1))
+
+                msg.next_attempt = now + delay
+                self.dirty[msg.id] = msg
+                self.push(msg)
+                self.stats['retried'] += 1
+                retried = True
+
+            else:
+                self.stats['failed'] += 1
+                self.forget(msg)
+                print('Dropped message to {} after {} attempts '
+                      '(status {})'.format(msg.chat_id, msg.attempts + 1,
+                                           status))
+
+            if msg.lane == NOTIFICATIONS and not retried:
+                self.finish_broadcast(status == 200)
+
+            self.cond.notify_all()
+
+        if status == 403 and self.on_blocked is not None:
+            self.on_blocked(msg.chat_id)
+
+    def finish_broadcast(self, sent):
+        # Must be called with cond held, for every notification that
+        # was sent or given up on
+        b = self.broadcast
+        if b is None:
+            return
+
+        b[2] += 1
+        if not sent:
+            b[3] += 1
+
+        if b[2] >= b[1]:
+            print('Broadcast of {} messages took {:.2f}s ({} failed)'.format(
+                b[1], time.monotonic() - b[0], b[3]))
+            self.broadcast = None
+
+    def forget(self, msg):
+        # Must be called with cond held
+        self.dirty.pop(msg.id, None)
+        if msg.stored:
+            self.deleted.add(msg.id)
+
+    def flush(self):
+        """ Writes queued and retried messages to the store and deletes
+        the finished ones
+
+        """
+        with self.flush_lock:
+            with self.cond:
+                rows = [m.to_row() for m in self.dirty.values()]
+                for m in self.dirty.values():
+                    m.stored = True
+                deleted = list(self.deleted)
+
+                self.dirty.clear()
+                self.deleted.clear()
+                self.flushed = time.monotonic()
+
+            if rows or deleted:
+                self.store.update_outbox(rows, deleted)
+
+    def flush_if_due(self):
+        """ Flushes if the last flush is flush_interval seconds ago
+
+        """
+        if time.monotonic() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def get_stats(self):
+        """ Returns a dict of delivery statistics: message counts since
+        the start, the number of pending messages, and the median, 95th
+        percentile and maximum latency in seconds of the last deliveries
+
+        """
+        with self.cond:
+            stats = dict(self.stats)
+            stats['pending'] = sum(map(len, self.queues)) + self.in_flight
+            latencies = sorted(self.latencies)
+
+        stats['latency_p50'] = get_percentile(latencies, 50)
+        stats['latency_p95'] = get_percentile(latencies, 95)
+        stats['latency_max'] = latencies[-1] if latencies else None
+        return stats
+
+    def start(self, sender):
+        """ Starts handing due messages to sender in a new thread
+
+        Parameters
+        ----------
+        sender : Broadcaster or ShardedSender
+            Sends messages within the rate limits, see
+            Broadcaster.dispatch
+        """
+        self.running = True
+        self.sender = sender
+        self.thread = threading.Thread(target=self.run, args=(sender,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, sender):
+        """ Hands due messages to the sender and flushes, until stop is
+        called
+
+        """
+        while True:
+            with self.cond:
+                if not self.running:
+                    break
+
+                wait = self.get_wait()
+                if wait is None or wait > self.flush_interval:
+                    wait = self.flush_interval
+                self.cond.wait(wait)
+
+            due = self.get_due()
+            if due:
+                sender.dispatch(due, self.complete)
+
+            self.flush_if_due()
+
+    def stop(self, timeout=5):
+        """ Waits up to timeout seconds for due messages to be sent,
+        stops sending and writes the messages that were not sent to the
+        store. The sender passed to start is closed, see
+        Broadcaster.close: attempts it has not started are cancelled,
+        and the messages being sent are waited for, so that a message
+        sent before quitting is not sent again on the next start
+
+        """
+        if self.thread is not None:
+            deadline = time.monotonic() + timeout
+
+            with self.cond:
+                while self.in_flight or self.get_wait() == 0:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+
+                self.running = False
+                self.cond.notify_all()
+
+            self.thread.join()
+            self.sender.close()
+
+        self.flush()
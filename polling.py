@@ -0,0 +1,101 @@
+import json
+import random
+
+
+class LongPollController:
+    """Chooses the parameters of getUpdates long polls
+
+    The poll timeout is long while the bot is idle, so that an idle bot
+    makes about one request a minute, and short while updates keep
+    coming. When a poll returns a full batch there are more updates
+    waiting, so the next poll does not wait at all. After errors polls
+    back off exponentially, with full jitter
+
+    """
+
+    def __init__(self, idle_timeout=50, busy_timeout=5, limit=100,
+                 backoff=1, max_backoff=60):
+
+        # Poll timeouts in seconds
+        self.idle_timeout = idle_timeout
+        self.busy_timeout = busy_timeout
+
+        # Maximum number of updates per poll
+        self.limit = limit
+
+        # Base and maximum error backoff in seconds
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.timeout = idle_timeout
+        self.failures = 0
+
+    def get_params(self, offset):
+        """ Returns the parameters of the next getUpdates request
+
+        Parameters
+        ----------
+        offset : int
+            One higher than the highest received update_id
+        """
+        return {'offset': offset,
+                'timeout': self.timeout,
+                'limit': self.limit,
+                # Only text messages are handled, skip everything else
+                'allowed_updates': json.dumps(['message'])}
+
+    def get_read_timeout(self, margin):
+        """ Returns a read timeout outlasting the next poll by margin
+        seconds
+
+        """
+        return self.timeout + margin
+
+    def success(self, count):
+        """ Adapts the timeout after a poll returned count updates
+
+        """
+        self.failures = 0
+
+        if count >= self.limit:
+            self.timeout = 0
+        elif count:
+            self.timeout = self.busy_timeout
+        else:
+            self.timeout = self.idle_timeout
+
+    def failure(self, minimum=0):
+        """ Records a failed poll
+        Returns the number of seconds to wait before the next one
+
+        Parameters
+        ----------
+        minimum : float
+            Lower bound of the wait, e.g. the retry_after of a 429
+        """
+        self.failures += 1
+        self.timeout = self.idle_timeout
+
+        cap = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+        return max(minimum, random.uniform(0, cap))
+
+
+def get_offset(updates, offset):
+    """ Returns the offset confirming a batch of updates, one higher than
+    the highest update_id received so far
+
+    """
+    for update in updates:
+        if update['update_id'] >= offset:
+            offset = update['update_id'] + 1
+    return offset
+
+
+def get_confirm_params(offset):
+    """ Returns the parameters of a getUpdates request which only confirms
+    the updates below offset, so that they are not delivered again after
+    a restart
+
+    """
+    # Updates returned by this request are not confirmed themselves
+    return {'offset': offset, 'timeout': 0, 'limit': 1}
@@ -0,0 +1,113 @@
+import marshal
+import sys
+import threading
+import time
+
+
+def get_function(code):
+    """Returns the (file name, line number, function name) tuple pstats
+    identifies a function by
+
+    """
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+class SamplingProfiler:
+    """Profiles every thread of the process by sampling their stacks
+    every interval seconds, without slowing them down like cProfile and
+    without having to start the bot under a profiler
+
+    Times are wall clock times, threads waiting e.g. for a queue or a
+    socket are sampled as well. Call counts are numbers of samples
+
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+
+        # pstats entries, by function: [primitive calls, calls, own
+        # time, cumulative time, {caller: [calls, primitive calls, own
+        # time, cumulative time]}]
+        self.stats = {}
+        self.samples = 0
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """ Starts sampling in a new thread
+
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stops sampling and waits for the last sample
+
+        """
+        self.running = False
+        self.thread.join()
+
+    def run(self):
+        own = threading.get_ident()
+        last = time.perf_counter()
+
+        while self.running:
+            time.sleep(self.interval)
+
+            # Every sample stands for the time since the last one
+            now = time.perf_counter()
+            elapsed, last = now - last, now
+
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.sample(frame, elapsed)
+            self.samples += 1
+
+    def sample(self, frame, elapsed):
+        """ Adds the stack of a thread, from its innermost frame, to the
+        statistics
+
+        """
+        stack = []
+        while frame is not None:
+            stack.append(get_function(frame.f_code))
+            frame = frame.f_back
+
+        seen = set()
+        for i, function in enumerate(stack):
+            entry = self.stats.get(function)
+            if entry is None:
+                entry = self.stats[function] = [0, 0, 0.0, 0.0, {}]
+
+            own = elapsed if i == 0 else 0.0
+            # Recursive functions count once per sample
+            cumulative = elapsed if function not in seen else 0.0
+
+            if function not in seen:
+                entry[0] += 1
+                entry[1] += 1
+            entry[2] += own
+            entry[3] += cumulative
+            seen.add(function)
+
+            if i + 1 < len(stack):
+                caller = entry[4].setdefault(stack[i + 1], [0, 0, 0.0, 0.0])
+                caller[0] += 1
+                caller[1] += 1
+                caller[2] += own
+                caller[3] += cumulative
+
+    def save(self, path):
+        """ Writes the statistics in the format of cProfile, readable
+        with pstats, e.g. python3 -m pstats path
+
+        """
+        stats = {f: (e[0], e[1], e[2], e[3],
+                     {c: tuple(v) for c, v in e[4].items()})
+                 for f, e in self.stats.items()}
+
+        with open(path, 'wb') as f:
+            marshal.dump(stats, f)
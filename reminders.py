@@ -0,0 +1,181 @@
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import utils
+from timerwheel import TimerWheel
+
+
+# Seconds in every duration unit, plain numbers are minutes
+UNITS = {'d': 86400, 'h': 3600, 'm': 60, 's': 1, '': 60}
+
+
+def parse_duration(text):
+    """Returns the number of seconds in a duration such as '10m', '1h30m'
+    or '90s', or None if text is not a valid duration
+
+    """
+    text = text.strip().lower()
+    if not re.fullmatch(r'(\d+ *[dhms]? *)+', text):
+        return None
+    return sum(int(n) * UNITS[u]
+               for n, u in re.findall(r'(\d+) *([dhms]?)', text))
+
+
+def format_duration(seconds):
+    """Returns a duration in seconds as a string such as '1h 30m'
+
+    """
+    if seconds < 60:
+        return '{}s'.format(int(seconds))
+    return utils.timedelta_to_string(timedelta(seconds=seconds))
+
+
+class Reminder:
+    """This class represents a pending reminder of a chat about an
+    expiring alert or deal. The text of the item is kept without its
+    ETA, which is only known when the reminder is sent
+
+    """
+
+    __slots__ = ('chat_id', 'item_id', 'expiry', 'head', 'tail')
+
+    def __init__(self, chat_id, item_id, expiry, head, tail):
+        self.chat_id    = chat_id
+        self.item_id    = item_id
+        self.expiry     = expiry
+        self.head       = head
+        self.tail       = tail
+
+    @classmethod
+    def for_item(cls, chat_id, item):
+        """ Returns the Reminder of a chat about an Alert or Deal
+
+        """
+        head, eta, tail = item.get_parts()
+        return cls(chat_id, str(item.id), item.expiry.timestamp(), head,
+                   tail)
+
+    def get_text(self, now=None):
+        """ Returns the reminder message, with the current ETA
+
+        """
+        if now is None:
+            now = time.time()
+        eta = datetime.fromtimestamp(self.expiry) - \
+            datetime.fromtimestamp(now)
+        return 'Expiring soon!\n\n' + self.head + \
+            utils.timedelta_to_string(eta) + self.tail
+
+    def to_row(self):
+        return (self.chat_id, self.item_id, self.expiry, self.head,
+                self.tail)
+
+
+class Reminders:
+    """Expiry reminders of every chat that asked for them. Pending
+    reminders are timers on a TimerWheel, so tens of thousands of them
+    cost nothing until they are due
+
+    """
+
+    def __init__(self, leads=None, tick=1.0):
+
+        # Seconds before expiry every chat is reminded, by chat ID
+        self.leads = dict(leads) if leads else {}
+
+        # Pending reminders of every chat, by chat ID and item ID
+        self.by_chat = {}
+
+        self.wheel = TimerWheel(tick)
+
+        # Lock for leads, by_chat and wheel, so that they stay consistent
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def get_lead(self, chat_id):
+        """ Returns the seconds before expiry a chat is reminded, None
+        if reminders are off
+
+        """
+        return self.leads.get(chat_id)
+
+    def get_leads(self, chat_ids=None):
+        """ Returns a list of (chat ID, lead) tuples of every chat with
+        reminders, or of the chats in chat_ids
+
+        """
+        with self.lock:
+            if chat_ids is None:
+                return list(self.leads.items())
+            return [(c, self.leads[c]) for c in chat_ids if c in self.leads]
+
+    def set_lead(self, chat_id, lead):
+        """ Enables the reminders of a chat, lead seconds before expiry.
+        Pending reminders of the chat are moved to the new lead
+
+        """
+        with self.lock:
+            self.leads[chat_id] = lead
+            for r in self.by_chat.get(chat_id, {}).values():
+                self.wheel.add((chat_id, r.item_id), r.expiry - lead, r)
+
+    def remove_chat(self, chat_id):
+        """ Disables the reminders of a chat and drops its pending ones
+        Returns False if they were not enabled
+
+        """
+        with self.lock:
+            if chat_id not in self.leads:
+                return False
+            del self.leads[chat_id]
+            for item_id in self.by_chat.pop(chat_id, {}):
+                self.wheel.remove((chat_id, item_id))
+        return True
+
+    def add(self, reminder, now=None):
+        """ Schedules a reminder. Reminders whose time has already come
+        are sent on the next tick
+        Returns False if the item has expired, the chat has no reminders
+        or the reminder is already pending
+
+        """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            lead = self.leads.get(reminder.chat_id)
+            if lead is None or reminder.expiry <= now:
+                return False
+
+            pending = self.by_chat.setdefault(reminder.chat_id, {})
+            if reminder.item_id in pending:
+                return False
+
+            pending[reminder.item_id] = reminder
+            self.wheel.add((reminder.chat_id, reminder.item_id),
+                           reminder.expiry - lead, reminder)
+        return True
+
+    def get_due(self, now=None):
+        """ Advances the wheel to now
+        Returns the list of due reminders of items that have not expired
+        yet, every reminder is only returned once
+
+        """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            fired = self.wheel.advance(now)
+            for (chat_id, item_id), r in fired:
+                pending = self.by_chat.get(chat_id)
+                if pending is not None:
+                    pending.pop(item_id, None)
+                    if not pending:
+                        del self.by_chat[chat_id]
+
+        return [r for key, r in fired if r.expiry > now]
@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+
+class RenderedItem:
+    """The pre-rendered text of an alert, invasion, deal or news item.
+    Only the ETA is computed when the text is spliced
+
+    """
+
+    __slots__ = ('head', 'eta', 'tail', 'expiry', 'rewards')
+
+    def __init__(self, item, expires=False):
+        self.head, self.eta, self.tail = item.get_parts()
+
+        # Items past their expiry are left out when splicing
+        self.expiry = item.expiry if expires else None
+
+        # Rewards, for filtering with per chat watch lists
+        self.rewards = item.get_rewards() if \
+            hasattr(item, 'get_rewards') else []
+
+
+def prerender(items, expires=False):
+    """Returns a list of RenderedItem objects for items
+
+    Parameters
+    ----------
+    items : iterable
+        Alert, Invasion, Deal or News objects
+    expires : bool
+        Whether to leave out items past their expiry when splicing
+    """
+    return [RenderedItem(i, expires) for i in items]
+
+
+def splice(rendered, now=None):
+    """Returns the text of a list of RenderedItem objects with their
+    current ETAs, items separated by blank lines
+
+    Parameters
+    ----------
+    rendered : List of RenderedItem objects
+        Items to be joined
+    now : datetime
+        Current time, defaults to datetime.now()
+    """
+    if now is None:
+        now = datetime.now()
+
+    parts = []
+    for r in rendered:
+        # We only need current items
+        if r.expiry is not None and r.expiry < now:
+            continue
+
+        parts.append(r.head)
+        if r.eta is not None:
+            parts.append(r.eta())
+        parts.append(r.tail)
+        parts.append('\n\n')
+
+    return ''.join(parts)
+
+
+class RenderCache:
+    """A small LRU cache of pre-rendered replies, keyed by feed snapshot
+    version and rendering options
+
+    """
+
+    def __init__(self, size=32):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        """ Returns the cached value for key, calling build to create it
+        on a miss
+
+        Parameters
+        ----------
+        key : hashable
+            Should include the snapshot version of every feed used
+        build : function
+            Returns the value to be cached
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        # Build outside the lock, concurrent misses at worst render twice
+        value = build()
+
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+        return value
@@ -0,0 +1,115 @@
+import time
+
+
+class FeedSchedule:
+    """When a single feed is checked next, and how often
+
+    """
+
+    def __init__(self, interval):
+        # Seconds between checks, adapted to how often the feed changes
+        self.interval = interval
+
+        # Time of the next check, as a Unix timestamp
+        self.next_check = 0
+
+        # Version of the last checked snapshot
+        self.version = None
+
+
+class NotificationScheduler:
+    """Plans the checks of the notified feeds. Every feed is checked
+    more often while it keeps changing and less often while it does not,
+    and checks can be planned ahead for times a feed is known to change,
+    e.g. when an alert expires
+
+    """
+
+    def __init__(self, names, interval=60, min_interval=15,
+                 max_interval=180, speedup=2, slowdown=1.25):
+        """
+        Parameters
+        ----------
+        names : iterable of str
+            Names of the scheduled feeds
+        interval : float
+            Initial number of seconds between checks of every feed
+        min_interval, max_interval : float
+            Bounds of the intervals
+        speedup : float
+            Factor the interval of a feed is divided by when it changed
+        slowdown : float
+            Factor the interval of a feed is multiplied by when it did not
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.speedup = speedup
+        self.slowdown = slowdown
+
+        self.feeds = {n: FeedSchedule(interval) for n in names}
+
+    def get_due(self, now=None):
+        """ Returns the names of the feeds that should be checked now
+
+        """
+        now = now if now is not None else time.time()
+        return [n for n, f in self.feeds.items() if f.next_check <= now]
+
+    def get_wait(self, now=None):
+        """ Returns the number of seconds until the next check is due
+
+        """
+        now = now if now is not None else time.time()
+        next_check = min(f.next_check for f in self.feeds.values())
+        return max(0, next_check - now)
+
+    def update(self, name, version, now=None):
+        """ Adapts the interval of a feed after a successful check and
+        schedules its next check
+
+        Parameters
+        ----------
+        name : str
+            Name of the feed
+        version : int
+            Version of the checked snapshot
+        """
+        now = now if now is not None else time.time()
+        f = self.feeds[name]
+
+        # The first check only tells us the current version
+        if f.version is not None:
+            if version != f.version:
+                f.interval = max(self.min_interval, f.interval / self.speedup)
+            else:
+                f.interval = min(self.max_interval,
+                                 f.interval * self.slowdown)
+
+        f.version = version
+        f.next_check = now + f.interval
+
+    def fail(self, name, now=None):
+        """ Schedules a feed that could not be checked for a retry
+
+        """
+        now = now if now is not None else time.time()
+        self.feeds[name].next_check = now + self.min_interval
+
+    def postpone(self, name, now=None):
+        """ Skips a due check of a feed nobody needs right now, keeping
+        its interval
+
+        """
+        now = now if now is not None else time.time()
+        f = self.feeds[name]
+        f.next_check = now + f.interval
+
+    def plan(self, name, at, now=None):
+        """ Moves the next check of a feed forward to the Unix timestamp
+        at, if it is in the future and earlier than the planned check
+
+        """
+        now = now if now is not None else time.time()
+        f = self.feeds[name]
+        if now < at < f.next_check:
+            f.next_check = at
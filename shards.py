@@ -0,0 +1,234 @@
+import multiprocessing
+import queue
+import threading
+
+import requests
+
+from broadcast import Broadcaster, get_retry_after, get_send_params
+from connection import ConnectionPool
+from metrics import record_send
+
+
+def run_shard(settings, tasks, results):
+    """Runs in a worker process and sends the messages of one shard
+    with its own connection pool and Broadcaster, until None is received
+    from tasks
+
+    Parameters
+    ----------
+    settings : dict
+        Keyword arguments of ShardedSender describing the shard
+    tasks : multiprocessing.Queue
+        Receives lists of (text, options, [(message ID, chat ID), ...])
+        batches, or ('pause', seconds) tuples
+    results : multiprocessing.Queue
+        Lists of (message ID, result, seconds) tuples are sent back
+        through it, see Broadcaster.attempt. seconds is the duration of
+        the request, recorded by the parent process
+    """
+    http = ConnectionPool(settings['pool_size'], settings['connect_timeout'],
+                          settings['read_timeout'], settings['retries'])
+    url = settings['api_url'] + 'sendMessage'
+
+    def send(recipient, message, **options):
+        p = get_send_params(recipient, message, **options)
+        try:
+            return http.post(url, params=p)
+        except requests.exceptions.RequestException as e:
+            print('Error sending message to {}: {}'.format(recipient, e))
+            return None
+
+    broadcaster = Broadcaster(send, settings['workers'], settings['rate'],
+                              settings['chat_interval'])
+
+    # Duration of the last request of every sender thread, metrics are
+    # only exposed by the parent process
+    sent = threading.local()
+
+    def on_sent(seconds, result):
+        sent.seconds = seconds
+
+    broadcaster.on_sent = on_sent
+
+    # Results of single attempts, forwarded to results in batches
+    done = queue.Queue()
+
+    def attempt(msg_id, chat_id, text, options):
+        sent.seconds = 0.0
+        try:
+            result = broadcaster.attempt(chat_id, text, options)
+        except Exception as e:
+            print('Unhandled error sending to {}: {!r}'.format(chat_id, e))
+            result = None
+        done.put((msg_id, result, sent.seconds))
+
+    def forward():
+        batch = []
+        while True:
+            try:
+                item = done.get(timeout=0.05 if batch else None)
+            except queue.Empty:
+                results.put(batch)
+                batch = []
+                continue
+
+            if item is None:
+                break
+
+            batch.append(item)
+            if len(batch) >= 100:
+                results.put(batch)
+                batch = []
+
+        if batch:
+            results.put(batch)
+
+    forwarder = threading.Thread(target=forward)
+    forwarder.start()
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        if task[0] == 'pause':
+            broadcaster.bucket.pause(task[1])
+            continue
+
+        for text, options, targets in task:
+            for msg_id, chat_id in targets:
+                broadcaster.executor.submit(attempt, msg_id, chat_id, text,
+                                            options)
+
+    # Let the running attempts finish before reporting the last results,
+    # the others stay in the parent's outbox
+    broadcaster.close()
+    done.put(None)
+    forwarder.join()
+    http.close()
+
+
+class ShardedSender:
+    """Sends messages from a pool of worker processes, each owning the
+    chats whose ID falls in its shard. Every text is handed to a shard
+    once, with all the chats it goes to, so encoding, TLS and the
+    requests overhead are spread over all cores
+
+    Telegram's global rate limit applies to the bot as a whole, so it is
+    split evenly between the shards, and a 429 received by one shard
+    pauses all of them
+
+    """
+
+    def __init__(self, shards, api_url, rate=30, chat_interval=1.0,
+                 workers=16, pool_size=10, connect_timeout=5,
+                 read_timeout=15, retries=3):
+
+        self.shards = shards
+
+        # Messages handed to a shard, by message ID
+        self.pending = {}
+        self.complete = {}
+        self.lock = threading.Lock()
+
+        settings = {'api_url': api_url, 'rate': rate / shards,
+                    'chat_interval': chat_interval, 'workers': workers,
+                    'pool_size': pool_size,
+                    'connect_timeout': connect_timeout,
+                    'read_timeout': read_timeout, 'retries': retries}
+
+        # Worker processes are spawned, forking a process running
+        # threads is not safe
+        context = multiprocessing.get_context('spawn')
+
+        self.results = context.Queue()
+        self.tasks = []
+        self.processes = []
+
+        for i in range(shards):
+            tasks = context.Queue()
+            p = context.Process(target=run_shard,
+                                args=(settings, tasks, self.results),
+                                name='shard-{}'.format(i))
+            p.daemon = True
+            p.start()
+
+            self.tasks.append(tasks)
+            self.processes.append(p)
+
+        self.collector = threading.Thread(target=self.collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def get_shard(self, chat_id):
+        """ Returns the index of the shard owning a chat
+
+        """
+        return chat_id % self.shards
+
+    def dispatch(self, messages, complete):
+        """ Hands every message to the shard of its chat, without
+        waiting, see Broadcaster.dispatch
+
+        """
+        # Targets of every text and options, by shard
+        batches = [{} for _ in range(self.shards)]
+
+        with self.lock:
+            for msg in messages:
+                self.pending[msg.id] = msg
+                self.complete[msg.id] = complete
+
+                key = (msg.text, tuple(sorted(msg.options.items())))
+                batches[self.get_shard(msg.chat_id)].setdefault(
+                    key, []).append((msg.id, msg.chat_id))
+
+        for tasks, batch in zip(self.tasks, batches):
+            if batch:
+                tasks.put([(text, dict(options), targets)
+                           for (text, options), targets in batch.items()])
+
+    def collect(self):
+        """ Runs in a separate thread and reports the results of the
+        shards, until None is received
+
+        """
+        while True:
+            batch = self.results.get()
+            if batch is None:
+                break
+
+            for msg_id, result, seconds in batch:
+                record_send(seconds, result)
+
+                with self.lock:
+                    msg = self.pending.pop(msg_id)
+                    complete = self.complete.pop(msg_id)
+
+                # Pause the other shards as well
+                if result is not None and result[0] == 429:
+                    self.pause(get_retry_after(result[1]))
+
+                complete(msg, result)
+
+    def pause(self, seconds):
+        """ Stops every shard from sending for the specified number of
+        seconds
+
+        """
+        for tasks in self.tasks:
+            tasks.put(('pause', seconds))
+
+    def close(self):
+        """ Stops the shards once they have finished the messages they
+        are sending, the messages they have not started are never
+        reported to complete
+
+        """
+        for tasks in self.tasks:
+            tasks.put(None)
+        for p in self.processes:
+            p.join()
+
+        self.results.put(None)
+        self.collector.join()
@@ -0,0 +1,358 @@
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id     INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS chat_settings (
+    chat_id     INTEGER PRIMARY KEY,
+    language    TEXT,
+    platform    TEXT,
+    mute_start  INTEGER,
+    mute_end    INTEGER
+);
+CREATE TABLE IF NOT EXISTS filters (
+    chat_id     INTEGER NOT NULL,
+    reward_key  TEXT NOT NULL,
+    reward      TEXT NOT NULL,
+    PRIMARY KEY (chat_id, reward_key)
+);
+CREATE TABLE IF NOT EXISTS seen (
+    kind        TEXT NOT NULL,
+    item_id     TEXT NOT NULL,
+    deadline    REAL NOT NULL,
+    PRIMARY KEY (kind, item_id)
+);
+CREATE TABLE IF NOT EXISTS reminder_chats (
+    chat_id     INTEGER PRIMARY KEY,
+    lead        REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reminders (
+    chat_id     INTEGER NOT NULL,
+    item_id     TEXT NOT NULL,
+    expiry      REAL NOT NULL,
+    head        TEXT NOT NULL,
+    tail        TEXT NOT NULL,
+    PRIMARY KEY (chat_id, item_id)
+);
+CREATE TABLE IF NOT EXISTS feeds (
+    url             TEXT PRIMARY KEY,
+    content         BLOB NOT NULL,
+    etag            TEXT,
+    last_modified   TEXT,
+    saved           REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id              INTEGER PRIMARY KEY,
+    chat_id         INTEGER NOT NULL,
+    text            TEXT NOT NULL,
+    options         TEXT NOT NULL,
+    created         REAL NOT NULL,
+    attempts        INTEGER NOT NULL,
+    next_attempt    REAL NOT NULL,
+    rest            TEXT NOT NULL
+);
+'''
+
+
+class StateStore:
+    """Persistent program state, kept in a SQLite database in WAL mode
+
+    Every change is written as its own small transaction as soon as it
+    happens, so a crash loses nothing that was acknowledged. Expired rows
+    are purged and the WAL is truncated by compact
+
+    """
+
+    def __init__(self, path, compact_interval=3600):
+
+        self.path = path
+
+        # Minimum number of seconds between two compactions
+        self.compact_interval = compact_interval
+        self.compacted = time.monotonic()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+        # Lock for conn, shared by command workers and the notifier
+        self.lock = threading.Lock()
+
+        with self.lock:
+            # In WAL mode with synchronous=NORMAL a commit costs no fsync,
+            # committed data still survives a crash of the process
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+
+            # True if the database has just been created
+            self.is_new = self.conn.execute(
+                'SELECT count(*) FROM sqlite_master').fetchone()[0] == 0
+
+            self.conn.executescript(SCHEMA)
+
+    def execute(self, sql, params=()):
+        """ Runs a single statement in its own transaction
+
+        """
+        with self.lock, self.conn:
+            self.conn.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        """ Runs a statement once for every row, in a single transaction
+
+        """
+        with self.lock, self.conn:
+            self.conn.executemany(sql, rows)
+
+    def query(self, sql, params=()):
+        """ Returns all rows selected by a query
+
+        """
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def add_chat(self, chat_id):
+        """ Records a chat with active notifications
+
+        """
+        self.execute('INSERT OR IGNORE INTO chats VALUES (?)', (chat_id,))
+
+    def remove_chat(self, chat_id):
+        """ Forgets a chat with active notifications
+
+        """
+        self.execute('DELETE FROM chats WHERE chat_id = ?', (chat_id,))
+
+    def get_chats(self):
+        """ Returns the list of chats with active notifications
+
+        """
+        return [r[0] for r in self.query('SELECT chat_id FROM chats')]
+
+    def set_chat_settings(self, row):
+        """ Records the settings of a chat
+
+        Parameters
+        ----------
+        row : tuple
+            (chat ID, language, platform, mute start, mute end)
+        """
+        self.execute('INSERT OR REPLACE INTO chat_settings '
+                     'VALUES (?, ?, ?, ?, ?)', row)
+
+    def remove_chat_settings(self, chat_id):
+        """ Forgets the settings of a chat
+
+        """
+        self.execute('DELETE FROM chat_settings WHERE chat_id = ?',
+                     (chat_id,))
+
+    def get_chat_settings(self):
+        """ Returns the settings of every chat as a dict of chat ID ->
+        (language, platform, mute start, mute end) tuple
+
+        """
+        return {r[0]: r[1:] for r in self.query(
+            'SELECT chat_id, language, platform, mute_start, mute_end '
+            'FROM chat_settings')}
+
+    def add_filter(self, chat_id, reward_key, reward):
+        """ Records a reward watched by a chat
+
+        """
+        self.execute('INSERT OR REPLACE INTO filters VALUES (?, ?, ?)',
+                     (chat_id, reward_key, reward))
+
+    def remove_filter(self, chat_id, reward_key):
+        """ Forgets a reward watched by a chat
+
+        """
+        self.execute('DELETE FROM filters WHERE chat_id = ? AND '
+                     'reward_key = ?', (chat_id, reward_key))
+
+    def get_filters(self):
+        """ Returns the watch lists as a dict of chat ID -> list of rewards
+
+        """
+        filters = {}
+        for chat_id, reward in self.query('SELECT chat_id, reward '
+                                          'FROM filters'):
+            filters.setdefault(chat_id, []).append(reward)
+        return filters
+
+    def update_seen(self, kind, deadlines, evicted=()):
+        """ Records tracked IDs of one kind with their deadlines and
+        forgets evicted ones
+
+        Parameters
+        ----------
+        kind : str
+            Kind of tracked items, e.g. 'alerts'
+        deadlines : dict
+            ID -> deadline of tracked IDs
+        evicted : iterable
+            IDs that are no longer tracked
+        """
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO seen VALUES (?, ?, ?)',
+                ((kind, str(i), d) for i, d in deadlines.items()))
+            self.conn.executemany(
+                'DELETE FROM seen WHERE kind = ? AND item_id = ?',
+                ((kind, str(i)) for i in evicted))
+
+    def get_seen(self, kind):
+        """ Returns tracked IDs of one kind as a dict of ID -> deadline
+
+        """
+        return dict(self.query('SELECT item_id, deadline FROM seen '
+                               'WHERE kind = ?', (kind,)))
+
+    def set_reminder_lead(self, chat_id, lead):
+        """ Records the seconds before expiry a chat is reminded
+
+        """
+        self.execute('INSERT OR REPLACE INTO reminder_chats VALUES (?, ?)',
+                     (chat_id, lead))
+
+    def remove_reminder_chat(self, chat_id):
+        """ Forgets a chat with reminders and its pending reminders
+
+        """
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM reminder_chats WHERE chat_id = ?',
+                              (chat_id,))
+            self.conn.execute('DELETE FROM reminders WHERE chat_id = ?',
+                              (chat_id,))
+
+    def get_reminder_leads(self):
+        """ Returns a dict of chat ID -> seconds before expiry of every
+        chat with reminders
+
+        """
+        return dict(self.query('SELECT chat_id, lead FROM reminder_chats'))
+
+    def add_reminders(self, reminders):
+        """ Records pending reminders
+
+        Parameters
+        ----------
+        reminders : iterable of Reminder objects
+        """
+        self.executemany('INSERT OR REPLACE INTO reminders '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (r.to_row() for r in reminders))
+
+    def remove_reminders(self, reminders):
+        """ Forgets sent reminders
+
+        Parameters
+        ----------
+        reminders : iterable of Reminder objects
+        """
+        self.executemany('DELETE FROM reminders WHERE chat_id = ? AND '
+                         'item_id = ?',
+                         ((r.chat_id, r.item_id) for r in reminders))
+
+    def get_reminders(self):
+        """ Returns the pending reminders as a list of (chat ID, item ID,
+        expiry, head, tail) tuples
+
+        """
+        return self.query('SELECT chat_id, item_id, expiry, head, tail '
+                          'FROM reminders')
+
+    def update_outbox(self, rows, deleted):
+        """ Records queued or retried messages and forgets finished ones,
+        in a single transaction
+
+        Parameters
+        ----------
+        rows : iterable of tuples
+            (ID, chat ID, text, options, created, attempts, next attempt,
+            rest) of every message to be written
+        deleted : iterable of int
+            IDs of messages that are no longer queued
+        """
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO outbox VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                rows)
+            self.conn.executemany('DELETE FROM outbox WHERE id = ?',
+                                  ((i,) for i in deleted))
+
+    def get_outbox(self):
+        """ Returns the queued messages as a list of (ID, chat ID, text,
+        options, created, attempts, next attempt, rest) tuples
+
+        """
+        return self.query('SELECT id, chat_id, text, options, created, '
+                          'attempts, next_attempt, rest FROM outbox '
+                          'ORDER BY id')
+
+    def set_feed(self, row):
+        """ Records the last content of a feed
+
+        Parameters
+        ----------
+        row : tuple
+            (URL, content, ETag, Last-Modified, Unix time it was saved at)
+        """
+        self.execute('INSERT OR REPLACE INTO feeds VALUES (?, ?, ?, ?, ?)',
+                     row)
+
+    def touch_feed(self, url, etag, last_modified, saved):
+        """ Records that the saved content of a feed is still current
+
+        Parameters
+        ----------
+        url : str
+            URL of the feed
+        etag : str
+            ETag of the last response, or None
+        last_modified : str
+            Last-Modified of the last response, or None
+        saved : float
+            Unix time the content was revalidated at
+        """
+        self.execute('UPDATE feeds SET etag = ?, last_modified = ?, '
+                     'saved = ? WHERE url = ?',
+                     (etag, last_modified, saved, url))
+
+    def get_feed(self, url):
+        """ Returns the last content of a feed as a (content, ETag,
+        Last-Modified, Unix time it was saved at) tuple, None if it was
+        never saved
+
+        """
+        rows = self.query('SELECT content, etag, last_modified, saved '
+                          'FROM feeds WHERE url = ?', (url,))
+        return rows[0] if rows else None
+
+    def compact(self, force=False):
+        """ Purges expired rows and truncates the WAL, at most once every
+        compact_interval seconds unless force is True
+
+        """
+        if not force and \
+                time.monotonic() - self.compacted < self.compact_interval:
+            return
+
+        self.compacted = time.monotonic()
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM seen WHERE deadline < ?', (now,))
+            self.conn.execute('DELETE FROM reminders WHERE expiry < ?',
+                              (now,))
+        with self.lock:
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        """ Compacts and closes the database
+
+        """
+        self.compact(force=True)
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,186 @@
+import threading
+
+
+class ChatSettings:
+    """Settings of a single chat. Instances are never modified, a changed
+    setting replaces the whole object
+
+    """
+
+    __slots__ = ('language', 'platform', 'mute_start', 'mute_end')
+
+    def __init__(self, language=None, platform=None, mute_start=None,
+                 mute_end=None):
+        # IETF language tag of the chat's user, e.g. 'en'
+        self.language   = language
+
+        # Game platform, None for the default one
+        self.platform   = platform
+
+        # Minutes after midnight notifications are muted between, the
+        # window may wrap around midnight
+        self.mute_start = mute_start
+        self.mute_end   = mute_end
+
+    def replace(self, **fields):
+        """ Returns a copy of these settings with some fields replaced
+
+        """
+        values = {f: getattr(self, f) for f in ChatSettings.__slots__}
+        values.update(fields)
+        return ChatSettings(**values)
+
+    def is_default(self):
+        return all(getattr(self, f) is None for f in ChatSettings.__slots__)
+
+    def is_muted(self, minute):
+        """ Returns True if notifications are muted at the specified
+        minute after midnight
+
+        """
+        if self.mute_start is None or self.mute_end is None:
+            return False
+        if self.mute_start <= self.mute_end:
+            return self.mute_start <= minute < self.mute_end
+        return minute >= self.mute_start or minute < self.mute_end
+
+    def to_row(self, chat_id):
+        return (chat_id, self.language, self.platform, self.mute_start,
+                self.mute_end)
+
+
+# Settings of chats without any
+DEFAULT_SETTINGS = ChatSettings()
+
+
+class SubscriberRegistry:
+    """The chats with active notifications and the settings of every
+    chat
+
+    Chats are kept in a set, so adding and removing one costs O(1).
+    Readers get an immutable snapshot of the chats, a tuple rebuilt
+    lazily after changes, which they can iterate for as long as they like
+    without holding any lock. Only chats with non-default settings have
+    a ChatSettings object, so memory grows with the number of chat IDs
+    alone
+
+    """
+
+    def __init__(self, chats=(), settings=None):
+
+        # IDs of chats with active notifications
+        self.chats = set(chats)
+
+        # Non-default settings, by chat ID
+        self.settings = dict(settings) if settings else {}
+
+        # Tuple of the chats, None after a change
+        self.cached_snapshot = None
+
+        # Lock for all of the above
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.chats)
+
+    def __contains__(self, chat_id):
+        return chat_id in self.chats
+
+    def add(self, chat_id):
+        """ Adds a chat
+        Returns False if it was already there
+
+        """
+        with self.lock:
+            if chat_id in self.chats:
+                return False
+            self.chats.add(chat_id)
+            self.cached_snapshot = None
+            return True
+
+    def remove(self, chat_id):
+        """ Removes a chat
+        Returns False if it was not there
+
+        """
+        with self.lock:
+            if chat_id not in self.chats:
+                return False
+            self.chats.discard(chat_id)
+            self.cached_snapshot = None
+            return True
+
+    def snapshot(self):
+        """ Returns a tuple of the IDs of all chats, which later changes
+        do not affect
+
+        """
+        snapshot = self.cached_snapshot
+        if snapshot is None:
+            with self.lock:
+                if self.cached_snapshot is None:
+                    self.cached_snapshot = tuple(self.chats)
+                snapshot = self.cached_snapshot
+        return snapshot
+
+    def get_settings(self, chat_id):
+        """ Returns the ChatSettings of a chat
+
+        """
+        return self.settings.get(chat_id, DEFAULT_SETTINGS)
+
+    def update_settings(self, chat_id, **fields):
+        """ Changes some settings of a chat
+        Returns the new ChatSettings
+
+        Parameters
+        ----------
+        chat_id : int
+            ID of the chat
+        fields : dict
+            New values of ChatSettings fields, None resets a field
+        """
+        with self.lock:
+            settings = self.settings.get(chat_id, DEFAULT_SETTINGS)
+            settings = settings.replace(**fields)
+
+            if settings.is_default():
+                self.settings.pop(chat_id, None)
+            else:
+                self.settings[chat_id] = settings
+
+        return settings
+
+    def get_platform(self, chat_id, default=None):
+        """ Returns the game platform of a chat, default if it has not
+        chosen one
+
+        """
+        platform = self.get_settings(chat_id).platform
+        return platform if platform is not None else default
+
+    def group_by_platform(self, chats, default=None):
+        """ Returns a dict of platform -> list of the IDs in chats on that
+        platform, chats without a platform are on default
+
+        """
+        with self.lock:
+            settings = self.settings
+
+            groups = {}
+            for c in chats:
+                s = settings.get(c)
+                platform = s.platform if s is not None and \
+                    s.platform is not None else default
+                groups.setdefault(platform, []).append(c)
+
+        return groups
+
+    def get_muted(self, minute):
+        """ Returns the set of chats whose notifications are muted at the
+        specified minute after midnight
+
+        """
+        with self.lock:
+            settings = list(self.settings.items())
+        return {c for c, s in settings if s.is_muted(minute)}
@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broadcast import TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_reserve_within_capacity(self):
+        bucket = TokenBucket(15)
+
+        for _ in range(15):
+            self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 1 / 15, places=2)
+
+    def test_pause(self):
+        bucket = TokenBucket(15)
+        bucket.pause(1)
+
+        self.assertAlmostEqual(bucket.reserve(), 1 + 1 / 15, places=2)
+
+    def test_pause_after_idle_period(self):
+        bucket = TokenBucket(15)
+        # As if the bucket had been idle for 2 seconds
+        bucket.updated -= 2
+        bucket.pause(1)
+
+        self.assertAlmostEqual(bucket.reserve(), 1 + 1 / 15, places=2)
+
+    def test_pause_keeps_larger_debt(self):
+        bucket = TokenBucket(15)
+        for _ in range(45):
+            bucket.reserve()
+        bucket.pause(1)
+
+        self.assertGreater(bucket.reserve(), 1.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
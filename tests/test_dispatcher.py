@@ -0,0 +1,83 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dispatcher import Dispatcher
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handled = []
+        self.lock = threading.Lock()
+
+    def handler(self, item):
+        if item.startswith('slow'):
+            time.sleep(0.3)
+        with self.lock:
+            self.handled.append(item)
+
+    def test_same_key_in_order(self):
+        dispatcher = Dispatcher(self.handler, workers=2, timeout=1)
+        dispatcher.start()
+        for i in range(20):
+            dispatcher.submit(1, str(i))
+        dispatcher.stop()
+
+        self.assertEqual(self.handled, [str(i) for i in range(20)])
+
+    def test_timed_out_handler_not_overtaken(self):
+        dispatcher = Dispatcher(self.handler, workers=1, timeout=0.2)
+        dispatcher.start()
+        dispatcher.submit(1, 'slow')
+        dispatcher.submit(1, 'fast')
+        dispatcher.stop()
+
+        self.assertEqual(self.handled, ['slow', 'fast'])
+
+    def test_timed_out_handler_does_not_block_other_keys(self):
+        dispatcher = Dispatcher(self.handler, workers=1, timeout=0.2)
+        dispatcher.start()
+        dispatcher.submit(1, 'slow')
+        dispatcher.submit(1, 'after slow')
+        dispatcher.submit(2, 'other')
+        dispatcher.stop()
+
+        self.assertLess(self.handled.index('other'),
+                        self.handled.index('slow'))
+        self.assertLess(self.handled.index('slow'),
+                        self.handled.index('after slow'))
+
+    def test_resumes_after_timed_out_handler(self):
+        dispatcher = Dispatcher(self.handler, workers=1, timeout=0.2)
+        dispatcher.start()
+        dispatcher.submit(1, 'slow')
+        dispatcher.submit(1, 'after slow')
+
+        # The held back item is handled without waiting for stop
+        time.sleep(0.6)
+        with self.lock:
+            self.assertEqual(self.handled, ['slow', 'after slow'])
+        dispatcher.stop()
+
+    def test_timeout_starts_with_handler(self):
+        # More hung handlers than threads, the last ones must wait for a
+        # thread without timing out and running out of order later
+        dispatcher = Dispatcher(self.handler, workers=1, timeout=0.2)
+        dispatcher.start()
+        for key in range(4):
+            dispatcher.submit(key, 'slow {}'.format(key))
+            dispatcher.submit(key, 'fast {}'.format(key))
+        dispatcher.stop()
+
+        for key in range(4):
+            self.assertLess(self.handled.index('slow {}'.format(key)),
+                            self.handled.index('fast {}'.format(key)))
+
+
+if __name__ == '__main__':
+    unittest.main()
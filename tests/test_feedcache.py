@@ -0,0 +1,87 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from feedcache import FeedCache
+from statestore import StateStore
+
+URL = 'http://example.com/feed'
+
+
+class Response:
+
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+def parse(r):
+    return r.content.decode()
+
+
+class FeedCacheStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = StateStore(os.path.join(self.dir.name, 'state.db'))
+        self.cache = FeedCache(None, state_store=self.store)
+
+    def tearDown(self):
+        self.cache.close()
+        self.store.close()
+        self.dir.cleanup()
+
+    def save_old(self):
+        snapshot = self.cache.make_snapshot(URL, parse, None,
+                                            Response(200, b'feed',
+                                                     {'ETag': '"1"'}))
+        self.store.execute('UPDATE feeds SET saved = 0')
+        return snapshot
+
+    def test_new_content_is_saved(self):
+        self.cache.make_snapshot(URL, parse, None,
+                                 Response(200, b'feed', {'ETag': '"1"'}))
+
+        content, etag, last_modified, saved = self.store.get_feed(URL)
+        self.assertEqual(content, b'feed')
+        self.assertEqual(etag, '"1"')
+        self.assertGreater(saved, 0)
+
+    def test_not_modified_updates_saved(self):
+        previous = self.save_old()
+        self.cache.make_snapshot(URL, parse, previous,
+                                 Response(304, headers={'ETag': '"2"'}))
+
+        content, etag, last_modified, saved = self.store.get_feed(URL)
+        self.assertEqual(content, b'feed')
+        self.assertEqual(etag, '"2"')
+        self.assertGreater(saved, 0)
+
+    def test_same_content_updates_saved(self):
+        previous = self.save_old()
+        self.cache.make_snapshot(URL, parse, previous,
+                                 Response(200, b'feed',
+                                          {'Last-Modified': 'today'}))
+
+        content, etag, last_modified, saved = self.store.get_feed(URL)
+        self.assertEqual(content, b'feed')
+        self.assertIsNone(etag)
+        self.assertEqual(last_modified, 'today')
+        self.assertGreater(saved, 0)
+
+    def test_restore_after_revalidation(self):
+        previous = self.save_old()
+        self.cache.make_snapshot(URL, parse, previous, Response(304))
+
+        cache = FeedCache(None, state_store=self.store)
+        cache.restore(URL, parse)
+        self.assertTrue(cache.is_fresh(URL, cache.snapshots.get(URL)))
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
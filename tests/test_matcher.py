@@ -0,0 +1,95 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matcher import Automaton, RewardMatcher, normalize
+
+
+class NormalizeTest(unittest.TestCase):
+
+    def test_case_spaces_and_counts(self):
+        self.assertEqual(normalize('  Orokin   Catalyst '), 'orokin catalyst')
+        self.assertEqual(normalize('3 x Fieldron'), 'fieldron')
+        self.assertEqual(normalize('Nitain Extract x2'), 'nitain extract')
+
+
+class AutomatonTest(unittest.TestCase):
+
+    def test_overlapping_fragments(self):
+        automaton = Automaton(['he', 'she', 'his', 'hers'])
+
+        self.assertEqual(sorted(automaton.search('ushers')),
+                         [(4, 0), (4, 1), (6, 3)])
+
+    def test_no_match(self):
+        self.assertEqual(Automaton(['abc']).search('abd ab'), [])
+
+
+class RewardMatcherTest(unittest.TestCase):
+
+    def test_exact(self):
+        matcher = RewardMatcher(['Orokin Catalyst'])
+
+        self.assertIn('orokin  catalyst', matcher)
+        self.assertIn('2 x Orokin Catalyst', matcher)
+        self.assertNotIn('Orokin Catalyst Blueprint', matcher)
+
+    def test_prefix(self):
+        matcher = RewardMatcher(['Vandal *'])
+
+        self.assertIn('Vandal Prime Receiver', matcher)
+        self.assertNotIn('Vandalism', matcher)
+        self.assertNotIn('Dera Vandal Barrel', matcher)
+
+    def test_suffix(self):
+        matcher = RewardMatcher(['* Helmet Blueprint'])
+
+        self.assertIn('Rhino Helmet Blueprint', matcher)
+        self.assertNotIn('Helmet Blueprint', matcher)
+        self.assertNotIn('Rhino Helmet Blueprint x2 extra', matcher)
+
+    def test_suffix_without_space(self):
+        matcher = RewardMatcher(['*Helmet Blueprint'])
+
+        self.assertIn('Rhino Helmet Blueprint', matcher)
+        self.assertIn('SuperHelmet Blueprint', matcher)
+
+    def test_infix(self):
+        matcher = RewardMatcher(['* Vandal *'])
+
+        self.assertIn('Dera Vandal Barrel', matcher)
+        self.assertNotIn('Dera Vandalism Barrel', matcher)
+        self.assertNotIn('Vandal Receiver', matcher)
+
+    def test_whitespace_inside_fragment(self):
+        matcher = RewardMatcher(['Vandal   Prime  *'])
+
+        self.assertIn('vandal prime receiver', matcher)
+        self.assertNotIn('vandal primer', matcher)
+
+    def test_fragments_in_order(self):
+        matcher = RewardMatcher(['*a*b*'])
+
+        self.assertIn('xaxbx', matcher)
+        self.assertNotIn('xbxax', matcher)
+
+    def test_fragments_do_not_overlap(self):
+        matcher = RewardMatcher(['aba*bab'])
+
+        self.assertIn('ababab', matcher)
+        self.assertNotIn('abab', matcher)
+
+    def test_wildcard_only(self):
+        self.assertIn('anything', RewardMatcher(['*']))
+
+    def test_no_patterns(self):
+        matcher = RewardMatcher([])
+
+        self.assertEqual(len(matcher), 0)
+        self.assertNotIn('Orokin Catalyst', matcher)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from outbox import Outbox, REPLIES
+from statestore import StateStore
+
+SENT = (200, {'ok': True})
+RATE_LIMITED = (429, {'parameters': {'retry_after': 3}})
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'state.db')
+        self.store = StateStore(self.path)
+        self.outbox = Outbox(self.store)
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def test_replies_before_notifications(self):
+        self.outbox.put([(1, 'notification')])
+        self.outbox.put([(2, 'reply')], REPLIES)
+
+        due = self.outbox.get_due()
+        self.assertEqual([m.text for m in due], ['reply', 'notification'])
+
+    def test_parts_sent_in_order(self):
+        self.outbox.put([(1, ['part 1', 'part 2', 'part 3'])], REPLIES)
+
+        texts = []
+        for _ in range(3):
+            due = self.outbox.get_due()
+            self.assertEqual(len(due), 1)
+            texts.append(due[0].text)
+            self.outbox.complete(due[0], SENT)
+
+        self.assertEqual(texts, ['part 1', 'part 2', 'part 3'])
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(self.outbox.stats['sent'], 3)
+
+    def test_next_part_waits_for_retry(self):
+        self.outbox.put([(1, ['part 1', 'part 2'])], REPLIES)
+
+        msg, = self.outbox.get_due()
+        self.outbox.complete(msg, RATE_LIMITED)
+
+        self.assertEqual(self.outbox.get_due(), [])
+        msg, = self.outbox.get_due(msg.next_attempt)
+        self.assertEqual(msg.text, 'part 1')
+
+    def test_blocked_chat_drops_remaining_parts(self):
+        self.outbox.put([(1, ['part 1', 'part 2'])], REPLIES)
+
+        msg, = self.outbox.get_due()
+        self.outbox.complete(msg, (403, None))
+
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_remaining_parts_survive_restart(self):
+        self.outbox.put([(1, ['part 1', 'part 2', 'part 3'])], REPLIES)
+        msg, = self.outbox.get_due()
+        self.outbox.complete(msg, SENT)
+        self.outbox.flush()
+
+        outbox = Outbox(self.store)
+        msg, = outbox.get_due()
+        self.assertEqual((msg.text, msg.rest), ('part 2', ['part 3']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timerwheel import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def test_fires_at_deadline(self):
+        wheel = TimerWheel(1.0, slots=60)
+        wheel.add('a', 105, 'payload')
+
+        self.assertEqual(wheel.advance(104), [])
+        self.assertEqual(wheel.advance(105), [('a', 'payload')])
+        self.assertEqual(len(wheel), 0)
+
+    def test_deadline_inside_advanced_tick(self):
+        # The tick of 101.5 contains the deadline, the timer must still
+        # be looked at on the next advance
+        wheel = TimerWheel(5.0, slots=60)
+        wheel.add('a', 103)
+
+        self.assertEqual(wheel.advance(101.5), [])
+        self.assertEqual(wheel.advance(105), [('a', None)])
+
+    def test_fractional_deadlines(self):
+        wheel = TimerWheel(1.0, slots=60)
+        wheel.advance(100)
+        wheel.add('a', 100.25)
+        wheel.add('b', 100.75)
+
+        self.assertEqual(wheel.advance(100.5), [])
+        self.assertEqual(sorted(k for k, p in wheel.advance(101)),
+                         ['a', 'b'])
+
+    def test_past_deadline_fires_on_next_tick(self):
+        wheel = TimerWheel(1.0, slots=60)
+        wheel.advance(100)
+        wheel.add('a', 90)
+
+        self.assertEqual(wheel.advance(101), [('a', None)])
+
+    def test_due_before_first_advance(self):
+        wheel = TimerWheel(1.0, slots=60)
+        wheel.add('a', 10)
+        wheel.add('b', 1000)
+
+        self.assertEqual(wheel.advance(500), [('a', None)])
+        self.assertIn('b', wheel)
+
+    def test_timer_beyond_one_revolution(self):
+        wheel = TimerWheel(1.0, slots=10)
+        wheel.advance(100)
+        wheel.add('a', 125)
+
+        # The wheel passes the timer's slot twice before it is due
+        for now in range(101, 125):
+            self.assertEqual(wheel.advance(now), [])
+        self.assertEqual(wheel.advance(125), [('a', None)])
+
+    def test_large_jump(self):
+        wheel = TimerWheel(1.0, slots=10)
+        wheel.advance(100)
+        wheel.add('a', 103)
+        wheel.add('b', 150)
+
+        self.assertEqual(wheel.advance(140), [('a', None)])
+        self.assertEqual(wheel.advance(150), [('b', None)])
+
+    def test_replace_and_remove(self):
+        wheel = TimerWheel(1.0, slots=60)
+        wheel.add('a', 105, 1)
+        wheel.add('a', 110, 2)
+        wheel.add('b', 105)
+
+        self.assertTrue(wheel.remove('b'))
+        self.assertFalse(wheel.remove('b'))
+        self.assertEqual(wheel.advance(105), [])
+        self.assertEqual(wheel.advance(110), [('a', 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import math
+import threading
+
+
+class TimerWheel:
+    """A hashed timer wheel. Timers are put in the slot of the first tick
+    at or after their deadline, modulo the size of the wheel, so they are
+    due when the wheel reaches that tick. Adding and removing a timer
+    costs O(1), and every tick only looks at the timers of the slots it
+    passes. Timers more than one revolution away stay in their slot until
+    the wheel comes round to them again
+
+    """
+
+    def __init__(self, tick=1.0, slots=3600):
+        """
+        Parameters
+        ----------
+        tick : float
+            Seconds covered by each slot
+        slots : int
+            Number of slots, one revolution takes tick * slots seconds
+        """
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+
+        # Deadline, payload and slot of every timer, by key
+        self.timers = {}
+
+        # Last tick the wheel was advanced to, None before the first
+        self.current = None
+
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def get_slot(self, deadline):
+        """ Returns the index of the slot a timer with the specified
+        deadline goes to
+
+        """
+        t = math.ceil(deadline / self.tick)
+
+        # Timers due in a tick the wheel has passed fire on the next one
+        if self.current is not None and t <= self.current:
+            t = self.current + 1
+
+        return t % len(self.slots)
+
+    def add(self, key, deadline, payload=None):
+        """ Starts a timer, replacing any timer with the same key
+
+        Parameters
+        ----------
+        key : hashable
+            Identifies the timer
+        deadline : float
+            Unix timestamp the timer fires at
+        payload : object
+            Returned with the key when the timer fires
+        """
+        with self.lock:
+            self.discard(key)
+            slot = self.get_slot(deadline)
+            self.timers[key] = (deadline, payload, slot)
+            self.slots[slot].add(key)
+
+    def remove(self, key):
+        """ Cancels a timer
+        Returns False if there was no timer with that key
+
+        """
+        with self.lock:
+            return self.discard(key)
+
+    def discard(self, key):
+        # Must be called with lock held
+        timer = self.timers.pop(key, None)
+        if timer is None:
+            return False
+        self.slots[timer[2]].discard(key)
+        return True
+
+    def advance(self, now):
+        """ Moves the wheel forward to the Unix timestamp now
+        Returns a list of (key, payload) tuples of the timers that fired
+
+        """
+        fired = []
+
+        with self.lock:
+            end = int(now // self.tick)
+
+            # Timers added before the first tick may already be due
+            # anywhere on the wheel
+            if self.current is None or end - self.current >= len(self.slots):
+                ticks = range(end - len(self.slots) + 1, end + 1)
+            else:
+                ticks = range(self.current + 1, end + 1)
+
+            for t in ticks:
+                slot = self.slots[t % len(self.slots)]
+                for key in [k for k in slot if self.timers[k][0] <= now]:
+                    slot.discard(key)
+                    fired.append((key, self.timers.pop(key)[1]))
+
+            self.current = end
+
+        return fired
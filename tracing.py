@@ -0,0 +1,137 @@
+import asyncio
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+# Returned by Tracer.span while not recording, entering it costs nothing
+NO_SPAN = contextlib.nullcontext()
+
+
+def get_track():
+    """Returns the ID and name of the timeline the current code runs on:
+    the running asyncio task, or else the current thread
+
+    """
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+
+    if task is not None:
+        return id(task), task.get_name()
+
+    thread = threading.current_thread()
+    return thread.ident, thread.name
+
+
+class Span:
+    """Records the duration of a with block as a trace event
+
+    """
+
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.record(self.name, self.start, time.perf_counter(),
+                           self.args)
+
+
+class Tracer:
+    """Records spans around the stages of the bot, e.g. command handlers,
+    feed fetches and sends, in the Chrome trace event format, which
+    chrome://tracing and Perfetto display as a timeline per thread and
+    asyncio task
+
+    Nothing is recorded between start and stop, spans then only cost a
+    function call
+
+    """
+
+    def __init__(self):
+        # Recorded events, None while not recording
+        self.events = None
+
+        # Names of the timelines of the recorded events, by ID
+        self.tracks = {}
+
+        self.lock = threading.Lock()
+
+    def start(self):
+        """ Starts recording spans
+        Throws RuntimeError if already recording
+
+        """
+        with self.lock:
+            if self.events is not None:
+                raise RuntimeError('A trace is already being recorded')
+            self.events = []
+            self.tracks = {}
+
+    def stop(self):
+        """ Stops recording
+        Returns the recorded trace, as expected by save
+
+        """
+        with self.lock:
+            events, self.events = self.events or [], None
+            tracks, self.tracks = self.tracks, {}
+
+        pid = os.getpid()
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                     'tid': tid, 'args': {'name': name}}
+                    for tid, name in tracks.items()]
+
+        return {'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}
+
+    def span(self, name, **args):
+        """ Returns a context manager recording its block as a span
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage, e.g. 'fetch'
+        args : dict
+            Details shown with the span, e.g. the URL
+        """
+        if self.events is None:
+            return NO_SPAN
+        return Span(self, name, args)
+
+    def record(self, name, start, end, args):
+        tid, track = get_track()
+
+        event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                 'args': args}
+
+        with self.lock:
+            # Spans still open when recording stopped are dropped
+            if self.events is not None:
+                self.events.append(event)
+                self.tracks[tid] = track
+
+
+def save(trace, path):
+    """Writes a trace returned by Tracer.stop to a JSON file
+
+    """
+    with open(path, 'w') as f:
+        json.dump(trace, f)
+
+
+# Spans of the bot, recorded by the modules doing the work
+TRACER = Tracer()
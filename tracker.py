@@ -0,0 +1,149 @@
+import heapq
+import threading
+import time
+
+
+class SeenTracker:
+    """Keeps the IDs of already notified items until they expire
+
+    Every ID has a deadline (a UNIX timestamp), kept in a dict for
+    membership tests and in a heap ordered by deadline for eviction.
+    Extending a deadline only updates the dict, the heap entry is moved
+    when it reaches the top, so the heap holds about one entry per ID
+
+    """
+
+    def __init__(self, retention=3600, deadlines=None):
+
+        # Seconds an item is remembered after it was last seen, for
+        # items without a deadline of their own
+        self.retention = retention
+
+        # Deadline of every tracked ID
+        self.deadlines = dict(deadlines) if deadlines else {}
+
+        # (deadline, ID) pairs, may contain outdated entries
+        self.heap = [(d, i) for i, d in self.deadlines.items()]
+        heapq.heapify(self.heap)
+
+        # Called by diff with a dict of changed ID -> deadline and a list
+        # of evicted IDs, e.g. to persist them
+        self.listener = None
+
+        self.lock = threading.Lock()
+
+    def __contains__(self, item_id):
+        return item_id in self.deadlines
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def add(self, item_id, deadline=None):
+        """ Tracks an ID, or extends its deadline if already tracked
+        Returns True if the ID was not tracked before
+
+        Parameters
+        ----------
+        item_id : hashable
+            ID of the item
+        deadline : float
+            UNIX timestamp after which the ID is forgotten, defaults to
+            retention seconds from now
+        """
+        if deadline is None:
+            deadline = time.time() + self.retention
+
+        with self.lock:
+            old = self.deadlines.get(item_id)
+            self.deadlines[item_id] = deadline
+
+            # A later deadline is picked up when the old entry is popped
+            if old is None or deadline < old:
+                heapq.heappush(self.heap, (deadline, item_id))
+
+        return old is None
+
+    def evict(self, now=None):
+        """ Forgets every ID whose deadline has passed
+        Returns the list of forgotten IDs
+
+        Parameters
+        ----------
+        now : float
+            Current UNIX timestamp, defaults to time.time()
+        """
+        if now is None:
+            now = time.time()
+
+        evicted = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, item_id = heapq.heappop(self.heap)
+                current = self.deadlines.get(item_id)
+
+                if current is None or current < deadline:
+                    # Outdated entry
+                    continue
+                if current > deadline:
+                    # Deadline was extended, move the entry
+                    heapq.heappush(self.heap, (current, item_id))
+                    continue
+
+                del self.deadlines[item_id]
+                evicted.append(item_id)
+
+        return evicted
+
+    def diff(self, items, deadline=None, now=None):
+        """ Tracks every item of a feed and returns the ones that were
+        not tracked before, in feed order. Expired IDs are evicted
+        first
+
+        Parameters
+        ----------
+        items : iterable
+            Objects with an id attribute
+        deadline : function
+            Called with an item, returns its deadline as a UNIX
+            timestamp. Defaults to retention seconds from now
+        now : float
+            Current UNIX timestamp, defaults to time.time()
+        """
+        if now is None:
+            now = time.time()
+
+        evicted = self.evict(now)
+
+        new = []
+        changed = {}
+        for i in items:
+            d = deadline(i) if deadline else now + self.retention
+            if self.deadlines.get(i.id) != d:
+                changed[i.id] = d
+            if self.add(i.id, d):
+                new.append(i)
+
+        if self.listener and (changed or evicted):
+            self.listener(changed, evicted)
+
+        return new
+
+    def to_dict(self):
+        """ Returns a dict of ID -> deadline, suitable for saving
+
+        """
+        with self.lock:
+            return dict(self.deadlines)
+
+    @classmethod
+    def load(cls, saved, retention=3600):
+        """ Returns a SeenTracker with saved IDs. saved is either a dict
+        returned by to_dict, or a list of IDs as found in older state
+        files, which are given a deadline of retention seconds from now
+
+        """
+        if isinstance(saved, dict):
+            return cls(retention, saved)
+
+        deadline = time.time() + retention
+        return cls(retention, {i: deadline for i in saved})
@@ -0,0 +1,98 @@
+import hmac
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accepts telegram updates POSTed to the webhook path
+
+    """
+
+    # Telegram keeps connections alive between updates
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+
+        if self.path != server.path:
+            self.answer(404)
+            return
+
+        # Telegram sends the secret given to setWebhook with every update.
+        # compare_digest raises TypeError on non-ASCII str, compare bytes
+        token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode(), server.secret.encode()):
+            self.answer(403)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            update = json.loads(self.rfile.read(length).decode())
+        except (ValueError, UnicodeDecodeError):
+            self.answer(400)
+            return
+
+        # Telegram delivers the update again later if it is not accepted
+        if server.receive(update, server.queue_timeout):
+            self.answer(200)
+        else:
+            self.answer(503)
+
+    def answer(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """An HTTP server receiving telegram updates, to be run behind a
+    reverse proxy terminating TLS
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, path, secret, receive, queue_timeout=5):
+        """
+        Parameters
+        ----------
+        address : (str, int) tuple
+            Host and port to listen on
+        path : str
+            URL path updates are POSTed to
+        secret : str
+            Secret token given to setWebhook
+        receive : function
+            Called with every update and queue_timeout, returns False if
+            the update could not be queued
+        queue_timeout : float
+            Seconds to wait for room in a full queue before refusing an
+            update
+        """
+        super().__init__(address, WebhookHandler)
+
+        self.path = path or '/'
+        self.secret = secret
+        self.receive = receive
+        self.queue_timeout = queue_timeout
+
+        self.thread = None
+
+    def start(self):
+        """ Starts serving in a new thread
+
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stops serving and closes the socket
+
+        """
+        self.shutdown()
+        self.server_close()